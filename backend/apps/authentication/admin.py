@@ -1,7 +1,8 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.models import User
-from .models import UserProfile
+from django.db.models import Count
+from .models import UserProfile, get_or_create_profile
 
 
 class UserProfileInline(admin.StackedInline):
@@ -14,16 +15,31 @@ class UserProfileInline(admin.StackedInline):
 class CustomUserAdmin(UserAdmin):
     inlines = (UserProfileInline,)
     list_display = UserAdmin.list_display + ('get_storage_used', 'get_file_count')
+    list_select_related = ('profile',)
+    
+    def get_queryset(self, request):
+        # Count files in the changelist query instead of once per row
+        return super().get_queryset(request).select_related('profile').annotate(
+            _file_count=Count('file_documents')
+        )
+    
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        # The profile inline is only saved when edited, so make sure one exists
+        get_or_create_profile(form.instance)
     
     def get_storage_used(self, obj):
-        if hasattr(obj, 'profile'):
-            return obj.profile.formatted_storage_used
+        # The profile is joined by get_queryset; read the cached relation once
+        profile = getattr(obj, 'profile', None)
+        if profile is not None:
+            return profile.formatted_storage_used
         return "N/A"
     get_storage_used.short_description = 'Storage Used'
     
     def get_file_count(self, obj):
-        return obj.file_documents.count()
+        return obj._file_count
     get_file_count.short_description = 'Files Count'
+    get_file_count.admin_order_field = '_file_count'
 
 
 # Re-register UserAdmin
@@ -34,10 +50,22 @@ admin.site.register(User, CustomUserAdmin)
 @admin.register(UserProfile)
 class UserProfileAdmin(admin.ModelAdmin):
     list_display = ('user', 'formatted_storage_used', 'formatted_storage_limit', 'storage_usage_percentage', 'created_at')
+    list_select_related = ('user',)
     list_filter = ('created_at',)
     search_fields = ('user__username', 'user__email')
     readonly_fields = ('created_at', 'storage_used', 'formatted_storage_used', 'formatted_storage_limit', 'storage_usage_percentage')
     
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        match = getattr(request, 'resolver_match', None)
+        if match and match.url_name == f'{self.opts.app_label}_{self.opts.model_name}_changelist':
+            # The list columns only derive from these, so skip the rest of each row
+            queryset = queryset.only(
+                'id', 'user__id', 'user__username',
+                'storage_used', 'storage_limit', 'created_at'
+            )
+        return queryset
+    
     fieldsets = (
         (None, {
             'fields': ('user',)
@@ -0,0 +1,20 @@
+# Generated by Django 5.2.6 on 2026-10-16 09:12
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0001_initial'),
+    ]
+
+    operations = [
+        # auth.User belongs to django.contrib.auth, so the constraint can't be
+        # declared on the model; enforce case-insensitive email uniqueness
+        # with a partial index instead (blank emails are still allowed).
+        migrations.RunSQL(
+            sql="CREATE UNIQUE INDEX uniq_user_email_ci ON auth_user (LOWER(email)) WHERE email <> '';",
+            reverse_sql="DROP INDEX uniq_user_email_ci;",
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-16 01:16
+
+import django.db.models.expressions
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0003_userprofile_updated_at'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='userprofile',
+            index=models.Index(fields=['storage_used'], name='authenticat_storage_5a6cd4_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userprofile',
+            index=models.Index(django.db.models.expressions.CombinedExpression(models.F('storage_limit'), '-', models.F('storage_used')), name='profile_free_bytes_idx'),
+        ),
+    ]
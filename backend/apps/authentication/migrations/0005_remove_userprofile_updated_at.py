@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-16 03:50
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0004_userprofile_storage_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='userprofile',
+            name='updated_at',
+        ),
+    ]
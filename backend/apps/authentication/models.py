@@ -1,7 +1,22 @@
+import functools
+
 from django.db import models
-from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.utils.functional import cached_property
+
+
+_SIZE_UNITS = ('bytes', 'KB', 'MB', 'GB', 'TB')
+
+
+@functools.lru_cache(maxsize=1024)
+def _format_bytes(size):
+    """Format a byte count as a human-readable string"""
+    # 1024 == 2**10, so the unit index is the bit length divided by ten
+    i = min((max(size, 1).bit_length() - 1) // 10, len(_SIZE_UNITS) - 1)
+    return f"{size / (1 << (10 * i)):.1f} {_SIZE_UNITS[i]}"
 
 
 class UserProfile(models.Model):
@@ -22,12 +37,27 @@ class UserProfile(models.Model):
         help_text="Storage currently used in bytes"
     )
     
+    class Meta:
+        indexes = [
+            models.Index(fields=['storage_used']),
+            # Free space, for near-quota reports
+            models.Index(
+                models.F('storage_limit') - models.F('storage_used'),
+                name='profile_free_bytes_idx'
+            ),
+        ]
+    
     def __str__(self):
         return f"{self.user.username}'s Profile"
     
-    @property
+    def save(self, *args, **kwargs):
+        # Storage values may have changed; drop the memoized percentage
+        self.__dict__.pop('storage_usage_percentage', None)
+        super().save(*args, **kwargs)
+    
+    @cached_property
     def storage_usage_percentage(self):
-        """Calculate storage usage as percentage"""
+        """Calculate storage usage as percentage (computed once per instance)"""
         if self.storage_limit == 0:
             return 0
         return (self.storage_used / self.storage_limit) * 100
@@ -35,37 +65,69 @@ class UserProfile(models.Model):
     @property
     def formatted_storage_used(self):
         """Get human-readable storage used"""
-        size = self.storage_used
-        for unit in ['bytes', 'KB', 'MB', 'GB']:
-            if size < 1024.0:
-                return f"{size:.1f} {unit}"
-            size /= 1024.0
-        return f"{size:.1f} TB"
+        return _format_bytes(self.storage_used)
     
     @property
     def formatted_storage_limit(self):
         """Get human-readable storage limit"""
-        size = self.storage_limit
-        for unit in ['bytes', 'KB', 'MB', 'GB']:
-            if size < 1024.0:
-                return f"{size:.1f} {unit}"
-            size /= 1024.0
-        return f"{size:.1f} TB"
+        return _format_bytes(self.storage_limit)
     
     def can_upload_file(self, file_size):
         """Check if user can upload a file of given size"""
         return (self.storage_used + file_size) <= self.storage_limit
+    
+    @classmethod
+    def try_reserve(cls, user_id, size):
+        """
+        Atomically reserve storage for an upload of the given size
+        
+        Runs a single conditional UPDATE, so concurrent uploads can't both
+        pass the quota check. Returns True if the space was reserved.
+        """
+        updated = cls.objects.filter(
+            user_id=user_id,
+            storage_used__lte=models.F('storage_limit') - size
+        ).update(storage_used=models.F('storage_used') + size)
+        return updated == 1
+    
+    @classmethod
+    def create_for_users(cls, users):
+        """Create profiles for many users with a single bulk INSERT"""
+        return cls.objects.bulk_create(
+            [cls(user_id=user.pk) for user in users],
+            ignore_conflicts=True
+        )
 
 
-@receiver(post_save, sender=User)
-def create_user_profile(sender, instance, created, **kwargs):
-    """Create user profile when user is created"""
-    if created:
-        UserProfile.objects.create(user=instance)
+def get_or_create_profile(user):
+    """
+    Get the user's profile, creating it if missing
+    
+    Registration creates profiles explicitly; this covers accounts created
+    through other paths such as createsuperuser.
+    """
+    try:
+        return user.profile
+    except UserProfile.DoesNotExist:
+        profile, _ = UserProfile.objects.get_or_create(user=user)
+        user.profile = profile
+        return profile
+
+
+def profile_cache_key(user_id):
+    """Cache key for the user's profile response"""
+    return f"profile:{user_id}"
 
 
 @receiver(post_save, sender=User)
-def save_user_profile(sender, instance, **kwargs):
-    """Save user profile when user is saved"""
-    if hasattr(instance, 'profile'):
-        instance.profile.save()
+@receiver(post_save, sender=UserProfile)
+@receiver(post_delete, sender=UserProfile)
+def invalidate_profile_cache(sender, instance, **kwargs):
+    """
+    Drop the cached profile response when the user or profile changes
+    
+    Logins save the user. Document and revision changes, and storage
+    updates made with a queryset update(), clear the key where they happen.
+    """
+    user_id = instance.pk if sender is User else instance.user_id
+    cache.delete(profile_cache_key(user_id))
@@ -2,9 +2,20 @@ from rest_framework import serializers
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 from django.contrib.auth.models import User
 from django.contrib.auth.password_validation import validate_password
+from django.db import IntegrityError, transaction
+from apps.files.models import FileRevision
 from .models import UserProfile
 
 
+EMAIL_UNIQUE_INDEX = 'uniq_user_email_ci'
+DUPLICATE_EMAIL_MESSAGE = "A user with this email already exists."
+
+
+def _is_duplicate_email(error):
+    """Check whether an IntegrityError comes from the unique email index"""
+    return EMAIL_UNIQUE_INDEX in str(error)
+
+
 class CustomTokenObtainPairSerializer(TokenObtainPairSerializer):
     """
     Custom token serializer to include user information in login response
@@ -59,39 +70,52 @@ class RegisterSerializer(serializers.ModelSerializer):
     
     def validate(self, attrs):
         """
-        Validate that passwords match and email is unique
+        Validate that passwords match
         """
         if attrs['password'] != attrs['password_confirm']:
             raise serializers.ValidationError(
                 {"password": "Password fields didn't match."}
             )
         
-        if User.objects.filter(email=attrs['email']).exists():
-            raise serializers.ValidationError(
-                {"email": "A user with this email already exists."}
-            )
-        
         return attrs
     
     def create(self, validated_data):
         """
-        Create user with encrypted password
+        Create user with encrypted password and their profile
+        
+        Email uniqueness is enforced by the database index rather than a
+        pre-check query, so duplicates surface as an IntegrityError here.
         """
         validated_data.pop('password_confirm')
-        user = User.objects.create_user(**validated_data)
+        try:
+            with transaction.atomic():
+                user = User.objects.create_user(**validated_data)
+                UserProfile.objects.create(user=user)
+        except IntegrityError as e:
+            if _is_duplicate_email(e):
+                raise serializers.ValidationError({"email": DUPLICATE_EMAIL_MESSAGE})
+            raise
         return user
 
 
+class UserStorageSerializer(serializers.ModelSerializer):
+    """
+    Storage fields of a user's profile
+    """
+    
+    class Meta:
+        model = UserProfile
+        fields = ('storage_used', 'storage_limit', 'storage_usage_percentage',
+                 'formatted_storage_used', 'formatted_storage_limit')
+        read_only_fields = fields
+
+
 class UserProfileSerializer(serializers.ModelSerializer):
     """
-    User profile serializer for getting/updating user information
+    User profile serializer for getting user information
     """
-    # Include profile information
-    storage_used = serializers.ReadOnlyField(source='profile.storage_used')
-    storage_limit = serializers.ReadOnlyField(source='profile.storage_limit')
-    storage_usage_percentage = serializers.ReadOnlyField(source='profile.storage_usage_percentage')
-    formatted_storage_used = serializers.ReadOnlyField(source='profile.formatted_storage_used')
-    formatted_storage_limit = serializers.ReadOnlyField(source='profile.formatted_storage_limit')
+    # Include profile information (resolved once, flattened in to_representation)
+    storage = UserStorageSerializer(source='profile', read_only=True)
     
     # User statistics
     total_files = serializers.SerializerMethodField()
@@ -100,26 +124,65 @@ class UserProfileSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ('id', 'username', 'email', 'first_name', 'last_name',
-                 'date_joined', 'last_login', 'storage_used', 'storage_limit',
-                 'storage_usage_percentage', 'formatted_storage_used',
-                 'formatted_storage_limit', 'total_files', 'total_revisions')
+                 'date_joined', 'last_login', 'storage', 'total_files',
+                 'total_revisions')
         read_only_fields = ('id', 'username', 'date_joined', 'last_login')
     
+    def to_representation(self, instance):
+        """
+        Keep the storage fields at the top level of the response
+        """
+        data = super().to_representation(instance)
+        data.update(data.pop('storage', None) or {})
+        return data
+    
+    def _has_files(self, obj):
+        """Cheap EXISTS probe so users without files skip the aggregates"""
+        if not hasattr(obj, '_has_files'):
+            obj._has_files = obj.file_documents.exists()
+        return obj._has_files
+    
     def get_total_files(self, obj):
         """Get total number of files for user"""
+        if hasattr(obj, '_total_files'):
+            return obj._total_files
+        if not self._has_files(obj):
+            return 0
         return obj.file_documents.count()
     
     def get_total_revisions(self, obj):
         """Get total number of file revisions for user"""
-        return sum(doc.get_revision_count() for doc in obj.file_documents.all())
+        if hasattr(obj, '_total_revisions'):
+            return obj._total_revisions
+        if not self._has_files(obj):
+            return 0
+        return FileRevision.objects.filter(document__owner=obj).count()
+
+
+class UserProfileWriteSerializer(serializers.ModelSerializer):
+    """
+    User profile serializer for updates
+    
+    Only carries the editable user fields so that writes don't recompute
+    the storage and file statistics exposed by UserProfileSerializer.
+    """
+    
+    class Meta:
+        model = User
+        fields = ('id', 'username', 'email', 'first_name', 'last_name')
+        read_only_fields = ('id', 'username')
     
-    def validate_email(self, value):
+    def update(self, instance, validated_data):
         """
-        Validate that email is unique (excluding current user)
+        Update user, reporting duplicate emails caught by the unique index
         """
-        if User.objects.filter(email=value).exclude(id=self.instance.id).exists():
-            raise serializers.ValidationError("A user with this email already exists.")
-        return value
+        try:
+            with transaction.atomic():
+                return super().update(instance, validated_data)
+        except IntegrityError as e:
+            if _is_duplicate_email(e):
+                raise serializers.ValidationError({"email": DUPLICATE_EMAIL_MESSAGE})
+            raise
 
 
 class PasswordChangeSerializer(serializers.Serializer):
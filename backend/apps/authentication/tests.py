@@ -1,10 +1,13 @@
-from django.test import TestCase
+from django.test import RequestFactory, TestCase
+from django.contrib.admin.sites import site
 from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.urls import reverse
 from rest_framework.test import APITestCase, APIClient
 from rest_framework import status
 from rest_framework_simplejwt.tokens import RefreshToken
-from .models import UserProfile
+from apps.files.models import FileDocument, FileRevision
+from .models import UserProfile, get_or_create_profile
 from .serializers import RegisterSerializer, UserProfileSerializer, CustomTokenObtainPairSerializer
 
 
@@ -17,12 +20,27 @@ class UserProfileModelTest(TestCase):
             email='test@example.com',
             password='testpass123'
         )
-        self.profile = self.user.profile
+        self.profile = UserProfile.objects.create(user=self.user)
     
-    def test_user_profile_created_automatically(self):
-        """Test that UserProfile is created automatically when User is created"""
-        self.assertIsInstance(self.profile, UserProfile)
-        self.assertEqual(self.profile.user, self.user)
+    def test_get_or_create_profile(self):
+        """Test that get_or_create_profile returns the existing profile"""
+        self.assertEqual(get_or_create_profile(self.user), self.profile)
+    
+    def test_get_or_create_profile_missing(self):
+        """Test that get_or_create_profile creates a profile when missing"""
+        user = User.objects.create_user(username='noprofile', password='testpass123')
+        profile = get_or_create_profile(user)
+        self.assertIsInstance(profile, UserProfile)
+        self.assertEqual(user.profile, profile)
+    
+    def test_create_for_users(self):
+        """Test bulk profile creation"""
+        users = [
+            User.objects.create_user(username=f'bulk{i}', password='testpass123')
+            for i in range(3)
+        ]
+        UserProfile.create_for_users(users)
+        self.assertEqual(UserProfile.objects.filter(user__in=users).count(), 3)
     
     def test_storage_usage_percentage(self):
         """Test storage usage percentage calculation"""
@@ -31,6 +49,11 @@ class UserProfileModelTest(TestCase):
         self.profile.save()
         
         self.assertEqual(self.profile.storage_usage_percentage, 25.0)
+        
+        # Saving new values recomputes the cached percentage
+        self.profile.storage_used = 500
+        self.profile.save()
+        self.assertEqual(self.profile.storage_usage_percentage, 50.0)
     
     def test_storage_usage_percentage_zero_limit(self):
         """Test storage usage percentage with zero limit"""
@@ -47,6 +70,10 @@ class UserProfileModelTest(TestCase):
             (1536, "1.5 KB"),
             (1572864, "1.5 MB"),
             (1610612736, "1.5 GB"),
+            (0, "0.0 bytes"),
+            (1023, "1023.0 bytes"),
+            (1024, "1.0 KB"),
+            (1649267441664, "1.5 TB"),
         ]
         
         for size, expected in test_cases:
@@ -71,12 +98,128 @@ class UserProfileModelTest(TestCase):
         self.assertTrue(self.profile.can_upload_file(200))  # At limit
         self.assertFalse(self.profile.can_upload_file(300))  # Over limit
     
+    def test_try_reserve(self):
+        """Test atomic storage reservation"""
+        self.profile.storage_limit = 1000
+        self.profile.storage_used = 800
+        self.profile.save()
+        
+        self.assertTrue(UserProfile.try_reserve(self.user.id, 200))  # Up to limit
+        self.assertFalse(UserProfile.try_reserve(self.user.id, 1))  # Over limit
+        
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.storage_used, 1000)
+    
     def test_profile_str_representation(self):
         """Test string representation of UserProfile"""
         expected = f"{self.user.username}'s Profile"
         self.assertEqual(str(self.profile), expected)
 
 
+class CustomUserAdminTest(TestCase):
+    """Test cases for CustomUserAdmin"""
+    
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            email='test@example.com',
+            password='testpass123'
+        )
+        UserProfile.objects.create(user=self.user)
+        FileDocument.objects.create(url='/documents/a.txt', name='a.txt', owner=self.user)
+        FileDocument.objects.create(url='/documents/b.txt', name='b.txt', owner=self.user)
+        self.model_admin = site._registry[User]
+        self.request = RequestFactory().get('/admin/auth/user/')
+        self.request.user = self.user
+    
+    def test_file_count_is_annotated(self):
+        """Test that file counts come from the changelist queryset"""
+        user = self.model_admin.get_queryset(self.request).get(pk=self.user.pk)
+        
+        with self.assertNumQueries(0):
+            self.assertEqual(self.model_admin.get_file_count(user), 2)
+            self.assertEqual(self.model_admin.get_storage_used(user), "0.0 bytes")
+    
+    def test_storage_used_without_profile(self):
+        """Test that users without a profile show N/A without extra queries"""
+        User.objects.create_user(username='noprofile', password='testpass123')
+        user = self.model_admin.get_queryset(self.request).get(username='noprofile')
+        
+        with self.assertNumQueries(0):
+            self.assertEqual(self.model_admin.get_storage_used(user), "N/A")
+
+
+class UserProfileAdminTest(TestCase):
+    """Test cases for UserProfileAdmin"""
+    
+    def setUp(self):
+        self.admin_user = User.objects.create_superuser(
+            username='admin',
+            email='admin@example.com',
+            password='adminpass123'
+        )
+        UserProfile.create_for_users([
+            User.objects.create_user(
+                username=f'user{i}',
+                email=f'user{i}@example.com',
+                password='testpass123'
+            )
+            for i in range(3)
+        ])
+        self.client.force_login(self.admin_user)
+    
+    def test_changelist_query_count_is_constant(self):
+        """Test that the profile changelist doesn't query per row"""
+        url = reverse('admin:authentication_userprofile_changelist')
+        self.client.get(url)  # warm up session/content type lookups
+        
+        # Session, user, the two changelist counts and one page of profiles
+        with self.assertNumQueries(5):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'user2')
+        
+        UserProfile.create_for_users([
+            User.objects.create_user(username='user3', email='user3@example.com', password='testpass123')
+        ])
+        with self.assertNumQueries(5):
+            self.client.get(url)
+
+
+class UserProfileSerializerTest(TestCase):
+    """Test cases for UserProfileSerializer"""
+    
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            email='test@example.com',
+            password='testpass123'
+        )
+    
+    def test_totals_without_files_use_single_probe(self):
+        """Test that users without files skip the count and aggregate queries"""
+        serializer = UserProfileSerializer()
+        with self.assertNumQueries(1):
+            self.assertEqual(serializer.get_total_files(self.user), 0)
+            self.assertEqual(serializer.get_total_revisions(self.user), 0)
+    
+    def test_total_revisions_counts_across_documents(self):
+        """Test revision totals without annotations"""
+        for i in range(2):
+            document = FileDocument.objects.create(
+                url=f'/documents/{i}.txt', name=f'{i}.txt', owner=self.user
+            )
+            for j in range(2):
+                FileRevision.objects.create(
+                    document=document,
+                    file_data=SimpleUploadedFile(f"{i}_{j}.txt", b"content")
+                )
+        
+        serializer = UserProfileSerializer()
+        self.assertEqual(serializer.get_total_files(self.user), 2)
+        self.assertEqual(serializer.get_total_revisions(self.user), 4)
+
+
 class RegisterSerializerTest(TestCase):
     """Test cases for RegisterSerializer"""
     
@@ -97,6 +240,7 @@ class RegisterSerializerTest(TestCase):
         self.assertEqual(user.username, 'newuser')
         self.assertEqual(user.email, 'new@example.com')
         self.assertTrue(user.check_password('complexpassword123'))
+        self.assertTrue(UserProfile.objects.filter(user=user).exists())
     
     def test_password_mismatch(self):
         """Test serializer validation with mismatched passwords"""
@@ -120,13 +264,19 @@ class RegisterSerializerTest(TestCase):
         
         data = {
             'username': 'newuser',
-            'email': 'existing@example.com',
+            'email': 'Existing@Example.com',
             'password': 'ComplexPassword123!',
             'password_confirm': 'ComplexPassword123!',
         }
         serializer = RegisterSerializer(data=data)
-        self.assertFalse(serializer.is_valid())
-        self.assertIn('email', serializer.errors)
+        self.assertTrue(serializer.is_valid())
+        
+        # Duplicates are rejected by the unique index on save
+        from rest_framework.exceptions import ValidationError
+        with self.assertRaises(ValidationError) as cm:
+            serializer.save()
+        self.assertIn('email', cm.exception.detail)
+        self.assertFalse(User.objects.filter(username='newuser').exists())
 
 
 class AuthenticationAPITest(APITestCase):
@@ -217,6 +367,26 @@ class AuthenticationAPITest(APITestCase):
         self.assertEqual(response.data['email'], 'test@example.com')
         self.assertIn('storage_used', response.data)
         self.assertIn('storage_limit', response.data)
+        self.assertEqual(response.data['formatted_storage_limit'], "1.0 GB")
+        self.assertNotIn('storage', response.data)
+    
+    def test_user_profile_file_totals(self):
+        """Test that profile totals count documents and their revisions"""
+        tokens = self.get_tokens(self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {tokens["access"]}')
+        
+        doc1 = FileDocument.objects.create(url='/documents/a.txt', name='a.txt', owner=self.user)
+        FileDocument.objects.create(url='/documents/b.txt', name='b.txt', owner=self.user)
+        for i in range(3):
+            FileRevision.objects.create(
+                document=doc1,
+                file_data=SimpleUploadedFile(f"a{i}.txt", b"content")
+            )
+        
+        response = self.client.get(self.profile_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['total_files'], 2)
+        self.assertEqual(response.data['total_revisions'], 3)
     
     def test_user_profile_update(self):
         """Test update user profile endpoint"""
@@ -239,6 +409,59 @@ class AuthenticationAPITest(APITestCase):
         self.user.refresh_from_db()
         self.assertEqual(self.user.first_name, 'Updated')
     
+    def test_user_profile_get_is_cached(self):
+        """Test that repeated profile reads are served from cache until an update"""
+        tokens = self.get_tokens(self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {tokens["access"]}')
+        
+        first = self.client.get(self.profile_url)
+        with self.assertNumQueries(1):  # authenticated user only
+            second = self.client.get(self.profile_url)
+        self.assertEqual(first.data, second.data)
+        
+        self.client.patch(self.profile_url, {'first_name': 'Changed'})
+        response = self.client.get(self.profile_url)
+        self.assertEqual(response.data['first_name'], 'Changed')
+    
+    def test_user_profile_cache_cleared_on_profile_save(self):
+        """Test that saving the profile row invalidates the cached response"""
+        tokens = self.get_tokens(self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {tokens["access"]}')
+        self.client.get(self.profile_url)
+        
+        profile = UserProfile.objects.get(user=self.user)
+        profile.storage_used = 2048
+        profile.save()
+        
+        response = self.client.get(self.profile_url)
+        self.assertEqual(response.data['storage_used'], 2048)
+    
+    def test_user_profile_cache_cleared_on_file_change(self):
+        """Test that adding or deleting a document invalidates the cached response"""
+        tokens = self.get_tokens(self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {tokens["access"]}')
+        self.assertEqual(self.client.get(self.profile_url).data['total_files'], 0)
+        
+        document = FileDocument.objects.create(url='/documents/a.txt', name='a.txt', owner=self.user)
+        self.assertEqual(self.client.get(self.profile_url).data['total_files'], 1)
+        
+        document.delete()
+        self.assertEqual(self.client.get(self.profile_url).data['total_files'], 0)
+    
+    def test_user_profile_update_duplicate_email(self):
+        """Test that profile update rejects an email used by another user"""
+        User.objects.create_user(
+            username='other',
+            email='other@example.com',
+            password='otherpass123'
+        )
+        tokens = self.get_tokens(self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {tokens["access"]}')
+        
+        response = self.client.patch(self.profile_url, {'email': 'other@example.com'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('email', response.data)
+    
     def test_profile_access_requires_authentication(self):
         """Test that profile access requires authentication"""
         response = self.client.get(self.profile_url)
@@ -294,6 +517,9 @@ class AuthenticationAPITest(APITestCase):
         
         for field in expected_fields:
             self.assertIn(field, response.data)
+        
+        self.assertEqual(response.data['total_files'], 0)
+        self.assertEqual(response.data['total_revisions'], 0)
 
 
 class CustomTokenObtainPairSerializerTest(TestCase):
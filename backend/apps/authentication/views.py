@@ -6,8 +6,16 @@ from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework_simplejwt.views import TokenObtainPairView
 from django.contrib.auth.models import User
 from django.contrib.auth import authenticate
-from .serializers import RegisterSerializer, UserProfileSerializer, CustomTokenObtainPairSerializer
-from .models import UserProfile
+from django.core.cache import cache
+from django.db.models import Count
+from .serializers import (
+    RegisterSerializer, UserProfileSerializer, UserProfileWriteSerializer,
+    CustomTokenObtainPairSerializer
+)
+from .models import UserProfile, get_or_create_profile, profile_cache_key
+
+
+PROFILE_CACHE_TIMEOUT = 300  # 5 minutes
 
 
 class CustomTokenObtainPairView(TokenObtainPairView):
@@ -27,8 +35,10 @@ def register_view(request):
     if serializer.is_valid():
         user = serializer.save()
         
-        # Generate tokens for the new user
+        # Generate tokens for the new user; each is signed exactly once
         refresh = RefreshToken.for_user(user)
+        refresh_token = str(refresh)
+        access_token = str(refresh.access_token)
         
         return Response({
             'message': 'User created successfully',
@@ -40,8 +50,8 @@ def register_view(request):
                 'last_name': user.last_name,
             },
             'tokens': {
-                'refresh': str(refresh),
-                'access': str(refresh.access_token),
+                'refresh': refresh_token,
+                'access': access_token,
             }
         }, status=status.HTTP_201_CREATED)
     
@@ -74,17 +84,29 @@ def profile_view(request):
     user = request.user
     
     if request.method == 'GET':
-        # Get user profile information
-        serializer = UserProfileSerializer(user)
-        return Response(serializer.data)
+        cache_key = profile_cache_key(user.id)
+        data = cache.get(cache_key)
+        
+        if data is None:
+            # Get user profile information with file statistics in a single query
+            user = User.objects.select_related('profile').annotate(
+                _total_files=Count('file_documents', distinct=True),
+                _total_revisions=Count('file_documents__revisions', distinct=True),
+            ).get(pk=user.pk)
+            get_or_create_profile(user)
+            data = UserProfileSerializer(user).data
+            cache.set(cache_key, data, PROFILE_CACHE_TIMEOUT)
+        
+        return Response(data)
     
     elif request.method in ['PUT', 'PATCH']:
         # Update user profile
         partial = request.method == 'PATCH'
-        serializer = UserProfileSerializer(user, data=request.data, partial=partial)
+        serializer = UserProfileWriteSerializer(user, data=request.data, partial=partial)
         
         if serializer.is_valid():
             serializer.save()
+            cache.delete(profile_cache_key(user.id))
             return Response(serializer.data)
         
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -119,7 +141,7 @@ def change_password_view(request):
     
     # Set new password
     user.set_password(new_password)
-    user.save()
+    user.save(update_fields=['password'])
     
     return Response({'message': 'Password changed successfully'}, status=status.HTTP_200_OK)
 
@@ -130,12 +152,15 @@ def user_stats_view(request):
     """
     Get user statistics (file count, storage used, etc.)
     """
-    user = request.user
-    profile = user.profile
+    user = User.objects.select_related('profile').annotate(
+        total_files=Count('file_documents', distinct=True),
+        total_revisions=Count('file_documents__revisions', distinct=True),
+    ).get(pk=request.user.pk)
+    profile = get_or_create_profile(user)
     
     stats = {
-        'total_files': user.file_documents.count(),
-        'total_revisions': sum(doc.get_revision_count() for doc in user.file_documents.all()),
+        'total_files': user.total_files,
+        'total_revisions': user.total_revisions,
         'storage_used': profile.storage_used,
         'storage_limit': profile.storage_limit,
         'storage_usage_percentage': profile.storage_usage_percentage,
@@ -15,6 +15,7 @@ class FileDocumentAdmin(admin.ModelAdmin):
     list_filter = ('created_at', 'updated_at', 'owner')
     search_fields = ('name', 'url', 'owner__username')
     readonly_fields = ('created_at', 'updated_at', 'get_revision_count')
+    list_select_related = ('owner',)
     inlines = [FileRevisionInline]
     
     fieldsets = (
@@ -26,6 +27,11 @@ class FileDocumentAdmin(admin.ModelAdmin):
             'classes': ('collapse',)
         })
     )
+    
+    def get_revision_count(self, obj):
+        return obj.revision_count
+    get_revision_count.short_description = 'Revisions'
+    get_revision_count.admin_order_field = 'revision_count'
 
 
 @admin.register(FileRevision)
@@ -34,6 +40,7 @@ class FileRevisionAdmin(admin.ModelAdmin):
     list_filter = ('uploaded_at', 'content_type', 'document__owner')
     search_fields = ('document__name', 'document__url', 'document__owner__username')
     readonly_fields = ('uploaded_at', 'file_size', 'formatted_file_size', 'file_extension')
+    list_select_related = ('document', 'document__owner')
     
     fieldsets = (
         (None, {
@@ -5,16 +5,20 @@ from rest_framework import status, permissions
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework.views import APIView
+from django.core.cache import cache
 from django.shortcuts import get_object_or_404
-from django.db.models import Count, Sum, Q
+from django.db.models import BigIntegerField, Count, ExpressionWrapper, F, Q, Sum
+from django.db.models.functions import TruncMonth
 from django.utils import timezone
 from datetime import timedelta
 
-from .models import FileDocument, FileRevision
+from .models import FILE_SIZE_UNITS, FileDocument, FileRevision
 from .models_extensions import (
-    FileMetadata, FileAccessLog, get_file_statistics, cleanup_old_revisions
+    FileMetadata, FileAccessLog, get_file_statistics, cleanup_old_revisions,
+    get_analytics_cache_key, access_log_buffer, ANALYTICS_CACHE_TIMEOUT
 )
 from .storage import StorageQuotaManager, FileHashManager
+from .utils import get_client_ip, get_user_agent
 
 
 class FileAnalyticsView(APIView):
@@ -28,23 +32,35 @@ class FileAnalyticsView(APIView):
         user = request.user
         days = int(request.query_params.get('days', 30))
         
-        stats = get_file_statistics(user, days)
+        cache_key = get_analytics_cache_key(user.id, days)
+        data = cache.get(cache_key)
+        if data is None:
+            data = self.get_analytics(user, days)
+            cache.set(cache_key, data, ANALYTICS_CACHE_TIMEOUT)
+        
+        return Response(data)
+    
+    def get_analytics(self, user, days):
+        """Compute analytics for the last ``days`` days"""
+        # One cutoff shared by every query so they all cover the same window
+        since = timezone.now() - timedelta(days=days)
+        stats = get_file_statistics(user, days, since=since)
         
         # Additional analytics
         recent_activity = FileAccessLog.objects.filter(
             user=user,
-            accessed_at__gte=timezone.now() - timedelta(days=days)
+            accessed_at__gte=since
         ).values('access_type').annotate(count=Count('id'))
         
-        # Most accessed files
-        popular_files = FileDocument.objects.filter(
-            owner=user,
-            access_logs__accessed_at__gte=timezone.now() - timedelta(days=days)
-        ).annotate(
-            access_count=Count('access_logs')
-        ).order_by('-access_count')[:10]
+        # Most accessed files, counting only accesses inside the window
+        popular_files = FileDocument.objects.filter(owner=user).annotate(
+            access_count=Count(
+                'access_logs',
+                filter=Q(access_logs__accessed_at__gte=since)
+            )
+        ).filter(access_count__gt=0).only('id', 'name', 'url').order_by('-access_count')[:10]
         
-        return Response({
+        return {
             'statistics': stats,
             'activity': {item['access_type']: item['count'] for item in recent_activity},
             'popular_files': [
@@ -56,7 +72,7 @@ class FileAnalyticsView(APIView):
                 }
                 for f in popular_files
             ]
-        })
+        }
 
 
 @api_view(['GET'])
@@ -72,7 +88,12 @@ def file_metadata_view(request, file_id):
     
     # Get all revisions with metadata
     revisions_data = []
-    for revision in document.revisions.all():
+    revisions = document.revisions.select_related('metadata').only(
+        'id', 'revision_number', 'uploaded_at', 'file_size', 'content_type',
+        'extension', 'document_id', 'metadata__sha256_hash', 'metadata__file_category',
+        'metadata__extra_metadata', 'metadata__is_processed'
+    )
+    for revision in revisions:
         revision_data = {
             'id': revision.id,
             'revision_number': revision.revision_number,
@@ -83,16 +104,16 @@ def file_metadata_view(request, file_id):
             'extension': revision.file_extension,
         }
         
-        # Add metadata if available
-        try:
-            metadata = revision.metadata
+        # Add metadata if available (joined above, so a missing row is cached as None)
+        metadata = getattr(revision, 'metadata', None)
+        if metadata is not None:
             revision_data.update({
-                'sha256_hash': metadata.sha256_hash,
+                'sha256_hash': metadata.sha256_hex,
                 'file_category': metadata.file_category,
                 'extra_metadata': metadata.extra_metadata,
                 'is_processed': metadata.is_processed,
             })
-        except FileMetadata.DoesNotExist:
+        else:
             revision_data['metadata_available'] = False
         
         revisions_data.append(revision_data)
@@ -123,14 +144,15 @@ def cleanup_user_files(request):
         )
     
     try:
-        cleaned_count = cleanup_old_revisions(user, keep_count)
+        cleaned_count, bytes_freed = cleanup_old_revisions(user, keep_count)
         
-        # Get updated storage info
+        # Storage usage was adjusted in place, so this reads no rows
         quota_status = StorageQuotaManager.get_quota_status(user)
         
         return Response({
             'message': f'Cleaned up {cleaned_count} old revisions',
             'cleaned_count': cleaned_count,
+            'bytes_freed': bytes_freed,
             'storage': quota_status
         })
         
@@ -147,57 +169,66 @@ def file_duplicates_view(request):
     """Find duplicate files based on content hash"""
     user = request.user
     
-    # Find files with same hash
-    duplicates = []
-    
-    # Get all metadata with hashes
     metadata_with_hashes = FileMetadata.objects.filter(
-        revision__document__owner=user,
-        sha256_hash__isnull=False,
-        sha256_hash__ne=''
-    ).exclude(sha256_hash='')
+        revision__document__owner=user
+    ).exclude(sha256_hash=b'')
     
-    # Group by hash
-    hash_groups = {}
-    for metadata in metadata_with_hashes:
-        hash_val = metadata.sha256_hash
-        if hash_val not in hash_groups:
-            hash_groups[hash_val] = []
-        hash_groups[hash_val].append(metadata)
+    # Screen on the indexed hash prefix first, so full hashes are only
+    # grouped for files whose prefix collides with another file's
+    candidate_prefixes = metadata_with_hashes.values('sha256_prefix').annotate(
+        file_count=Count('id')
+    ).filter(file_count__gt=1).values('sha256_prefix')
     
-    # Find groups with multiple files
-    for hash_val, metadata_list in hash_groups.items():
-        if len(metadata_list) > 1:
-            files = []
-            for metadata in metadata_list:
-                revision = metadata.revision
-                files.append({
-                    'document_id': revision.document.id,
-                    'document_name': revision.document.name,
-                    'document_url': revision.document.url,
-                    'revision_id': revision.id,
-                    'revision_number': revision.revision_number,
-                    'file_size': revision.file_size,
-                    'uploaded_at': revision.uploaded_at,
-                })
-            
-            duplicates.append({
-                'hash': hash_val,
-                'file_count': len(files),
-                'total_size': sum(f['file_size'] for f in files),
-                'files': files
-            })
+    # Let the database find hashes shared by more than one file, sized
+    # and ranked by total size, with each group's savings computed in SQL
+    duplicate_groups = list(
+        metadata_with_hashes.filter(
+            sha256_prefix__in=candidate_prefixes
+        ).values('sha256_hash').annotate(
+            file_count=Count('id'),
+            total_size=Sum('revision__file_size')
+        ).filter(file_count__gt=1).annotate(
+            savings=ExpressionWrapper(
+                (F('file_count') - 1) * F('total_size') / F('file_count'),
+                output_field=BigIntegerField()
+            )
+        ).order_by('-total_size')
+    )
     
-    # Sort by potential space savings
-    duplicates.sort(key=lambda x: x['total_size'], reverse=True)
+    # Fetch only the duplicated rows, with revisions and documents joined
+    # Digests may come back as memoryview, which cannot be a dict key
+    files_by_hash = {bytes(group['sha256_hash']): [] for group in duplicate_groups}
+    duplicate_metadata = metadata_with_hashes.filter(
+        sha256_hash__in=list(files_by_hash)
+    ).select_related('revision__document').only(
+        'sha256_hash', 'revision__id', 'revision__revision_number',
+        'revision__file_size', 'revision__uploaded_at', 'revision__document__id',
+        'revision__document__name', 'revision__document__url'
+    )
+    for metadata in duplicate_metadata:
+        revision = metadata.revision
+        files_by_hash[bytes(metadata.sha256_hash)].append({
+            'document_id': revision.document.id,
+            'document_name': revision.document.name,
+            'document_url': revision.document.url,
+            'revision_id': revision.id,
+            'revision_number': revision.revision_number,
+            'file_size': revision.file_size,
+            'uploaded_at': revision.uploaded_at,
+        })
     
     return Response({
-        'duplicate_groups': len(duplicates),
-        'duplicates': duplicates,
-        'potential_savings': sum(
-            (group['file_count'] - 1) * (group['total_size'] // group['file_count'])
-            for group in duplicates
-        )
+        'duplicate_groups': len(duplicate_groups),
+        'duplicates': [
+            {
+                'hash': bytes(group['sha256_hash']).hex(),
+                'file_count': group['file_count'],
+                'total_size': group['total_size'],
+                'files': files_by_hash[bytes(group['sha256_hash'])]
+            }
+            for group in duplicate_groups
+        ],
+        'potential_savings': sum(group['savings'] for group in duplicate_groups)
     })
 
 
@@ -215,26 +246,37 @@ def storage_breakdown_view(request):
         total_size=Sum('revision__file_size')
     )
     
-    # Storage by date (last 12 months)
-    monthly_data = []
-    for i in range(12):
-        month_start = timezone.now() - timedelta(days=30 * (i + 1))
-        month_end = timezone.now() - timedelta(days=30 * i)
-        
-        month_stats = FileRevision.objects.filter(
+    # Storage by calendar month (last 12 months), grouped in one query
+    current_month = timezone.localtime().replace(
+        day=1, hour=0, minute=0, second=0, microsecond=0
+    )
+    month_index = current_month.year * 12 + current_month.month - 1
+    months = [
+        divmod(index, 12) for index in range(month_index - 11, month_index + 1)
+    ]
+    start = current_month.replace(year=months[0][0], month=months[0][1] + 1)
+    months = [f'{year:04d}-{month + 1:02d}' for year, month in months]
+    
+    monthly_stats = {
+        item['month'].strftime('%Y-%m'): item
+        for item in FileRevision.objects.filter(
             document__owner=user,
-            uploaded_at__gte=month_start,
-            uploaded_at__lt=month_end
-        ).aggregate(
+            uploaded_at__gte=start
+        ).annotate(
+            month=TruncMonth('uploaded_at')
+        ).values('month').annotate(
             count=Count('id'),
             size=Sum('file_size')
-        )
-        
-        monthly_data.append({
-            'month': month_start.strftime('%Y-%m'),
-            'uploads': month_stats['count'] or 0,
-            'size': month_stats['size'] or 0
-        })
+        ).order_by('month')
+    }
+    monthly_data = [
+        {
+            'month': month_key,
+            'uploads': monthly_stats.get(month_key, {}).get('count') or 0,
+            'size': monthly_stats.get(month_key, {}).get('size') or 0
+        }
+        for month_key in months
+    ]
     
     # Get quota status
     quota_status = StorageQuotaManager.get_quota_status(user)
@@ -250,7 +292,7 @@ def storage_breakdown_view(request):
             }
             for item in category_breakdown
         ],
-        'monthly_uploads': list(reversed(monthly_data))
+        'monthly_uploads': monthly_data
     })
 
 
@@ -265,17 +307,19 @@ def verify_file_integrity(request, file_id):
     except FileDocument.DoesNotExist:
         return Response({'error': 'File not found'}, status=status.HTTP_404_NOT_FOUND)
     
+    # Join the metadata holding the stored hash into the revision lookup
+    revisions = document.revisions.select_related('metadata')
     revision_id = request.data.get('revision_id')
     if revision_id:
         try:
-            revision = document.revisions.get(id=revision_id)
+            revision = revisions.get(id=revision_id)
         except FileRevision.DoesNotExist:
             return Response(
                 {'error': 'Revision not found'}, 
                 status=status.HTTP_404_NOT_FOUND
             )
     else:
-        revision = document.get_latest_revision()
+        revision = revisions.order_by('-revision_number').first()
         if not revision:
             return Response(
                 {'error': 'No revisions found'}, 
@@ -290,20 +334,21 @@ def verify_file_integrity(request, file_id):
                 'error': 'No hash available for verification'
             }, status=status.HTTP_400_BAD_REQUEST)
         
-        # Verify integrity
+        # Verify every stored digest from a single read of the file
+        expected_hashes = {'sha256': metadata.sha256_hex}
+        if metadata.md5_hash:
+            expected_hashes['md5'] = metadata.md5_hex
+        
         file_path = revision.file_data.path
-        is_valid = FileHashManager.verify_integrity(
-            file_path, 
-            metadata.sha256_hash, 
-            'sha256'
-        )
+        is_valid = FileHashManager.verify_hashes(file_path, expected_hashes)
         
         return Response({
             'revision_id': revision.id,
             'revision_number': revision.revision_number,
             'integrity_valid': is_valid,
             'hash_algorithm': 'sha256',
-            'stored_hash': metadata.sha256_hash
+            'stored_hash': metadata.sha256_hex,
+            'verified_algorithms': sorted(expected_hashes),
         })
         
     except FileMetadata.DoesNotExist:
@@ -321,15 +366,9 @@ def format_file_size(size_bytes):
     if size_bytes == 0:
         return "0 bytes"
     
-    size_names = ["bytes", "KB", "MB", "GB", "TB"]
-    size = float(size_bytes)
-    i = 0
-    
-    while size >= 1024.0 and i < len(size_names) - 1:
-        size /= 1024.0
-        i += 1
-    
-    return f"{size:.1f} {size_names[i]}"
+    # 1024 == 2**10, so the unit index is the bit length divided by ten
+    i = min((size_bytes.bit_length() - 1) // 10, len(FILE_SIZE_UNITS) - 1)
+    return f"{size_bytes / (1 << (10 * i)):.1f} {FILE_SIZE_UNITS[i]}"
 
 
 # Log file access for analytics
@@ -337,13 +376,10 @@ def log_file_access(request, document, revision=None, access_type='view'):
     """Log file access for analytics"""
     try:
         # Get IP and User-Agent
-        ip_address = request.META.get('HTTP_X_FORWARDED_FOR', '').split(',')[0]
-        if not ip_address:
-            ip_address = request.META.get('REMOTE_ADDR')
-        
-        user_agent = request.META.get('HTTP_USER_AGENT', '')[:500]  # Limit length
+        ip_address = get_client_ip(request)
+        user_agent = get_user_agent(request)
         
-        FileAccessLog.objects.create(
+        access_log_buffer.add(
             document=document,
             revision=revision,
             user=request.user,
@@ -1,15 +1,20 @@
 """
 Management command for file cleanup and maintenance
 """
+from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
 from django.contrib.auth.models import User
+from django.db.models import Sum
 from django.utils import timezone
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 import os
 
 from apps.files.models import FileDocument, FileRevision
 from apps.files.models_extensions import FileMetadata, cleanup_old_revisions
-from apps.files.storage import StorageQuotaManager
+
+
+METADATA_BATCH_SIZE = 1000
 
 
 class Command(BaseCommand):
@@ -47,6 +52,13 @@ class Command(BaseCommand):
             help='Process metadata for files missing it'
         )
         
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Threads used to hash files when processing metadata'
+        )
+        
         parser.add_argument(
             '--user',
             type=str,
@@ -90,7 +102,7 @@ class Command(BaseCommand):
             self._update_quotas(users, dry_run)
         
         if options.get('process_metadata'):
-            self._process_metadata(users, dry_run)
+            self._process_metadata(users, dry_run, options.get('workers') or 1)
         
         if not any([
             options.get('cleanup_revisions'),
@@ -112,19 +124,19 @@ class Command(BaseCommand):
         
         for user in users:
             if dry_run:
-                # Count what would be cleaned
-                documents = FileDocument.objects.filter(owner=user)
-                user_cleaned = 0
-                for doc in documents:
-                    revision_count = doc.revisions.count()
-                    if revision_count > keep_count:
-                        user_cleaned += revision_count - keep_count
+                # Count what would be cleaned from the stored revision counts
+                documents = FileDocument.objects.filter(
+                    owner=user, revision_count__gt=keep_count
+                ).values_list('revision_count', flat=True)
+                user_cleaned = sum(
+                    max(0, revision_count - keep_count) for revision_count in documents
+                )
                 
                 self.stdout.write(f"  {user.username}: would clean {user_cleaned} revisions")
                 total_cleaned += user_cleaned
             else:
                 # Actually clean up
-                user_cleaned = cleanup_old_revisions(user, keep_count)
+                user_cleaned, _ = cleanup_old_revisions(user, keep_count)
                 if user_cleaned > 0:
                     self.stdout.write(f"  {user.username}: cleaned {user_cleaned} revisions")
                 total_cleaned += user_cleaned
@@ -138,9 +150,6 @@ class Command(BaseCommand):
         """Clean up orphaned files"""
         self.stdout.write("Cleaning up orphaned files...")
         
-        from django.conf import settings
-        import os
-        
         media_root = settings.MEDIA_ROOT
         uploads_dir = os.path.join(media_root, 'uploads')
         
@@ -151,6 +160,11 @@ class Command(BaseCommand):
         orphaned_files = []
         total_size = 0
         
+        # Load every referenced path once rather than querying per file
+        known_files = set(
+            FileRevision.objects.order_by().values_list('file_data', flat=True).iterator(chunk_size=5000)
+        )
+        
         # Walk through all files in uploads directory
         for root, dirs, files in os.walk(uploads_dir):
             for file in files:
@@ -158,7 +172,7 @@ class Command(BaseCommand):
                 relative_path = os.path.relpath(file_path, media_root)
                 
                 # Check if file is referenced in database
-                if not FileRevision.objects.filter(file_data=relative_path).exists():
+                if relative_path not in known_files:
                     file_size = os.path.getsize(file_path)
                     orphaned_files.append((file_path, file_size))
                     total_size += file_size
@@ -188,40 +202,46 @@ class Command(BaseCommand):
         """Update storage quotas"""
         self.stdout.write("Updating storage quotas...")
         
-        for user in users:
-            if hasattr(user, 'profile'):
-                old_usage = user.profile.storage_used
-                
-                if not dry_run:
-                    new_usage = StorageQuotaManager.update_user_quota(user)
-                    if old_usage != new_usage:
-                        self.stdout.write(
-                            f"  {user.username}: {old_usage} -> {new_usage} bytes"
-                        )
-                else:
-                    # Calculate what new usage would be
-                    total_usage = sum(
-                        revision.file_size 
-                        for doc in user.file_documents.all() 
-                        for revision in doc.revisions.all()
-                    )
-                    if old_usage != total_usage:
-                        self.stdout.write(
-                            f"  {user.username}: would update {old_usage} -> {total_usage} bytes"
-                        )
+        # Sum every user's revisions in a single query, profile joined
+        users_with_usage = User.objects.filter(pk__in=users).select_related(
+            'profile'
+        ).annotate(
+            total_usage=Sum('file_documents__revisions__file_size')
+        ).order_by('username')
+        
+        for user in users_with_usage:
+            if not hasattr(user, 'profile'):
+                continue
+            
+            old_usage = user.profile.storage_used
+            new_usage = user.total_usage or 0
+            if old_usage == new_usage:
+                continue
+            
+            if not dry_run:
+                user.profile.storage_used = new_usage
+                user.profile.save(update_fields=['storage_used'])
+                self.stdout.write(
+                    f"  {user.username}: {old_usage} -> {new_usage} bytes"
+                )
+            else:
+                self.stdout.write(
+                    f"  {user.username}: would update {old_usage} -> {new_usage} bytes"
+                )
         
         action = "Would update" if dry_run else "Updated"
         self.stdout.write(self.style.SUCCESS(f"{action} storage quotas"))
 
-    def _process_metadata(self, users, dry_run):
+    def _process_metadata(self, users, dry_run, workers=1):
         """Process missing metadata"""
         self.stdout.write("Processing missing metadata...")
         
         # Find revisions without metadata
+        # Only the path is needed to hash each file; skip the default sort
         revisions_without_metadata = FileRevision.objects.filter(
             metadata__isnull=True,
             document__owner__in=users
-        )
+        ).order_by().only('id', 'file_data')
         
         count = revisions_without_metadata.count()
         
@@ -233,20 +253,46 @@ class Command(BaseCommand):
         
         if not dry_run:
             processed = 0
-            for revision in revisions_without_metadata:
-                try:
-                    # This will auto-create metadata via signal
-                    FileMetadata.objects.create(revision=revision)
-                    processed += 1
-                except Exception as e:
-                    self.stdout.write(
-                        self.style.ERROR(
-                            f"Error processing metadata for revision {revision.id}: {e}"
-                        )
-                    )
+            batch = []
+            # Hashing releases the GIL, so each batch of files is read and
+            # hashed on a pool of threads; only the inserts stay serial
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                # Stream revisions and insert their metadata in batches
+                for revision in revisions_without_metadata.iterator(chunk_size=METADATA_BATCH_SIZE):
+                    batch.append(FileMetadata(revision=revision))
+                    
+                    if len(batch) >= METADATA_BATCH_SIZE:
+                        processed += self._process_batch(executor, batch)
+                        batch = []
+                
+                if batch:
+                    processed += self._process_batch(executor, batch)
             
             self.stdout.write(
                 self.style.SUCCESS(f"Processed metadata for {processed} revisions")
             )
         else:
-            self.stdout.write(f"Would process metadata for {count} revisions")
\ No newline at end of file
+            self.stdout.write(f"Would process metadata for {count} revisions")
+
+    def _process_batch(self, executor, batch):
+        """Extract metadata for a batch in parallel, then insert it"""
+        # process() only reads the file, so the workers never touch the database
+        list(executor.map(FileMetadata.process, batch))
+        
+        for metadata in batch:
+            if metadata.processing_error:
+                self.stdout.write(
+                    self.style.ERROR(
+                        f"Error processing metadata for revision {metadata.revision.id}: "
+                        f"{metadata.processing_error}"
+                    )
+                )
+        
+        return self._create_metadata(batch)
+
+    def _create_metadata(self, batch):
+        """Insert a batch of metadata, skipping revisions processed meanwhile"""
+        FileMetadata.objects.bulk_create(
+            batch, ignore_conflicts=True, batch_size=METADATA_BATCH_SIZE
+        )
+        return len(batch)
@@ -8,12 +8,151 @@ from django.core.cache import cache
 from django.conf import settings
 import logging
 import json
+import queue
+import re
+import threading
+import time
 from datetime import timedelta
 
-from .models_extensions import FileAccessLog
+from .utils import get_client_ip, get_user_agent, increment_cache_counter
 
 logger = logging.getLogger(__name__)
 
+RATE_LIMIT_WINDOW = 3600  # 1 hour
+
+FILE_PATH_PREFIXES = ('/api/files/', '/media/')
+
+# User agents of scripted clients, matched in a single case-insensitive scan
+SUSPICIOUS_USER_AGENT_RE = re.compile(
+    '|'.join(re.escape(agent) for agent in (
+        'wget', 'curl', 'bot', 'crawler', 'spider', 'scraper',
+        'python-requests', 'java/', 'go-http-client'
+    )),
+    re.IGNORECASE
+)
+
+
+# Prevent caching of downloads and stop browsers sniffing or framing them
+DOWNLOAD_SECURITY_HEADERS = (
+    ('Cache-Control', 'no-cache, no-store, must-revalidate'),
+    ('Pragma', 'no-cache'),
+    ('Expires', '0'),
+    ('X-Content-Type-Options', 'nosniff'),
+    ('X-Frame-Options', 'DENY'),
+)
+
+# Headers for every successful file response
+FILE_SECURITY_HEADERS = DOWNLOAD_SECURITY_HEADERS + (
+    ('Content-Security-Policy', "default-src 'none'"),
+    ('X-XSS-Protection', '1; mode=block'),
+    ('Referrer-Policy', 'strict-origin-when-cross-origin'),
+)
+
+
+# Field order of the tuples queued for each kind of audit record
+AUDIT_RECORD_TYPES = {
+    'access': ('File access', (
+        'ip', 'user_agent', 'method', 'path', 'status_code',
+        'user_id', 'timestamp', 'suspicious',
+    )),
+    'audit': ('File audit', (
+        'user_id', 'username', 'action', 'file_info', 'ip_address',
+        'user_agent', 'timestamp', 'status_code',
+    )),
+}
+
+
+def get_user_context(request):
+    """
+    Get (is_authenticated, user_id, username) for the request's user
+    
+    Resolved once per user object: DRF authenticates inside the view and
+    replaces request.user, so a changed user is resolved again.
+    """
+    user = request.user
+    context = getattr(request, '_user_context', None)
+    if context is None or context[0] is not user:
+        is_authenticated = user.is_authenticated
+        context = (
+            user,
+            is_authenticated,
+            user.id if is_authenticated else None,
+            user.username if is_authenticated else '',
+        )
+        request._user_context = context
+    return context[1:]
+
+
+class AuditLogQueue:
+    """
+    Hand audit records to a background thread that logs them in batches
+    
+    Request threads only enqueue a tuple; building the JSON and calling
+    the logger happen on the worker thread, once per batch.
+    """
+    
+    def __init__(self, batch_size=100):
+        self.batch_size = batch_size
+        self._queue = queue.SimpleQueue()
+        self._worker = None
+        self._lock = threading.Lock()
+    
+    def put(self, kind, values):
+        """Queue a record of the given kind without blocking"""
+        # Nothing would be emitted, so skip queueing and formatting entirely
+        if not logger.isEnabledFor(logging.INFO):
+            return
+        self._ensure_worker()
+        self._queue.put_nowait((kind, values))
+    
+    def flush(self):
+        """Log everything queued so far on the calling thread"""
+        while True:
+            batch = self._next_batch(block=False)
+            if not batch:
+                return
+            self._log_batch(batch)
+    
+    def _ensure_worker(self):
+        if self._worker is not None:
+            return
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(
+                    target=self._run, name='file-audit-log', daemon=True
+                )
+                self._worker.start()
+    
+    def _run(self):
+        while True:
+            self._log_batch(self._next_batch(block=True))
+    
+    def _next_batch(self, block):
+        batch = []
+        if block:
+            batch.append(self._queue.get())
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+    
+    def _log_batch(self, batch):
+        try:
+            lines = []
+            for kind, values in batch:
+                label, fields = AUDIT_RECORD_TYPES[kind]
+                record = dict(zip(fields, values))
+                record['timestamp'] = record['timestamp'].isoformat()
+                lines.append(f"{label}: {json.dumps(record)}")
+            logger.info("\n".join(lines))
+        except Exception as e:
+            logger.error(f"Failed to write audit log batch: {str(e)}")
+
+
+audit_log_queue = AuditLogQueue()
+
 
 class FileSecurityMiddleware(MiddlewareMixin):
     """
@@ -28,8 +167,8 @@ class FileSecurityMiddleware(MiddlewareMixin):
         
         # Add security context
         request.file_security = {
-            'ip_address': self._get_client_ip(request),
-            'user_agent': request.META.get('HTTP_USER_AGENT', ''),
+            'ip_address': get_client_ip(request),
+            'user_agent': get_user_agent(request),
             'timestamp': timezone.now(),
             'is_suspicious': False,
         }
@@ -67,90 +206,56 @@ class FileSecurityMiddleware(MiddlewareMixin):
     
     def _is_file_request(self, request):
         """Check if this is a file-related request"""
-        path = request.path
-        return (
-            path.startswith('/api/files/') or
-            path.startswith('/media/') or
-            'download' in request.GET
-        )
-    
-    def _get_client_ip(self, request):
-        """Get client IP address"""
-        x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
-        if x_forwarded_for:
-            return x_forwarded_for.split(',')[0].strip()
-        return request.META.get('REMOTE_ADDR', 'unknown')
+        # Computed once per request and reused by process_response
+        is_file_request = getattr(request, '_is_file_request', None)
+        if is_file_request is None:
+            is_file_request = (
+                request.path.startswith(FILE_PATH_PREFIXES) or
+                'download' in request.GET
+            )
+            request._is_file_request = is_file_request
+        return is_file_request
     
     def _is_suspicious_request(self, request):
         """Detect suspicious file access patterns"""
-        ip = self._get_client_ip(request)
-        user_agent = request.META.get('HTTP_USER_AGENT', '').lower()
+        ip = get_client_ip(request)
         
         # Check for suspicious user agents
-        suspicious_agents = [
-            'wget', 'curl', 'bot', 'crawler', 'spider', 'scraper',
-            'python-requests', 'java/', 'go-http-client'
-        ]
-        
-        for agent in suspicious_agents:
-            if agent in user_agent:
-                return True
-        
-        # Check for rapid sequential requests from same IP
-        cache_key = f"file_requests_{ip}"
-        recent_requests = cache.get(cache_key, 0)
-        
-        if recent_requests > 50:  # More than 50 requests in the cache period
+        if SUSPICIOUS_USER_AGENT_RE.search(request.META.get('HTTP_USER_AGENT', '')):
             return True
         
-        # Increment counter
-        cache.set(cache_key, recent_requests + 1, timeout=300)  # 5-minute window
+        # Check for rapid sequential requests from same IP
+        recent_requests = increment_cache_counter(f"file_requests_{ip}", timeout=300)  # 5-minute window
         
-        return False
+        return recent_requests > 50  # More than 50 requests in the cache period
     
     def _is_rate_limited(self, request):
         """Check if IP is rate limited"""
-        ip = self._get_client_ip(request)
+        ip = get_client_ip(request)
         
         # Different limits for authenticated vs anonymous users
-        if request.user.is_authenticated:
+        is_authenticated, _, _ = get_user_context(request)
+        if is_authenticated:
             limit = getattr(settings, 'AUTHENTICATED_FILE_RATE_LIMIT', 1000)
         else:
             limit = getattr(settings, 'ANONYMOUS_FILE_RATE_LIMIT', 100)
         
-        # Check requests in last hour
-        cache_key = f"file_rate_limit_{ip}"
-        requests_count = cache.get(cache_key, 0)
-        
-        if requests_count >= limit:
-            return True
-        
-        # Increment counter
-        cache.set(cache_key, requests_count + 1, timeout=3600)  # 1-hour window
+        # Sliding one-hour window: weight the previous fixed window by how much
+        # of it still overlaps the last hour, so bursts at a window edge can't
+        # reach twice the limit
+        now = time.time()
+        window, offset = divmod(now, RATE_LIMIT_WINDOW)
+        current_count = increment_cache_counter(
+            f"file_rate_limit_{ip}_{int(window)}", timeout=2 * RATE_LIMIT_WINDOW
+        )
+        previous_count = cache.get(f"file_rate_limit_{ip}_{int(window) - 1}", 0)
         
-        return False
+        return current_count + previous_count * (1 - offset / RATE_LIMIT_WINDOW) > limit
     
     def _add_security_headers(self, request, response):
         """Add security headers to file responses"""
-        # Prevent caching of sensitive files
-        response['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-        response['Pragma'] = 'no-cache'
-        response['Expires'] = '0'
-        
-        # Content security policy
-        response['Content-Security-Policy'] = "default-src 'none'"
-        
-        # Prevent MIME type sniffing
-        response['X-Content-Type-Options'] = 'nosniff'
-        
-        # Frame options
-        response['X-Frame-Options'] = 'DENY'
-        
-        # XSS protection
-        response['X-XSS-Protection'] = '1; mode=block'
-        
-        # Referrer policy
-        response['Referrer-Policy'] = 'strict-origin-when-cross-origin'
+        for header, value in FILE_SECURITY_HEADERS:
+            response.headers[header] = value
     
     def _log_file_response(self, request, response):
         """Log file response for audit"""
@@ -158,18 +263,16 @@ class FileSecurityMiddleware(MiddlewareMixin):
             return
         
         try:
-            log_data = {
-                'ip': request.file_security.get('ip_address'),
-                'user_agent': request.file_security.get('user_agent'),
-                'method': request.method,
-                'path': request.path,
-                'status_code': response.status_code,
-                'user_id': request.user.id if request.user.is_authenticated else None,
-                'timestamp': request.file_security.get('timestamp').isoformat(),
-                'suspicious': request.file_security.get('is_suspicious'),
-            }
-            
-            logger.info(f"File access: {json.dumps(log_data)}")
+            audit_log_queue.put('access', (
+                request.file_security.get('ip_address'),
+                request.file_security.get('user_agent'),
+                request.method,
+                request.path,
+                response.status_code,
+                get_user_context(request)[1],
+                request.file_security.get('timestamp'),
+                request.file_security.get('is_suspicious'),
+            ))
             
         except Exception as e:
             logger.error(f"Failed to log file response: {str(e)}")
@@ -194,19 +297,14 @@ class FileAccessAuditMiddleware(MiddlewareMixin):
     
     def _should_audit(self, request, response):
         """Determine if this request should be audited"""
-        # Only audit successful file operations
-        if response.status_code not in [200, 201]:
-            return False
-        
-        # Only audit file-related requests
-        if not request.path.startswith('/api/files/'):
-            return False
-        
-        return True
+        # Only audit successful file operations; ScopedFileAccessAuditMiddleware
+        # already limits this middleware to file API paths
+        return response.status_code in (200, 201)
     
     def _create_audit_log(self, request, response):
         """Create detailed audit log entry"""
-        if not request.user.is_authenticated:
+        is_authenticated, user_id, username = get_user_context(request)
+        if not is_authenticated:
             return
         
         # Extract file information from request
@@ -214,20 +312,17 @@ class FileAccessAuditMiddleware(MiddlewareMixin):
         if not file_info:
             return
         
-        # Create audit log (this could be stored in a separate audit table)
-        audit_data = {
-            'user_id': request.user.id,
-            'username': request.user.username,
-            'action': self._determine_action(request),
-            'file_info': file_info,
-            'ip_address': self._get_client_ip(request),
-            'user_agent': request.META.get('HTTP_USER_AGENT', ''),
-            'timestamp': timezone.now().isoformat(),
-            'status_code': response.status_code,
-        }
-        
-        # Log to file or external service
-        logger.info(f"File audit: {json.dumps(audit_data)}")
+        # Queue the audit record; the worker thread formats and logs it
+        audit_log_queue.put('audit', (
+            user_id,
+            username,
+            self._determine_action(request),
+            file_info,
+            get_client_ip(request),
+            request.META.get('HTTP_USER_AGENT', ''),
+            timezone.now(),
+            response.status_code,
+        ))
     
     def _extract_file_info(self, request):
         """Extract file information from request"""
@@ -252,7 +347,7 @@ class FileAccessAuditMiddleware(MiddlewareMixin):
         """Determine the action being performed"""
         method = request.method.upper()
         
-        if 'download=true' in request.GET.urlencode():
+        if request.GET.get('download') == 'true':
             return 'DOWNLOAD'
         elif method == 'GET':
             return 'VIEW'
@@ -264,13 +359,34 @@ class FileAccessAuditMiddleware(MiddlewareMixin):
             return 'DELETE'
         
         return method
+
+
+class PathScopedMiddleware:
+    """
+    Run a wrapped middleware only for requests under the given path prefixes
+    
+    Other requests go straight to the next handler, so the wrapped
+    middleware's hooks are never entered for them.
+    """
+    middleware_class = None
+    path_prefixes = ()
+    
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.middleware = self.middleware_class(get_response)
     
-    def _get_client_ip(self, request):
-        """Get client IP address"""
-        x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
-        if x_forwarded_for:
-            return x_forwarded_for.split(',')[0].strip()
-        return request.META.get('REMOTE_ADDR', 'unknown')
+    def __call__(self, request):
+        if request.path.startswith(self.path_prefixes):
+            return self.middleware(request)
+        return self.get_response(request)
+
+
+class ScopedFileAccessAuditMiddleware(PathScopedMiddleware):
+    """
+    FileAccessAuditMiddleware limited to the file API
+    """
+    middleware_class = FileAccessAuditMiddleware
+    path_prefixes = ('/api/files/',)
 
 
 class FileDownloadSecurityMiddleware(MiddlewareMixin):
@@ -295,7 +411,7 @@ class FileDownloadSecurityMiddleware(MiddlewareMixin):
         """Check if this is a file download"""
         return (
             response.status_code == 200 and
-            ('download=true' in request.GET.urlencode() or
+            (request.GET.get('download') == 'true' or
              'attachment' in response.get('Content-Disposition', ''))
         )
     
@@ -305,30 +421,22 @@ class FileDownloadSecurityMiddleware(MiddlewareMixin):
         if 'Content-Disposition' not in response:
             response['Content-Disposition'] = 'attachment'
         
-        # Prevent caching
-        response['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-        response['Pragma'] = 'no-cache'
-        response['Expires'] = '0'
-        
-        # Security headers
-        response['X-Content-Type-Options'] = 'nosniff'
-        response['X-Frame-Options'] = 'DENY'
+        for header, value in DOWNLOAD_SECURITY_HEADERS:
+            response.headers[header] = value
     
     def _log_download(self, request, response):
         """Log file download"""
-        if request.user.is_authenticated:
+        if not logger.isEnabledFor(logging.INFO):
+            return
+        
+        is_authenticated, _, username = get_user_context(request)
+        if is_authenticated:
             try:
                 logger.info(
-                    f"File download by {request.user.username} "
-                    f"from {self._get_client_ip(request)} "
-                    f"- Size: {response.get('Content-Length', 'unknown')} bytes"
+                    "File download by %s from %s - Size: %s bytes",
+                    username,
+                    get_client_ip(request),
+                    response.get('Content-Length', 'unknown')
                 )
             except Exception:
-                pass
-    
-    def _get_client_ip(self, request):
-        """Get client IP address"""
-        x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
-        if x_forwarded_for:
-            return x_forwarded_for.split(',')[0].strip()
-        return request.META.get('REMOTE_ADDR', 'unknown')
\ No newline at end of file
+                pass
\ No newline at end of file
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-16 01:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0004_fileaccesslog_accessed_at_default'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='filerevision',
+            index=models.Index(fields=['document', 'uploaded_at'], name='files_filer_documen_0bb6fd_idx'),
+        ),
+    ]
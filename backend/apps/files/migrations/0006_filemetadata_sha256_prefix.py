@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-16 01:38
+
+import django.db.models.functions.text
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0005_filerevision_document_uploaded_at_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='filemetadata',
+            name='sha256_prefix',
+            field=models.GeneratedField(db_persist=True, expression=django.db.models.functions.text.Substr('sha256_hash', 1, 16), output_field=models.CharField(max_length=16)),
+        ),
+        migrations.AddIndex(
+            model_name='filemetadata',
+            index=models.Index(fields=['sha256_prefix'], name='files_filem_sha256__24c197_idx'),
+        ),
+    ]
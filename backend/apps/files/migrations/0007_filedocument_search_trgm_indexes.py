@@ -0,0 +1,42 @@
+# Generated by Django 5.2.6 on 2026-10-16 09:40
+
+from django.db import migrations
+
+
+# Admin search uses icontains, which PostgreSQL renders as
+# UPPER("column"::text) LIKE UPPER(%term%), so the trigram indexes are built
+# on that expression. Other databases have no trigram support and keep
+# scanning, so the operations only run on PostgreSQL.
+TRIGRAM_INDEXES = {
+    'fd_name_trgm': 'name',
+    'fd_url_trgm': 'url',
+}
+
+
+def create_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm;')
+    for index_name, column in TRIGRAM_INDEXES.items():
+        schema_editor.execute(
+            f'CREATE INDEX IF NOT EXISTS {index_name} ON files_filedocument '
+            f'USING gin ((UPPER({column}::text)) gin_trgm_ops);'
+        )
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for index_name in TRIGRAM_INDEXES:
+        schema_editor.execute(f'DROP INDEX IF EXISTS {index_name};')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0006_filemetadata_sha256_prefix'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-16 02:04
+
+import os
+
+from django.db import migrations, models
+
+
+def populate_extensions(apps, schema_editor):
+    FileRevision = apps.get_model('files', 'FileRevision')
+    revisions = list(FileRevision.objects.only('id', 'file_data'))
+    for revision in revisions:
+        revision.extension = os.path.splitext(revision.file_data.name)[1].lower()[:16]
+    FileRevision.objects.bulk_update(revisions, ['extension'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0007_filedocument_search_trgm_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='filerevision',
+            name='extension',
+            field=models.CharField(blank=True, db_index=True, help_text='Lowercased file extension, set on save', max_length=16),
+        ),
+        migrations.RunPython(populate_extensions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-16 02:09
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def populate_revision_counters(apps, schema_editor):
+    FileDocument = apps.get_model('files', 'FileDocument')
+    documents = list(FileDocument.objects.annotate(
+        counted=Count('revisions'),
+        latest=Max('revisions__revision_number'),
+    ).only('id'))
+    for document in documents:
+        document.revision_count = document.counted
+        document.last_revision_number = document.latest or 0
+    FileDocument.objects.bulk_update(
+        documents, ['revision_count', 'last_revision_number'], batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0008_filerevision_extension'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='filedocument',
+            name='last_revision_number',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='filedocument',
+            name='revision_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(populate_revision_counters, migrations.RunPython.noop),
+    ]
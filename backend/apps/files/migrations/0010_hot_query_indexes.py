@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-16 02:13
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0009_filedocument_revision_counters'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='filedocument',
+            index=models.Index(fields=['owner', '-updated_at'], name='files_filed_owner_i_2f8cad_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='filemetadata',
+            index=models.Index(fields=['revision', 'file_category'], name='files_filem_revisio_eaa5c4_idx'),
+        ),
+    ]
@@ -0,0 +1,74 @@
+# Generated by Django 5.2.18 on 2026-10-16 02:18
+
+import django.db.models.functions.text
+from django.db import migrations, models
+
+
+# Altering the column type carries the hex text over as its ASCII bytes
+# (SQLite keeps the value, PostgreSQL casts varchar to bytea), so the data
+# steps only have to translate between hex and raw digests.
+HASH_FIELDS = ('sha256_hash', 'md5_hash')
+
+
+def _as_text(value):
+    if isinstance(value, str):
+        return value
+    return bytes(value).decode('ascii')
+
+
+def hex_to_digest(apps, schema_editor):
+    FileMetadata = apps.get_model('files', 'FileMetadata')
+    rows = list(FileMetadata.objects.only('id', *HASH_FIELDS))
+    for row in rows:
+        for field in HASH_FIELDS:
+            setattr(row, field, bytes.fromhex(_as_text(getattr(row, field) or b'')))
+    FileMetadata.objects.bulk_update(rows, HASH_FIELDS, batch_size=1000)
+
+
+def digest_to_hex(apps, schema_editor):
+    FileMetadata = apps.get_model('files', 'FileMetadata')
+    rows = list(FileMetadata.objects.only('id', *HASH_FIELDS))
+    for row in rows:
+        for field in HASH_FIELDS:
+            setattr(row, field, bytes(getattr(row, field) or b'').hex().encode('ascii'))
+    FileMetadata.objects.bulk_update(rows, HASH_FIELDS, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0010_hot_query_indexes'),
+    ]
+
+    operations = [
+        # The generated prefix depends on sha256_hash, so drop it while the
+        # column type changes and rebuild it over the raw digest afterwards
+        migrations.RemoveIndex(
+            model_name='filemetadata',
+            name='files_filem_sha256__24c197_idx',
+        ),
+        migrations.RemoveField(
+            model_name='filemetadata',
+            name='sha256_prefix',
+        ),
+        migrations.AlterField(
+            model_name='filemetadata',
+            name='md5_hash',
+            field=models.BinaryField(blank=True, default=b'', max_length=16),
+        ),
+        migrations.AlterField(
+            model_name='filemetadata',
+            name='sha256_hash',
+            field=models.BinaryField(blank=True, default=b'', max_length=32),
+        ),
+        migrations.RunPython(hex_to_digest, digest_to_hex),
+        migrations.AddField(
+            model_name='filemetadata',
+            name='sha256_prefix',
+            field=models.GeneratedField(db_persist=True, expression=django.db.models.functions.text.Substr('sha256_hash', 1, 8), output_field=models.BinaryField(max_length=8)),
+        ),
+        migrations.AddIndex(
+            model_name='filemetadata',
+            index=models.Index(fields=['sha256_prefix'], name='files_filem_sha256__24c197_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-16 02:36
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0011_filemetadata_binary_hashes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='filedocument',
+            unique_together=set(),
+        ),
+        migrations.AddConstraint(
+            model_name='filedocument',
+            constraint=models.UniqueConstraint(fields=('owner', 'url'), name='uniq_owner_url'),
+        ),
+    ]
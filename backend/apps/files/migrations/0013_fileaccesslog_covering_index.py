@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-16 02:53
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0012_filedocument_uniq_owner_url'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        # Build the wider index before dropping the one it replaces
+        migrations.AddIndex(
+            model_name='fileaccesslog',
+            index=models.Index(fields=['user', '-accessed_at', 'access_type'], name='fal_user_time_idx'),
+        ),
+        migrations.RemoveIndex(
+            model_name='fileaccesslog',
+            name='files_filea_user_id_66bbc8_idx',
+        ),
+    ]
@@ -1,8 +1,13 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest, Now
 from django.contrib.auth.models import User
 import os
 
 
+FILE_SIZE_UNITS = ("bytes", "KB", "MB", "GB", "TB")
+
+
 def user_file_path(instance, filename):
     """Generate file path for user uploads"""
     # Remove any path traversal attempts
@@ -31,22 +36,36 @@ class FileDocument(models.Model):
     )
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Maintained by FileRevision.save() and the revision delete signal
+    revision_count = models.PositiveIntegerField(default=0)
+    last_revision_number = models.PositiveIntegerField(default=0)
     
     class Meta:
         # Ensure each user can only have one document per URL path
-        unique_together = ['owner', 'url']
+        constraints = [
+            models.UniqueConstraint(fields=['owner', 'url'], name='uniq_owner_url'),
+        ]
         ordering = ['-updated_at']
+        indexes = [
+            # Per-user listings and the "recent" manager sort by updated_at
+            models.Index(fields=['owner', '-updated_at']),
+        ]
     
     def __str__(self):
         return f"{self.name} ({self.url}) - {self.owner.username}"
     
     def get_latest_revision(self):
         """Get the most recent revision of this document"""
+        # Listings prefetch it with prefetch_latest_revision()
+        if hasattr(self, 'latest_revisions'):
+            return self.latest_revisions[0] if self.latest_revisions else None
+        if not self.revision_count:
+            return None
         return self.revisions.order_by('-revision_number').first()
     
     def get_revision_count(self):
         """Get total number of revisions for this document"""
-        return self.revisions.count()
+        return self.revision_count
 
 
 class FileRevision(models.Model):
@@ -73,11 +92,21 @@ class FileRevision(models.Model):
         blank=True,
         help_text="MIME type of the file"
     )
+    extension = models.CharField(
+        max_length=16,
+        blank=True,
+        db_index=True,
+        help_text="Lowercased file extension, set on save"
+    )
     
     class Meta:
         # Ensure unique revision numbers per document
         unique_together = ['document', 'revision_number']
         ordering = ['-revision_number']
+        indexes = [
+            # Date-ranged analytics filter a user's documents by upload time
+            models.Index(fields=['document', 'uploaded_at']),
+        ]
     
     def __str__(self):
         return f"{self.document.name} - Revision {self.revision_number}"
@@ -87,22 +116,41 @@ class FileRevision(models.Model):
         if self.file_data and not self.file_size:
             self.file_size = self.file_data.size
         
-        # Auto-increment revision number if not set
-        if not self.revision_number:
-            last_revision = FileRevision.objects.filter(
-                document=self.document
-            ).order_by('-revision_number').first()
+        # Store the extension once instead of parsing the name on every read
+        if self.file_data and not self.extension:
+            self.extension = os.path.splitext(self.file_data.name)[1].lower()[:16]
+        
+        adding = self._state.adding
+        with transaction.atomic():
+            # Auto-increment revision number if not set, holding the document
+            # row lock so concurrent uploads cannot pick the same number
+            if not self.revision_number:
+                counters = FileDocument.objects.select_for_update().values(
+                    'revision_count', 'last_revision_number'
+                ).get(pk=self.document_id)
+                self.revision_number = (
+                    counters['last_revision_number'] + 1 if counters['revision_count'] else 0
+                )
+            
+            super().save(*args, **kwargs)
             
-            self.revision_number = (last_revision.revision_number + 1) if last_revision else 0
+            if adding:
+                # Bump the document's counters in one UPDATE without reading it back
+                FileDocument.objects.filter(pk=self.document_id).update(
+                    revision_count=F('revision_count') + 1,
+                    last_revision_number=Greatest(F('last_revision_number'), self.revision_number),
+                    updated_at=Now()
+                )
         
-        super().save(*args, **kwargs)
+        if adding:
+            document = self.document
+            document.revision_count += 1
+            document.last_revision_number = max(document.last_revision_number, self.revision_number)
     
     @property
     def file_extension(self):
         """Get file extension"""
-        if self.file_data:
-            return os.path.splitext(self.file_data.name)[1].lower()
-        return ''
+        return self.extension
     
     @property
     def formatted_file_size(self):
@@ -110,9 +158,21 @@ class FileRevision(models.Model):
         if not self.file_size:
             return "0 bytes"
         
-        size = float(self.file_size)  # Use a copy, don't modify the original
-        for unit in ['bytes', 'KB', 'MB', 'GB']:
-            if size < 1024.0:
-                return f"{size:.1f} {unit}"
-            size /= 1024.0
-        return f"{size:.1f} TB"
+        # 1024 == 2**10, so the unit index is the bit length divided by ten
+        i = min((self.file_size.bit_length() - 1) // 10, len(FILE_SIZE_UNITS) - 1)
+        return f"{self.file_size / (1 << (10 * i)):.1f} {FILE_SIZE_UNITS[i]}"
+
+
+def prefetch_latest_revision():
+    """
+    Prefetch only each document's newest revision into ``latest_revisions``
+    """
+    latest_number = FileRevision.objects.filter(
+        document=models.OuterRef('document')
+    ).order_by('-revision_number').values('revision_number')[:1]
+    return models.Prefetch(
+        'revisions',
+        queryset=FileRevision.objects.filter(revision_number=models.Subquery(latest_number)),
+        to_attr='latest_revisions'
+    )
+
@@ -1,18 +1,33 @@
 """
 Extensions and enhancements for file models
 """
-from django.db import models
+from django.db import DatabaseError, connection, models, transaction
+from django.db.models import Count, Q
+from django.db.models.functions import Substr
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
+from django.core.cache import cache
 from django.utils import timezone
+from datetime import timedelta
+import atexit
 import json
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from .storage import secure_file_storage, FileMetadataExtractor, StorageQuotaManager
+from apps.authentication.models import profile_cache_key
+
+from .storage import (
+    secure_file_storage, FileMetadataExtractor, RevisionManager, StorageQuotaManager
+)
 from .models import FileDocument, FileRevision
 
 logger = logging.getLogger(__name__)
 
+ANALYTICS_CACHE_TIMEOUT = 300  # 5 minutes
+
 
 class FileMetadata(models.Model):
     """
@@ -24,9 +39,16 @@ class FileMetadata(models.Model):
         related_name='metadata'
     )
     
-    # File hashes for integrity checking
-    sha256_hash = models.CharField(max_length=64, blank=True)
-    md5_hash = models.CharField(max_length=32, blank=True)
+    # Raw file digests for integrity checking, half the size of hex strings
+    sha256_hash = models.BinaryField(max_length=32, blank=True, default=b'')
+    md5_hash = models.BinaryField(max_length=16, blank=True, default=b'')
+    
+    # First 8 bytes of the SHA-256 digest, indexed for cheap duplicate screening
+    sha256_prefix = models.GeneratedField(
+        expression=Substr('sha256_hash', 1, 8),
+        output_field=models.BinaryField(max_length=8),
+        db_persist=True
+    )
     
     # File classification
     file_category = models.CharField(
@@ -57,12 +79,32 @@ class FileMetadata(models.Model):
     class Meta:
         verbose_name = "File Metadata"
         verbose_name_plural = "File Metadata"
+        indexes = [
+            models.Index(fields=['sha256_prefix']),
+            # Lets category lookups per revision be answered from the index
+            models.Index(fields=['revision', 'file_category']),
+        ]
     
     def __str__(self):
         return f"Metadata for {self.revision}"
     
+    @property
+    def sha256_hex(self):
+        """SHA-256 digest as a hex string"""
+        return bytes(self.sha256_hash).hex()
+    
+    @property
+    def md5_hex(self):
+        """MD5 digest as a hex string"""
+        return bytes(self.md5_hash).hex()
+    
     def save(self, *args, **kwargs):
         # Auto-process metadata if not done
+        self.process()
+        super().save(*args, **kwargs)
+    
+    def process(self):
+        """Extract metadata in memory, recording any error instead of raising"""
         if not self.is_processed and self.revision.file_data:
             try:
                 self._extract_metadata()
@@ -70,8 +112,6 @@ class FileMetadata(models.Model):
             except Exception as e:
                 self.processing_error = str(e)
                 logger.error(f"Error processing metadata for revision {self.revision.id}: {str(e)}")
-        
-        super().save(*args, **kwargs)
     
     def _extract_metadata(self):
         """Extract metadata from file"""
@@ -84,7 +124,8 @@ class FileMetadata(models.Model):
             file_obj.close()
             
             # Update fields
-            self.sha256_hash = metadata.get('sha256_hash', '')
+            self.sha256_hash = bytes.fromhex(metadata.get('sha256_hash') or '')
+            self.md5_hash = bytes.fromhex(metadata.get('md5_hash') or '')
             self.file_category = metadata.get('file_category', 'other')
             self.extra_metadata = {
                 'original_filename': metadata.get('filename', ''),
@@ -126,19 +167,169 @@ class FileAccessLog(models.Model):
     ip_address = models.GenericIPAddressField(null=True, blank=True)
     user_agent = models.TextField(blank=True)
     
-    accessed_at = models.DateTimeField(auto_now_add=True)
+    # Set explicitly so buffered rows keep the time of access, not of insert
+    accessed_at = models.DateTimeField(default=timezone.now)
     
     class Meta:
         ordering = ['-accessed_at']
         indexes = [
             models.Index(fields=['document', '-accessed_at']),
-            models.Index(fields=['user', '-accessed_at']),
+            # Covers the per-user activity breakdown without reading rows
+            models.Index(fields=['user', '-accessed_at', 'access_type'], name='fal_user_time_idx'),
         ]
     
     def __str__(self):
         return f"{self.user.username} {self.access_type} {self.document.name} at {self.accessed_at}"
 
 
+class AccessLogBuffer:
+    """
+    Collect access log rows in memory and insert them in batches
+    
+    Rows are flushed with a single bulk INSERT once the batch is full or
+    the flush interval has passed, checked after each request finishes so
+    the write stays off the request's critical path. With ``background``
+    set the INSERT runs on a separate thread instead of the request's.
+    At most ``max_pending`` rows are held; further accesses are dropped
+    rather than letting a stalled database grow the buffer.
+    
+    Queued rows are written on normal interpreter exit, but rows still in
+    memory when the process crashes or is killed are lost.
+    """
+    
+    def __init__(self, batch_size=500, flush_interval=5, max_pending=10000, background=False):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.background = background
+        self._entries = []
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._flusher = None
+    
+    def add(self, **fields):
+        """Queue an access log row, returning False if it was dropped"""
+        fields.setdefault('accessed_at', timezone.now())
+        entry = FileAccessLog(**fields)
+        with self._lock:
+            if len(self._entries) >= self.max_pending:
+                return False
+            self._entries.append(entry)
+        return True
+    
+    def flush_if_due(self):
+        """Flush when the batch is full or the interval has elapsed"""
+        with self._lock:
+            due = bool(self._entries) and (
+                len(self._entries) >= self.batch_size or
+                time.monotonic() - self._last_flush >= self.flush_interval
+            )
+            if due and self.background:
+                # One flusher at a time; rows queued meanwhile wait for the next
+                if self._flusher is not None and self._flusher.is_alive():
+                    return
+                self._flusher = threading.Thread(
+                    target=self._flush_in_background, name='file-access-log', daemon=True
+                )
+                self._flusher.start()
+                return
+        if due:
+            self.flush()
+    
+    def _flush_in_background(self):
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error(f"Failed to flush access logs: {str(e)}")
+        finally:
+            # The flusher thread holds its own connection; don't leave it open
+            connection.close()
+    
+    def flush(self):
+        """Write all queued rows, returning how many were inserted"""
+        with self._lock:
+            entries, self._entries = self._entries, []
+            self._last_flush = time.monotonic()
+        
+        if not entries:
+            return 0
+        
+        try:
+            with transaction.atomic():
+                FileAccessLog.objects.bulk_create(entries, batch_size=self.batch_size)
+        except DatabaseError as e:
+            # A deleted document, revision or user, or one malformed row, fails
+            # the whole batch; retry row by row so only the bad rows are lost
+            logger.warning(f"Batched access log insert failed, retrying per row: {str(e)}")
+            entries = self._insert_each(entries)
+        
+        # bulk_create skips post_save, so invalidate analytics here
+        for user_id in {entry.user_id for entry in entries}:
+            invalidate_file_analytics(user_id)
+        
+        return len(entries)
+    
+    @classmethod
+    def _insert_each(cls, entries):
+        """Insert rows one at a time, returning those that were written"""
+        queued = len(entries)
+        try:
+            entries = cls._drop_orphaned(entries)
+        except DatabaseError as e:
+            logger.error(f"Dropped {queued} buffered access logs: {str(e)}")
+            return []
+        
+        inserted = []
+        for entry in entries:
+            try:
+                with transaction.atomic():
+                    entry.save(force_insert=True)
+            except DatabaseError as e:
+                logger.error(f"Dropped access log for document {entry.document_id}: {str(e)}")
+            else:
+                inserted.append(entry)
+        
+        if len(inserted) < queued:
+            logger.warning(f"Dropped {queued - len(inserted)} of {queued} buffered access logs")
+        return inserted
+    
+    @staticmethod
+    def _drop_orphaned(entries):
+        """Keep only rows whose document, revision and user still exist"""
+        document_ids = set(FileDocument.objects.filter(
+            pk__in={entry.document_id for entry in entries}
+        ).values_list('pk', flat=True))
+        revision_ids = set(FileRevision.objects.filter(
+            pk__in={entry.revision_id for entry in entries if entry.revision_id is not None}
+        ).values_list('pk', flat=True))
+        user_ids = set(User.objects.filter(
+            pk__in={entry.user_id for entry in entries}
+        ).values_list('pk', flat=True))
+        return [
+            entry for entry in entries
+            if entry.document_id in document_ids
+            and entry.user_id in user_ids
+            and (entry.revision_id is None or entry.revision_id in revision_ids)
+        ]
+
+
+access_log_buffer = AccessLogBuffer(
+    batch_size=getattr(settings, 'FILE_ACCESS_LOG_BATCH_SIZE', 500),
+    flush_interval=getattr(settings, 'FILE_ACCESS_LOG_FLUSH_INTERVAL', 5),
+    max_pending=getattr(settings, 'FILE_ACCESS_LOG_MAX_PENDING', 10000),
+    background=getattr(settings, 'FILE_ACCESS_LOG_BACKGROUND_FLUSH', False),
+)
+
+
+@atexit.register
+def flush_access_logs_at_exit():
+    """Write whatever is still queued when the process shuts down"""
+    try:
+        access_log_buffer.flush()
+    except Exception as e:
+        logger.error(f"Error flushing access logs at exit: {str(e)}")
+
+
 class FileShare(models.Model):
     """
     File sharing with external users (future feature)
@@ -200,13 +391,15 @@ class FileDocumentManager(models.Manager):
     
     def by_category(self, user, category):
         """Get documents by file category"""
-        return self.for_user(user).filter(
-            revisions__metadata__file_category=category
-        ).distinct()
+        # A semi-join stops at the first matching revision, so no distinct() is needed
+        matching_metadata = FileMetadata.objects.filter(
+            revision__document=models.OuterRef('pk'),
+            file_category=category
+        )
+        return self.for_user(user).filter(models.Exists(matching_metadata))
     
     def recent(self, user, days=7):
         """Get recently modified documents"""
-        from datetime import timedelta
         cutoff = timezone.now() - timedelta(days=days)
         return self.for_user(user).filter(updated_at__gte=cutoff)
 
@@ -219,13 +412,15 @@ class FileRevisionManager(models.Manager):
         return self.filter(document=document)
     
     def latest_for_documents(self, documents):
-        """Get latest revision for each document"""
-        latest_revisions = []
-        for doc in documents:
-            latest = self.filter(document=doc).order_by('-revision_number').first()
-            if latest:
-                latest_revisions.append(latest)
-        return latest_revisions
+        """Get latest revision for each document in a single query"""
+        # The (document, revision_number) unique index serves the subquery
+        latest_number = self.filter(
+            document=models.OuterRef('document')
+        ).order_by('-revision_number').values('revision_number')[:1]
+        return self.filter(
+            document__in=documents,
+            revision_number=models.Subquery(latest_number)
+        )
 
 
 # Monkey patch the existing models to add managers
@@ -235,28 +430,117 @@ FileRevision.add_to_class('enhanced_objects', FileRevisionManager())
 
 
 # Signal handlers for automatic processing
-from django.db.models.signals import post_save, pre_delete
+from django.core.signals import request_finished
+from django.db.models.signals import post_delete, post_save, pre_delete
 from django.dispatch import receiver
 
 
+_metadata_executor = None
+_metadata_executor_lock = threading.Lock()
+
+
+def _get_metadata_executor():
+    """Lazily start the thread pool used for metadata extraction"""
+    global _metadata_executor
+    if _metadata_executor is None:
+        with _metadata_executor_lock:
+            if _metadata_executor is None:
+                _metadata_executor = ThreadPoolExecutor(
+                    max_workers=settings.FILE_METADATA_WORKERS,
+                    thread_name_prefix='file-metadata'
+                )
+    return _metadata_executor
+
+
+def create_revision_metadata(revision):
+    """Create and process metadata for a revision"""
+    try:
+        FileMetadata.objects.create(revision=revision)
+    except Exception as e:
+        logger.error(f"Error creating metadata for revision {revision.id}: {str(e)}")
+
+
+def _create_revision_metadata_in_background(revision):
+    try:
+        create_revision_metadata(revision)
+    finally:
+        # Worker threads hold their own connection; don't leave it open
+        connection.close()
+
+
 @receiver(post_save, sender=FileRevision)
 def create_file_metadata(sender, instance, created, **kwargs):
-    """Automatically create metadata for new revisions"""
-    if created:
-        try:
-            FileMetadata.objects.create(revision=instance)
-        except Exception as e:
-            logger.error(f"Error creating metadata for revision {instance.id}: {str(e)}")
+    """Automatically create metadata for new revisions, after commit"""
+    if not created:
+        return
+    
+    if getattr(settings, 'FILE_METADATA_WORKERS', 0) > 0:
+        # Hash the file on a worker thread instead of the upload request
+        transaction.on_commit(
+            lambda: _get_metadata_executor().submit(
+                _create_revision_metadata_in_background, instance
+            )
+        )
+    else:
+        transaction.on_commit(lambda: create_revision_metadata(instance))
 
 
 @receiver(post_save, sender=FileRevision)
 def update_user_storage(sender, instance, created, **kwargs):
-    """Update user storage quota when revision is saved"""
+    """Update user storage quota once the new revision is committed"""
+    if created:
+        def update_quota():
+            try:
+                StorageQuotaManager.update_user_quota(instance.document.owner)
+            except Exception as e:
+                logger.error(f"Error updating storage quota: {str(e)}")
+        
+        transaction.on_commit(update_quota)
+
+
+@receiver(post_save, sender=FileRevision)
+def invalidate_analytics_on_upload(sender, instance, created, **kwargs):
+    """Drop cached analytics when a revision is uploaded"""
+    if created:
+        invalidate_file_analytics(instance.document.owner_id)
+
+
+@receiver(post_save, sender=FileAccessLog)
+def invalidate_analytics_on_access(sender, instance, created, **kwargs):
+    """Drop cached analytics when a file access is logged"""
     if created:
+        invalidate_file_analytics(instance.user_id)
+
+
+@receiver(request_finished)
+def flush_access_logs(sender, **kwargs):
+    """Write buffered access logs once a request has been answered"""
+    try:
+        access_log_buffer.flush_if_due()
+    except Exception as e:
+        logger.error(f"Error flushing access logs: {str(e)}")
+
+
+@receiver(post_delete, sender=FileDocument)
+def invalidate_analytics_on_delete(sender, instance, **kwargs):
+    """Drop cached analytics when a document is deleted"""
+    invalidate_file_analytics(instance.owner_id)
+
+
+@receiver(post_save, sender=FileDocument)
+@receiver(post_delete, sender=FileDocument)
+@receiver(post_save, sender=FileRevision)
+@receiver(post_delete, sender=FileRevision)
+def invalidate_profile_on_file_change(sender, instance, **kwargs):
+    """Drop the cached profile response, whose file totals just changed"""
+    if sender is FileDocument:
+        owner_id = instance.owner_id
+    else:
         try:
-            StorageQuotaManager.update_user_quota(instance.document.owner)
-        except Exception as e:
-            logger.error(f"Error updating storage quota: {str(e)}")
+            owner_id = instance.document.owner_id
+        except FileDocument.DoesNotExist:
+            return  # Deleted along with its document, which is handled above
+    cache.delete(profile_cache_key(owner_id))
 
 
 @receiver(pre_delete, sender=FileRevision)
@@ -270,6 +554,14 @@ def cleanup_revision_files(sender, instance, **kwargs):
         logger.error(f"Error cleaning up revision files: {str(e)}")
 
 
+@receiver(post_delete, sender=FileRevision)
+def decrement_revision_count(sender, instance, **kwargs):
+    """Keep the document's denormalized revision count in step with deletes"""
+    FileDocument.objects.filter(pk=instance.document_id).update(
+        revision_count=models.F('revision_count') - 1
+    )
+
+
 @receiver(pre_delete, sender=FileDocument)
 def update_storage_on_delete(sender, instance, **kwargs):
     """Update storage quota when document is deleted"""
@@ -279,7 +571,6 @@ def update_storage_on_delete(sender, instance, **kwargs):
             StorageQuotaManager.update_user_quota(instance.owner)
         
         # Schedule update after deletion
-        from django.db import transaction
         transaction.on_commit(update_quota)
         
     except Exception as e:
@@ -287,20 +578,38 @@ def update_storage_on_delete(sender, instance, **kwargs):
 
 
 # Utility functions for enhanced file management
-def get_file_statistics(user, days=30):
-    """Get comprehensive file statistics for user"""
-    from datetime import timedelta
-    from django.db.models import Count, Sum
+def get_analytics_cache_key(user_id, days):
+    """
+    Build a versioned cache key for a user's analytics
     
-    cutoff = timezone.now() - timedelta(days=days)
+    Every cached window for the user shares one version, so bumping it
+    in invalidate_file_analytics() retires them all at once without
+    needing pattern deletes from the cache backend.
+    """
+    version = cache.get_or_set(f"analytics_version:{user_id}", time.time_ns, None)
+    return f"analytics:{user_id}:{version}:{days}"
+
+
+def invalidate_file_analytics(user_id):
+    """Invalidate every cached analytics window for a user"""
+    cache.set(f"analytics_version:{user_id}", time.time_ns(), None)
+
+
+def get_file_statistics(user, days=30, since=None):
+    """
+    Get comprehensive file statistics for user
     
-    # Basic counts
-    total_docs = FileDocument.objects.filter(owner=user).count()
-    total_revisions = FileRevision.objects.filter(document__owner=user).count()
-    recent_uploads = FileRevision.objects.filter(
-        document__owner=user,
-        uploaded_at__gte=cutoff
-    ).count()
+    ``since`` overrides the cutoff derived from ``days`` so callers can
+    share one timestamp across several queries.
+    """
+    cutoff = since if since is not None else timezone.now() - timedelta(days=days)
+    
+    # Basic counts in one pass over the user's documents and revisions
+    counts = FileDocument.objects.filter(owner=user).aggregate(
+        total_docs=Count('id', distinct=True),
+        total_revisions=Count('revisions'),
+        recent_uploads=Count('revisions', filter=Q(revisions__uploaded_at__gte=cutoff)),
+    )
     
     # Category breakdown
     categories = FileMetadata.objects.filter(
@@ -310,29 +619,34 @@ def get_file_statistics(user, days=30):
     )
     
     # Storage info
-    quota_status = StorageQuotaManager.get_quota_status(user)
+    quota_status = StorageQuotaManager.get_cached_quota_status(user)
     
     return {
-        'total_documents': total_docs,
-        'total_revisions': total_revisions,
-        'recent_uploads': recent_uploads,
+        'total_documents': counts['total_docs'],
+        'total_revisions': counts['total_revisions'],
+        'recent_uploads': counts['recent_uploads'],
         'categories': {item['file_category']: item['count'] for item in categories},
         'storage': quota_status,
     }
 
 
 def cleanup_old_revisions(user, keep_per_document=5):
-    """Clean up old revisions for user"""
-    from .storage import RevisionManager
+    """
+    Clean up old revisions for user
     
+    Returns a (cleaned_count, bytes_freed) tuple.
+    """
     documents = FileDocument.objects.filter(owner=user)
     total_cleaned = 0
+    total_freed = 0
     
     for document in documents:
-        cleaned = RevisionManager.cleanup_old_revisions(document, keep_per_document)
+        cleaned, freed = RevisionManager.cleanup_old_revisions(document, keep_per_document)
         total_cleaned += cleaned
+        total_freed += freed
     
-    # Update storage quota
-    StorageQuotaManager.update_user_quota(user)
+    # Update storage quota by the freed amount instead of recounting
+    StorageQuotaManager.release_storage(user, total_freed)
+    invalidate_file_analytics(user.id)
     
-    return total_cleaned
\ No newline at end of file
+    return total_cleaned, total_freed
@@ -5,14 +5,38 @@ from rest_framework import permissions
 from rest_framework.exceptions import PermissionDenied
 from django.core.exceptions import ValidationError
 from django.utils import timezone
-from datetime import timedelta
 import logging
+import time
+from functools import wraps
+
+from apps.authentication.models import get_or_create_profile
 
 from .models import FileDocument, FileRevision
-from .models_extensions import FileAccessLog
+from .models_extensions import access_log_buffer
+from .utils import get_client_ip, get_user_agent, increment_cache_counter
 
 logger = logging.getLogger(__name__)
 
+ACCESS_RATE_LIMIT = 1000
+ACCESS_RATE_LIMIT_WINDOW = 3600  # 1 hour
+
+
+def get_owner_id(obj):
+    """Owner primary key of a document, or of the document behind a revision"""
+    owner_id = getattr(obj, 'owner_id', None)
+    if owner_id is None:
+        # Revisions fetched through document.revisions already cache the
+        # document, so this reads its owner_id without loading the user
+        document = getattr(obj, 'document', None)
+        owner_id = getattr(document, 'owner_id', None)
+    return owner_id
+
+
+def is_owned_by(obj, user):
+    """Check ownership by comparing primary keys instead of User instances"""
+    owner_id = get_owner_id(obj)
+    return owner_id is not None and owner_id == user.pk
+
 
 class IsOwnerOrReadOnly(permissions.BasePermission):
     """
@@ -30,11 +54,7 @@ class IsOwnerOrReadOnly(permissions.BasePermission):
     
     def _check_owner(self, user, obj):
         """Check if user owns the object"""
-        if hasattr(obj, 'owner'):
-            return obj.owner == user
-        elif hasattr(obj, 'document'):
-            return obj.document.owner == user
-        return False
+        return is_owned_by(obj, user)
 
 
 class FileAccessPermission(permissions.BasePermission):
@@ -45,20 +65,31 @@ class FileAccessPermission(permissions.BasePermission):
     
     def has_permission(self, request, view):
         """Check if user has general permission to access files"""
+        # DRF checks this before every object check, so the result (and any
+        # denial message) is kept on the request and computed only once
+        cached = getattr(request, '_file_access_permission', None)
+        if cached is None:
+            cached = request._file_access_permission = self._check_permission(request)
+        
+        allowed, message = cached
+        if message:
+            self.message = message
+        return allowed
+    
+    def _check_permission(self, request):
+        """Return (allowed, denial message) for the request's user"""
         if not request.user.is_authenticated:
-            return False
+            return False, None
         
         # Check if user account is active
         if not request.user.is_active:
-            self.message = "Your account is not active."
-            return False
+            return False, "Your account is not active."
         
         # Check for rate limiting (optional)
         if self._is_rate_limited(request.user):
-            self.message = "Too many requests. Please try again later."
-            return False
+            return False, "Too many requests. Please try again later."
         
-        return True
+        return True, None
     
     def has_object_permission(self, request, view, obj):
         """Check specific object permissions"""
@@ -66,51 +97,55 @@ class FileAccessPermission(permissions.BasePermission):
             return False
         
         # Check ownership
-        if not self._is_owner(request.user, obj):
+        if not self._is_owner_cached(request, obj):
             self._log_unauthorized_access(request, obj)
             return False
         
         # Additional checks based on request method
         if request.method in ['DELETE']:
-            return self._can_delete(request.user, obj)
+            return self._can_delete(request, obj)
         elif request.method in ['PUT', 'PATCH']:
-            return self._can_modify(request.user, obj)
+            return self._can_modify(request, obj)
         
         return True
     
+    def _is_owner_cached(self, request, obj):
+        """Check ownership once per object for the lifetime of the request"""
+        owner_checks = getattr(request, '_file_owner_checks', None)
+        if owner_checks is None:
+            owner_checks = request._file_owner_checks = {}
+        
+        key = (type(obj), obj.pk)
+        if key not in owner_checks:
+            owner_checks[key] = self._is_owner(request.user, obj)
+        return owner_checks[key]
+    
     def _is_owner(self, user, obj):
         """Check if user is the owner"""
-        if isinstance(obj, FileDocument):
-            return obj.owner == user
-        elif isinstance(obj, FileRevision):
-            return obj.document.owner == user
-        elif hasattr(obj, 'owner'):
-            return obj.owner == user
-        elif hasattr(obj, 'document'):
-            return obj.document.owner == user
-        return False
+        return is_owned_by(obj, user)
     
-    def _can_delete(self, user, obj):
+    def _can_delete(self, request, obj):
         """Check if user can delete the object"""
         # For now, owners can delete anything they own
         # This could be extended to check for shared files, etc.
-        return self._is_owner(user, obj)
+        return self._is_owner_cached(request, obj)
     
-    def _can_modify(self, user, obj):
+    def _can_modify(self, request, obj):
         """Check if user can modify the object"""
         # Basic ownership check - can be extended
-        return self._is_owner(user, obj)
+        return self._is_owner_cached(request, obj)
     
     def _is_rate_limited(self, user):
         """Check if user is rate limited"""
-        # Simple rate limiting - max 1000 requests per hour
-        one_hour_ago = timezone.now() - timedelta(hours=1)
-        recent_requests = FileAccessLog.objects.filter(
-            user=user,
-            accessed_at__gte=one_hour_ago
-        ).count()
+        # Simple rate limiting - max 1000 requests per hour, counted in a
+        # per-user cache counter for the current hour
+        window = int(time.time()) // ACCESS_RATE_LIMIT_WINDOW
+        recent_requests = increment_cache_counter(
+            f"file_access_rate_limit_{user.id}_{window}",
+            timeout=ACCESS_RATE_LIMIT_WINDOW + 100
+        )
         
-        return recent_requests > 1000
+        return recent_requests > ACCESS_RATE_LIMIT
     
     def _log_unauthorized_access(self, request, obj):
         """Log unauthorized access attempts"""
@@ -128,6 +163,9 @@ class FileAccessPermission(permissions.BasePermission):
 class StorageQuotaPermission(permissions.BasePermission):
     """
     Permission to check storage quota before uploads
+    
+    This only turns away uploads that clearly won't fit; the space itself
+    is reserved atomically when the revision is created.
     """
     message = "Storage quota exceeded."
     
@@ -136,15 +174,8 @@ class StorageQuotaPermission(permissions.BasePermission):
         if request.method not in ['POST', 'PUT']:
             return True  # Only check for uploads
         
-        # Check if file is being uploaded
-        if 'file' not in request.data and 'file_data' not in request.data:
-            return True
-        
-        user = request.user
-        if not hasattr(user, 'profile'):
-            return True  # No quota if no profile
-        
-        # Get file size
+        # Get file size before loading the profile, so requests without
+        # an upload never query it
         file_obj = request.data.get('file') or request.data.get('file_data')
         if not file_obj:
             return True
@@ -154,7 +185,8 @@ class StorageQuotaPermission(permissions.BasePermission):
             return True
         
         # Check quota
-        profile = user.profile
+        profile = get_or_create_profile(request.user)
+        
         if profile.storage_used + file_size > profile.storage_limit:
             available = profile.storage_limit - profile.storage_used
             self.message = (
@@ -171,9 +203,11 @@ class FileTypePermission(permissions.BasePermission):
     Permission to restrict file types based on user level
     """
     # Define allowed extensions by user type
-    BASIC_ALLOWED = {'.txt', '.pdf', '.jpg', '.png', '.gif', '.doc', '.docx'}
+    BASIC_ALLOWED = frozenset({'.txt', '.pdf', '.jpg', '.png', '.gif', '.doc', '.docx'})
     PREMIUM_ALLOWED = BASIC_ALLOWED | {'.zip', '.rar', '.mp4', '.avi', '.psd', '.ai'}
     ADMIN_ALLOWED = None  # No restrictions
+    # Suffix tuples let str.endswith test every extension in one call
+    PREMIUM_SUFFIXES = tuple(PREMIUM_ALLOWED)
     
     def has_permission(self, request, view):
         """Check file type permissions"""
@@ -189,10 +223,6 @@ class FileTypePermission(permissions.BasePermission):
         if not filename:
             return True
         
-        # Get file extension
-        import os
-        ext = os.path.splitext(filename)[1].lower()
-        
         # Check permissions based on user type
         user = request.user
         if user.is_superuser:
@@ -201,8 +231,17 @@ class FileTypePermission(permissions.BasePermission):
         # For now, all users get premium permissions
         # This could be extended to check user subscription level
         allowed_extensions = self.PREMIUM_ALLOWED
+        allowed_suffixes = self.PREMIUM_SUFFIXES
         
-        if allowed_extensions and ext not in allowed_extensions:
+        name = filename.lower()
+        if allowed_extensions and name in allowed_extensions:
+            # A bare ".txt" is all extension and no name
+            self.message = "File name is missing before the extension."
+            return False
+        
+        if allowed_suffixes and not name.endswith(allowed_suffixes):
+            _, dot, ext = filename.rpartition('.')
+            ext = f".{ext.lower()}" if dot else ''
             self.message = f"File type '{ext}' is not allowed for your account level."
             return False
         
@@ -227,11 +266,8 @@ class FileViewPermission(permissions.BasePermission):
             return False
         
         # Check ownership
-        user = request.user
-        if isinstance(obj, FileDocument):
-            return obj.owner == user
-        elif isinstance(obj, FileRevision):
-            return obj.document.owner == user
+        if isinstance(obj, (FileDocument, FileRevision)):
+            return is_owned_by(obj, request.user)
         
         return False
 
@@ -258,11 +294,8 @@ class BulkOperationPermission(permissions.BasePermission):
         
         # Check if all files belong to the user
         if request.method == 'POST' and urls:
-            user_file_urls = set(
-                FileDocument.objects.filter(owner=user).values_list('url', flat=True)
-            )
-            
-            invalid_urls = [url for url in urls if url not in user_file_urls]
+            ownership = bulk_check_owner(user, urls)
+            invalid_urls = [url for url, owned in ownership.items() if not owned]
             if invalid_urls:
                 self.message = f"You don't own some of the specified files: {invalid_urls[:5]}"
                 return False
@@ -270,6 +303,19 @@ class BulkOperationPermission(permissions.BasePermission):
         return True
 
 
+# Headers added to file API responses by FileAccessMiddleware
+FILE_RESPONSE_HEADERS = (
+    # Prevent caching of sensitive files
+    ('Cache-Control', 'no-cache, no-store, must-revalidate'),
+    ('Pragma', 'no-cache'),
+    ('Expires', '0'),
+    # Add content security policy
+    ('Content-Security-Policy', "default-src 'none'"),
+    # Prevent MIME type sniffing
+    ('X-Content-Type-Options', 'nosniff'),
+)
+
+
 # Middleware for additional security
 class FileAccessMiddleware:
     """
@@ -294,40 +340,29 @@ class FileAccessMiddleware:
         """Add security headers and checks"""
         # Add security context to request
         request.security_context = {
-            'ip_address': self._get_client_ip(request),
-            'user_agent': request.META.get('HTTP_USER_AGENT', ''),
+            'ip_address': get_client_ip(request),
+            'user_agent': get_user_agent(request),
             'timestamp': timezone.now(),
         }
     
     def _process_response(self, request, response):
         """Add security headers to response"""
-        # Add security headers for file downloads
-        if hasattr(request, 'resolver_match') and request.resolver_match:
-            if 'files' in request.resolver_match.app_name or '':
-                # Prevent caching of sensitive files
-                response['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-                response['Pragma'] = 'no-cache'
-                response['Expires'] = '0'
-                
-                # Add content security policy
-                response['Content-Security-Policy'] = "default-src 'none'"
-                
-                # Prevent MIME type sniffing
-                response['X-Content-Type-Options'] = 'nosniff'
-    
-    def _get_client_ip(self, request):
-        """Get client IP address"""
-        x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
-        if x_forwarded_for:
-            return x_forwarded_for.split(',')[0].strip()
-        return request.META.get('REMOTE_ADDR')
+        # Only file API responses get the headers; anything else is untouched
+        resolver_match = getattr(request, 'resolver_match', None)
+        if resolver_match and resolver_match.app_name == 'files':
+            for header, value in FILE_RESPONSE_HEADERS:
+                response[header] = value
 
 
 # Decorator for additional permission checks
 def require_file_owner(view_func):
     """
     Decorator to ensure user owns the file being accessed
+    
+    The checked document is kept as ``request.file_document`` so the view
+    can reuse it instead of fetching the same row again.
     """
+    @wraps(view_func)
     def wrapper(request, *args, **kwargs):
         # Get file ID or URL from kwargs
         file_id = kwargs.get('file_id') or kwargs.get('pk')
@@ -336,14 +371,16 @@ def require_file_owner(view_func):
         if file_id:
             try:
                 document = FileDocument.objects.get(id=file_id)
-                if document.owner != request.user:
-                    raise PermissionDenied("You don't own this file")
             except FileDocument.DoesNotExist:
                 raise PermissionDenied("File not found")
+            # Compare ids so the owner row isn't loaded just for the check
+            if document.owner_id != request.user.id:
+                raise PermissionDenied("You don't own this file")
+            request.file_document = document
         
         elif file_url:
             try:
-                document = FileDocument.objects.get(url=file_url, owner=request.user)
+                request.file_document = FileDocument.objects.get(url=file_url, owner=request.user)
             except FileDocument.DoesNotExist:
                 raise PermissionDenied("File not found or access denied")
         
@@ -358,7 +395,18 @@ def user_can_access_file(user, file_document):
     if not user.is_authenticated:
         return False
     
-    return file_document.owner == user
+    return file_document.owner_id == user.pk
+
+
+def bulk_check_owner(user, urls):
+    """
+    Map each URL to whether the user owns a document there, in one query
+    """
+    # Only look up the requested URLs; (owner, url) is unique and indexed
+    owned_urls = set(
+        FileDocument.objects.filter(owner=user, url__in=urls).values_list('url', flat=True)
+    )
+    return {url: url in owned_urls for url in urls}
 
 
 def user_can_upload_file(user, file_size=0):
@@ -366,10 +414,8 @@ def user_can_upload_file(user, file_size=0):
     if not user.is_authenticated:
         return False, "User not authenticated"
     
-    if not hasattr(user, 'profile'):
-        return True, "No quota restrictions"
+    profile = get_or_create_profile(user)
     
-    profile = user.profile
     if profile.storage_used + file_size > profile.storage_limit:
         return False, "Storage quota exceeded"
     
@@ -383,25 +429,26 @@ def log_file_access(user, document, access_type='view', request=None):
         user_agent = ""
         
         if request:
-            ip_address = request.META.get('HTTP_X_FORWARDED_FOR', '').split(',')[0]
-            if not ip_address:
-                ip_address = request.META.get('REMOTE_ADDR')
-            user_agent = request.META.get('HTTP_USER_AGENT', '')
+            # Both are parsed once per request and shared with the middleware
+            ip_address = get_client_ip(request)
+            user_agent = get_user_agent(request)
         
-        FileAccessLog.objects.create(
+        access_log_buffer.add(
             document=document,
             user=user,
             access_type=access_type,
             ip_address=ip_address,
-            user_agent=user_agent[:500]  # Limit length
+            user_agent=user_agent
         )
     except Exception as e:
         # Don't fail the request if logging fails
         logger.error(f"Failed to log file access: {str(e)}")
 
 
-# Permission sets for different use cases
-OWNER_PERMISSIONS = [permissions.IsAuthenticated, FileAccessPermission]
+# Permission sets for different use cases. FileAccessPermission and
+# BulkOperationPermission reject anonymous users themselves, so IsAuthenticated
+# is only listed where no other class checks authentication
+OWNER_PERMISSIONS = [FileAccessPermission]
 UPLOAD_PERMISSIONS = [permissions.IsAuthenticated, StorageQuotaPermission, FileTypePermission]
-BULK_PERMISSIONS = [permissions.IsAuthenticated, BulkOperationPermission]
+BULK_PERMISSIONS = [BulkOperationPermission]
 VIEW_PERMISSIONS = [permissions.IsAuthenticated, FileViewPermission]
\ No newline at end of file
@@ -1,9 +1,26 @@
 from rest_framework import serializers
 from django.contrib.auth.models import User
 from django.core.files.uploadedfile import UploadedFile
-import mimetypes
+from django.db import IntegrityError, transaction
 import os
+import re
 from .models import FileDocument, FileRevision
+from .utils import guess_content_type
+
+
+URL_UNIQUE_CONSTRAINT = 'uniq_owner_url'
+# SQLite reports the constraint's columns rather than its name
+URL_UNIQUE_COLUMNS = '{0}.owner_id, {0}.url'.format(FileDocument._meta.db_table)
+DUPLICATE_URL_MESSAGE = 'You already have a document at this URL path'
+
+# Path traversal, empty segments and characters that are unsafe in paths
+INVALID_URL_RE = re.compile(r'\.\.|//|[<>"|?*]')
+
+
+def _is_duplicate_url(error):
+    """Check whether an IntegrityError comes from the (owner, url) constraint"""
+    message = str(error)
+    return URL_UNIQUE_CONSTRAINT in message or URL_UNIQUE_COLUMNS in message
 
 
 class FileRevisionSerializer(serializers.ModelSerializer):
@@ -71,7 +88,7 @@ class FileRevisionSerializer(serializers.ModelSerializer):
         file_data = validated_data['file_data']
         
         # Auto-detect content type
-        content_type, _ = mimetypes.guess_type(file_data.name)
+        content_type = guess_content_type(file_data.name)
         if content_type:
             validated_data['content_type'] = content_type
         
@@ -106,7 +123,7 @@ class FileDocumentSerializer(serializers.ModelSerializer):
         source='get_latest_revision',
         read_only=True
     )
-    revision_count = serializers.ReadOnlyField(source='get_revision_count')
+    revision_count = serializers.IntegerField(read_only=True)
     
     # All revisions (optional, for detailed view)
     revisions = FileRevisionListSerializer(many=True, read_only=True)
@@ -130,11 +147,10 @@ class FileDocumentSerializer(serializers.ModelSerializer):
         if value.endswith('/'):
             raise serializers.ValidationError("URL cannot end with '/'")
         
-        # Check for invalid characters
-        invalid_chars = ['..', '//', '<', '>', '"', '|', '?', '*']
-        for char in invalid_chars:
-            if char in value:
-                raise serializers.ValidationError(f"URL contains invalid character: {char}")
+        # Check for invalid characters in a single scan
+        match = INVALID_URL_RE.search(value)
+        if match:
+            raise serializers.ValidationError(f"URL contains invalid character: {match.group(0)}")
         
         return value
     
@@ -142,18 +158,18 @@ class FileDocumentSerializer(serializers.ModelSerializer):
         """
         Validate that URL is unique for this user
         """
-        user = self.context['request'].user
         url = attrs.get('url')
         
-        if url:
-            # Check for existing document with same URL for this user
-            existing = FileDocument.objects.filter(owner=user, url=url)
-            if self.instance:
-                existing = existing.exclude(id=self.instance.id)
+        # New documents rely on the (owner, url) unique constraint in create()
+        if url and self.instance:
+            # Check for another document with same URL for this user
+            existing = FileDocument.objects.filter(
+                owner=self.context['request'].user, url=url
+            ).exclude(id=self.instance.id)
             
             if existing.exists():
                 raise serializers.ValidationError({
-                    'url': 'You already have a document at this URL path'
+                    'url': DUPLICATE_URL_MESSAGE
                 })
         
         return attrs
@@ -164,7 +180,13 @@ class FileDocumentSerializer(serializers.ModelSerializer):
         """
         user = self.context['request'].user
         validated_data['owner'] = user
-        return super().create(validated_data)
+        try:
+            with transaction.atomic():
+                return super().create(validated_data)
+        except IntegrityError as e:
+            if _is_duplicate_url(e):
+                raise serializers.ValidationError({'url': DUPLICATE_URL_MESSAGE})
+            raise
 
 
 class FileDocumentListSerializer(serializers.ModelSerializer):
@@ -175,7 +197,7 @@ class FileDocumentListSerializer(serializers.ModelSerializer):
         source='get_latest_revision',
         read_only=True
     )
-    revision_count = serializers.ReadOnlyField(source='get_revision_count')
+    revision_count = serializers.IntegerField(read_only=True)
     
     class Meta:
         model = FileDocument
@@ -253,19 +275,10 @@ class FileDocumentDetailSerializer(FileDocumentSerializer):
     class Meta(FileDocumentSerializer.Meta):
         fields = FileDocumentSerializer.Meta.fields
     
-    def to_representation(self, instance):
-        """
-        Customize representation to include all revisions
-        """
-        data = super().to_representation(instance)
-        
-        # Include all revisions in detail view
-        if not self.context.get('exclude_revisions', False):
-            revisions = instance.revisions.all()
-            data['revisions'] = FileRevisionListSerializer(
-                revisions, 
-                many=True, 
-                context=self.context
-            ).data
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
         
-        return data
\ No newline at end of file
+        # The inherited revisions field already serializes every revision;
+        # drop it up front when the caller doesn't want them
+        if self.context.get('exclude_revisions', False):
+            self.fields.pop('revisions', None)
\ No newline at end of file
@@ -4,13 +4,65 @@ Custom storage backend for file management with enhanced features
 import os
 import hashlib
 import logging
+import mmap
+import secrets
+from datetime import datetime
+from functools import lru_cache
 from django.core.files.storage import FileSystemStorage
 from django.core.files.base import ContentFile
 from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F, Max, Sum
+from django.db.models.functions import Greatest
 from django.utils.deconstruct import deconstructible
 
+from apps.authentication.models import UserProfile, get_or_create_profile, profile_cache_key
+
+from .models import FileRevision
+from .utils import guess_content_type
+
 logger = logging.getLogger(__name__)
 
+QUOTA_CACHE_TIMEOUT = 60  # seconds
+HASH_ALGORITHMS = ('md5', 'sha1', 'sha256')
+# Resolved once at import. hashlib's named constructors are the OpenSSL
+# implementations, which pick SHA-NI/ARMv8 instructions at runtime when the
+# CPU has them; hashlib.new() would repeat the name lookup on every call.
+HASH_CONSTRUCTORS = {algorithm: getattr(hashlib, algorithm) for algorithm in HASH_ALGORITHMS}
+# Disk-backed files at least this large are hashed through a read-only mmap
+MMAP_HASH_THRESHOLD = 1 << 20
+# Characters replaced with '_' in stored filenames
+INVALID_NAME_TRANSLATION = str.maketrans(dict.fromkeys('/\\:*?"<>|;', '_'))
+# Collisions tried as name_1 ... name_N before falling back to random suffixes
+NUMBERED_NAME_ATTEMPTS = 100
+RANDOM_NAME_ATTEMPTS = 10
+# File categories in priority order: (category, extensions, content type test)
+FILE_CATEGORIES = (
+    ('image', frozenset({'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.svg', '.webp'}),
+     lambda content_type: content_type.startswith('image/')),
+    ('document', frozenset({'.pdf', '.doc', '.docx', '.txt', '.rtf', '.odt'}),
+     lambda content_type: 'document' in content_type),
+    ('spreadsheet', frozenset({'.xls', '.xlsx', '.csv', '.ods'}),
+     lambda content_type: 'spreadsheet' in content_type),
+    ('presentation', frozenset({'.ppt', '.pptx', '.odp'}),
+     lambda content_type: 'presentation' in content_type),
+    ('archive', frozenset({'.zip', '.rar', '.7z', '.tar', '.gz', '.bz2'}),
+     lambda content_type: 'archive' in content_type),
+    ('video', frozenset({'.mp4', '.avi', '.mov', '.wmv', '.flv', '.webm'}),
+     lambda content_type: content_type.startswith('video/')),
+    ('audio', frozenset({'.mp3', '.wav', '.flac', '.ogg', '.m4a'}),
+     lambda content_type: content_type.startswith('audio/')),
+)
+EXTENSION_CATEGORIES = {
+    extension: category
+    for category, extensions, _ in FILE_CATEGORIES
+    for extension in extensions
+}
+FILE_CATEGORY_RULES = tuple((category, test) for category, _, test in FILE_CATEGORIES)
+# Default read size for hashing; FILE_HASH_CHUNK_SIZE overrides it.
+# 1 MiB keeps the Python loop short on large files
+HASH_CHUNK_SIZE = 1 << 20
+
 
 @deconstructible
 class SecureFileStorage(FileSystemStorage):
@@ -32,10 +84,8 @@ class SecureFileStorage(FileSystemStorage):
         # Remove directory path and get basename
         name = os.path.basename(name)
         
-        # Replace potentially problematic characters
-        invalid_chars = ['/', '\\', ':', '*', '?', '"', '<', '>', '|', ';']
-        for char in invalid_chars:
-            name = name.replace(char, '_')
+        # Replace potentially problematic characters in a single pass
+        name = name.translate(INVALID_NAME_TRANSLATION)
         
         # Ensure name isn't empty
         if not name or name.startswith('.'):
@@ -62,23 +112,33 @@ class SecureFileStorage(FileSystemStorage):
         if not self.exists(name):
             return name
         
-        # Generate unique name
+        # List the directory once and test numbered candidates against that
+        # set, rather than one exists() stat per candidate
         root, ext = os.path.splitext(name)
-        counter = 1
-        
-        while True:
-            candidate = f"{root}_{counter}{ext}"
-            if len(candidate) > max_length:
-                # Truncate root to fit
-                max_root_length = max_length - len(f"_{counter}{ext}")
-                candidate = f"{root[:max_root_length]}_{counter}{ext}"
-            
+        with os.scandir(os.path.dirname(self.path(name))) as entries:
+            taken = {entry.name for entry in entries if entry.name.endswith(ext)}
+        
+        for counter in range(1, NUMBERED_NAME_ATTEMPTS + 1):
+            candidate = self._suffixed_name(root, ext, counter, max_length)
+            if candidate not in taken:
+                return candidate
+        
+        # Heavily reused names get a random suffix, checked on its own
+        for _ in range(RANDOM_NAME_ATTEMPTS):
+            candidate = self._suffixed_name(root, ext, secrets.token_hex(4), max_length)
             if not self.exists(candidate):
                 return candidate
-            
-            counter += 1
-            if counter > 9999:  # Prevent infinite loop
-                raise ValueError(f"Could not find available name for {name}")
+        
+        raise ValueError(f"Could not find available name for {name}")
+    
+    @staticmethod
+    def _suffixed_name(root, ext, suffix, max_length):
+        """Append _suffix to the name root, truncating the root to fit"""
+        candidate = f"{root}_{suffix}{ext}"
+        if len(candidate) > max_length:
+            max_root_length = max_length - len(f"_{suffix}{ext}")
+            candidate = f"{root[:max_root_length]}_{suffix}{ext}"
+        return candidate
 
 
 class FileHashManager:
@@ -86,36 +146,113 @@ class FileHashManager:
     Manages file content hashing for deduplication and integrity
     """
     
+    @staticmethod
+    def _map_file(file_obj):
+        """
+        Map a large disk-backed file read-only, or return None for other files
+        """
+        try:
+            fileno = file_obj.fileno()
+            if os.fstat(fileno).st_size < MMAP_HASH_THRESHOLD:
+                return None
+            mapped = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+        except (AttributeError, OSError, ValueError):
+            # In-memory uploads and ContentFile have no usable descriptor
+            return None
+        
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        return mapped
+    
+    @staticmethod
+    def _read_chunks(file_obj):
+        """
+        Yield file content from the start in FILE_HASH_CHUNK_SIZE pieces
+        """
+        chunk_size = getattr(settings, 'FILE_HASH_CHUNK_SIZE', HASH_CHUNK_SIZE)
+        file_obj.seek(0)
+        return iter(lambda: file_obj.read(chunk_size), b"")
+    
     @staticmethod
     def calculate_hash(file_obj, algorithm='sha256'):
         """
         Calculate hash of file content
         """
-        if algorithm not in ['md5', 'sha1', 'sha256']:
-            algorithm = 'sha256'
+        constructor = HASH_CONSTRUCTORS.get(algorithm, hashlib.sha256)
         
-        hasher = getattr(hashlib, algorithm)()
+        mapped = FileHashManager._map_file(file_obj)
+        if mapped is not None:
+            # One update over the whole mapping, hashed without holding the GIL
+            with mapped:
+                hasher = constructor(mapped)
+        else:
+            hasher = constructor()
+            for chunk in FileHashManager._read_chunks(file_obj):
+                hasher.update(chunk)
         
         # Reset file pointer
         file_obj.seek(0)
         
-        # Read in chunks for memory efficiency
-        for chunk in iter(lambda: file_obj.read(8192), b""):
-            hasher.update(chunk)
+        return hasher.hexdigest()
+    
+    @staticmethod
+    def calculate_hashes(file_obj, algorithms=('sha256',)):
+        """
+        Calculate several hashes of file content in a single read pass
+        """
+        hashers = {
+            algorithm: HASH_CONSTRUCTORS[algorithm]()
+            for algorithm in algorithms if algorithm in HASH_CONSTRUCTORS
+        }
+        
+        mapped = FileHashManager._map_file(file_obj)
+        if mapped is not None:
+            with mapped:
+                for hasher in hashers.values():
+                    hasher.update(mapped)
+        else:
+            for chunk in FileHashManager._read_chunks(file_obj):
+                for hasher in hashers.values():
+                    hasher.update(chunk)
         
-        # Reset file pointer
         file_obj.seek(0)
         
-        return hasher.hexdigest()
+        return {algorithm: hasher.hexdigest() for algorithm, hasher in hashers.items()}
+    
+    @staticmethod
+    def verify_hashes(file_path, expected_hashes):
+        """
+        Verify file integrity against several expected hashes in one read pass
+        """
+        try:
+            with open(file_path, 'rb') as f:
+                actual_hashes = FileHashManager.calculate_hashes(f, tuple(expected_hashes))
+        except (IOError, OSError):
+            return False
+        
+        # Unsupported algorithms are missing from actual_hashes and fail
+        return bool(expected_hashes) and all(
+            actual_hashes.get(algorithm) == expected
+            for algorithm, expected in expected_hashes.items()
+        )
     
     @staticmethod
     def verify_integrity(file_path, expected_hash, algorithm='sha256'):
         """
         Verify file integrity against expected hash
         """
+        constructor = HASH_CONSTRUCTORS.get(algorithm, hashlib.sha256)
+        
         try:
             with open(file_path, 'rb') as f:
-                actual_hash = FileHashManager.calculate_hash(f, algorithm)
+                mapped = FileHashManager._map_file(f)
+                if mapped is not None:
+                    with mapped:
+                        actual_hash = constructor(mapped).hexdigest()
+                else:
+                    # file_digest reads straight into the C hasher, skipping
+                    # a per-chunk Python loop
+                    actual_hash = hashlib.file_digest(f, constructor).hexdigest()
                 return actual_hash == expected_hash
         except (IOError, OSError):
             return False
@@ -140,43 +277,38 @@ class RevisionManager:
         """
         Get the next available revision number for a document
         """
-        from .models import FileRevision
-        
-        last_revision = FileRevision.objects.filter(
+        # MAX over the (document, revision_number) unique index; no row is loaded
+        last_number = FileRevision.objects.filter(
             document=document
-        ).order_by('-revision_number').first()
+        ).aggregate(last=Max('revision_number'))['last']
         
-        return (last_revision.revision_number + 1) if last_revision else 0
+        return 0 if last_number is None else last_number + 1
     
     @staticmethod
     def cleanup_old_revisions(document, keep_count=10):
         """
         Clean up old revisions, keeping only the most recent ones
-        """
-        from .models import FileRevision
         
-        revisions = document.revisions.order_by('-revision_number')
-        
-        if revisions.count() <= keep_count:
-            return 0  # Nothing to clean up
-        
-        old_revisions = revisions[keep_count:]
-        deleted_count = 0
+        Returns a (deleted_count, bytes_freed) tuple.
+        """
+        # Only the ids and sizes of the revisions past the newest keep_count
+        old_revisions = list(
+            document.revisions.order_by('-revision_number').values_list('id', 'file_size')[keep_count:]
+        )
+        if not old_revisions:
+            return 0, 0  # Nothing to clean up
         
-        for revision in old_revisions:
-            try:
-                # Delete file first
-                if revision.file_data and revision.file_data.storage.exists(revision.file_data.name):
-                    revision.file_data.delete(save=False)
-                
-                # Delete revision record
-                revision.delete()
-                deleted_count += 1
-                
-            except Exception as e:
-                logger.error(f"Error deleting revision {revision.id}: {str(e)}")
+        try:
+            # One DELETE for every old revision; the pre_delete handler still
+            # removes each stored file
+            _, deleted = FileRevision.objects.filter(
+                id__in=[revision_id for revision_id, _ in old_revisions]
+            ).delete()
+        except Exception as e:
+            logger.error(f"Error deleting old revisions of document {document.id}: {str(e)}")
+            return 0, 0
         
-        return deleted_count
+        return deleted.get(FileRevision._meta.label, 0), sum(size for _, size in old_revisions)
 
 
 class FileMetadataExtractor:
@@ -189,9 +321,6 @@ class FileMetadataExtractor:
         """
         Extract comprehensive metadata from uploaded file
         """
-        import mimetypes
-        from datetime import datetime
-        
         metadata = {
             'filename': getattr(file_obj, 'name', 'unknown'),
             'size': getattr(file_obj, 'size', 0),
@@ -201,14 +330,17 @@ class FileMetadataExtractor:
         
         # Guess content type if not provided
         if not metadata['content_type']:
-            metadata['content_type'], _ = mimetypes.guess_type(metadata['filename'])
+            metadata['content_type'] = guess_content_type(metadata['filename'])
         
-        # Calculate file hash
+        # Calculate both file hashes from one read of the content
         try:
-            metadata['sha256_hash'] = FileHashManager.calculate_hash(file_obj, 'sha256')
+            hashes = FileHashManager.calculate_hashes(file_obj, ('md5', 'sha256'))
+            metadata['sha256_hash'] = hashes['sha256']
+            metadata['md5_hash'] = hashes['md5']
         except Exception as e:
             logger.warning(f"Could not calculate file hash: {str(e)}")
             metadata['sha256_hash'] = None
+            metadata['md5_hash'] = None
         
         # Extract file extension
         metadata['extension'] = os.path.splitext(metadata['filename'])[1].lower()
@@ -222,34 +354,23 @@ class FileMetadataExtractor:
         return metadata
     
     @staticmethod
+    @lru_cache(maxsize=4096)
     def _classify_file_type(extension, content_type):
         """
         Classify file into broad categories
+        
+        Categories are tried in FILE_CATEGORY_RULES order and the first one
+        matching either the extension or the content type wins.
         """
-        image_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.svg', '.webp'}
-        document_extensions = {'.pdf', '.doc', '.docx', '.txt', '.rtf', '.odt'}
-        spreadsheet_extensions = {'.xls', '.xlsx', '.csv', '.ods'}
-        presentation_extensions = {'.ppt', '.pptx', '.odp'}
-        archive_extensions = {'.zip', '.rar', '.7z', '.tar', '.gz', '.bz2'}
-        video_extensions = {'.mp4', '.avi', '.mov', '.wmv', '.flv', '.webm'}
-        audio_extensions = {'.mp3', '.wav', '.flac', '.ogg', '.m4a'}
-        
-        if extension in image_extensions or (content_type and content_type.startswith('image/')):
-            return 'image'
-        elif extension in document_extensions or (content_type and 'document' in content_type):
-            return 'document'
-        elif extension in spreadsheet_extensions or (content_type and 'spreadsheet' in content_type):
-            return 'spreadsheet'
-        elif extension in presentation_extensions or (content_type and 'presentation' in content_type):
-            return 'presentation'
-        elif extension in archive_extensions or (content_type and 'archive' in content_type):
-            return 'archive'
-        elif extension in video_extensions or (content_type and content_type.startswith('video/')):
-            return 'video'
-        elif extension in audio_extensions or (content_type and content_type.startswith('audio/')):
-            return 'audio'
-        else:
-            return 'other'
+        category = EXTENSION_CATEGORIES.get(extension)
+        if content_type:
+            # Only categories ranked before the extension's can still win
+            for rule_category, matches_content_type in FILE_CATEGORY_RULES:
+                if rule_category == category:
+                    break
+                if matches_content_type(content_type):
+                    return rule_category
+        return category or 'other'
 
 
 class StorageQuotaManager:
@@ -262,10 +383,7 @@ class StorageQuotaManager:
         """
         Check if user has enough quota for additional storage
         """
-        if not hasattr(user, 'profile'):
-            return True, 0  # No quota limits if no profile
-        
-        profile = user.profile
+        profile = get_or_create_profile(user)
         current_usage = profile.storage_used
         quota_limit = profile.storage_limit
         
@@ -280,22 +398,71 @@ class StorageQuotaManager:
         """
         Recalculate and update user's storage usage
         """
-        if not hasattr(user, 'profile'):
-            return 0
-        
-        total_usage = 0
+        profile = get_or_create_profile(user)
         
-        # Calculate total size from all user's file revisions
-        for document in user.file_documents.all():
-            for revision in document.revisions.all():
-                total_usage += revision.file_size
+        # Sum every revision's size in the database instead of loading rows
+        total_usage = FileRevision.objects.filter(
+            document__owner=user
+        ).aggregate(total=Sum('file_size'))['total'] or 0
         
         # Update profile
-        user.profile.storage_used = total_usage
-        user.profile.save(update_fields=['storage_used'])
+        profile.storage_used = total_usage
+        profile.save(update_fields=['storage_used'])
+        cache.delete(StorageQuotaManager.quota_cache_key(user))
         
         return total_usage
     
+    @staticmethod
+    def reserve_storage(user, size):
+        """
+        Add an upload's size to the user's usage if it fits the quota
+        
+        The check and the increment are one UPDATE; run it in the upload's
+        transaction so a failed upload gives the space back.
+        """
+        get_or_create_profile(user)
+        reserved = UserProfile.try_reserve(user.id, size)
+        if reserved:
+            # update() skips post_save, so drop the cached responses here
+            cache.delete_many([
+                StorageQuotaManager.quota_cache_key(user), profile_cache_key(user.id)
+            ])
+        return reserved
+    
+    @staticmethod
+    def release_storage(user, size):
+        """
+        Subtract freed bytes from user's storage usage without recounting
+        """
+        if size <= 0:
+            return
+        
+        profile = get_or_create_profile(user)
+        # One UPDATE, so concurrent uploads' usage changes aren't overwritten
+        UserProfile.objects.filter(pk=profile.pk).update(
+            storage_used=Greatest(F('storage_used') - size, 0)
+        )
+        profile.refresh_from_db(fields=['storage_used'])
+        # update() skips post_save, so drop the cached responses here
+        cache.delete_many([
+            StorageQuotaManager.quota_cache_key(user), profile_cache_key(user.id)
+        ])
+    
+    @staticmethod
+    def quota_cache_key(user):
+        return f"quota:{user.id}"
+    
+    @staticmethod
+    def get_cached_quota_status(user):
+        """
+        Get quota status, cached briefly and cleared when usage is recalculated
+        """
+        return cache.get_or_set(
+            StorageQuotaManager.quota_cache_key(user),
+            lambda: StorageQuotaManager.get_quota_status(user),
+            QUOTA_CACHE_TIMEOUT
+        )
+    
     @staticmethod
     def get_quota_status(user):
         """
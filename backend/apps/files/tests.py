@@ -1,17 +1,65 @@
-from django.test import TestCase
-from django.contrib.auth.models import User
-from django.urls import reverse
+from django.test import RequestFactory, TestCase, override_settings
+from django.contrib.admin.sites import site
+from django.contrib.auth.models import AnonymousUser, User
+from django.urls import resolve, reverse
+from django.core.cache import cache
+from django.core.files import File
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import DataError, IntegrityError
+from django.http import HttpResponse
+from django.utils import timezone
+from rest_framework.exceptions import PermissionDenied, ValidationError
 from rest_framework.test import APITestCase, APIClient
 from rest_framework import status
 from rest_framework_simplejwt.tokens import RefreshToken
-import tempfile
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+import hashlib
+import io
+import json
+import mimetypes
+import mmap
+import shutil
 import os
+import tempfile
+import time
+import urllib.parse
+from apps.authentication.models import UserProfile
+from .api_extensions import format_file_size
+from .middleware import (
+    AuditLogQueue, FileAccessAuditMiddleware, FileDownloadSecurityMiddleware,
+    FileSecurityMiddleware, RATE_LIMIT_WINDOW, ScopedFileAccessAuditMiddleware,
+    get_user_context, logger as middleware_logger
+)
 from .models import FileDocument, FileRevision
+from .models_extensions import (
+    AccessLogBuffer, FileAccessLog, FileMetadata, access_log_buffer,
+    flush_access_logs_at_exit, get_file_statistics
+)
+from .permissions import (
+    FileAccessMiddleware, FileAccessPermission, FileTypePermission, FileViewPermission,
+    IsOwnerOrReadOnly, StorageQuotaPermission, bulk_check_owner, log_file_access,
+    require_file_owner, user_can_upload_file
+)
 from .serializers import (
     FileDocumentSerializer, FileRevisionSerializer, 
     FileUploadSerializer, FileDocumentDetailSerializer
 )
+from .storage import (
+    FileHashManager, FileMetadataExtractor, HASH_ALGORITHMS, MMAP_HASH_THRESHOLD,
+    RevisionManager, SecureFileStorage, StorageQuotaManager
+)
+from .utils import get_client_ip, guess_content_type, increment_cache_counter
+
+
+def make_request(user, method='GET', data=None):
+    """Build a request for calling permissions and serializers directly"""
+    request = RequestFactory().generic(method, '/')
+    request.user = user
+    request.data = data or {}
+    return request
 
 
 class FileDocumentModelTest(TestCase):
@@ -111,6 +159,22 @@ class FileRevisionModelTest(TestCase):
         self.assertEqual(rev1.revision_number, 0)
         self.assertEqual(rev2.revision_number, 1)
     
+    def test_revision_number_comes_from_document_counter(self):
+        """Test that numbering follows the document's high-water mark"""
+        FileRevision.objects.create(document=self.document, file_data=self.test_file)
+        rev2 = FileRevision.objects.create(
+            document=self.document,
+            file_data=SimpleUploadedFile("test2.txt", b"content2")
+        )
+        rev2.delete()
+        
+        rev3 = FileRevision.objects.create(
+            document=self.document,
+            file_data=SimpleUploadedFile("test3.txt", b"content3")
+        )
+        
+        self.assertEqual(rev3.revision_number, 2)
+    
     def test_auto_set_file_size(self):
         """Test that file size is auto-set if not provided"""
         revision = FileRevision.objects.create(
@@ -130,7 +194,20 @@ class FileRevisionModelTest(TestCase):
         
         # Note: The extension comes from the stored file path
         self.assertTrue(revision.file_extension.endswith('.pdf'))
-    
+
+    def test_extension_stored_on_save(self):
+        """Test that the lowercased extension is persisted on save"""
+        revision = FileRevision.objects.create(
+            document=self.document,
+            file_data=SimpleUploadedFile("REPORT.PDF", b"content"),
+            file_size=7
+        )
+
+        self.assertEqual(revision.extension, '.pdf')
+        self.assertTrue(
+            FileRevision.objects.filter(pk=revision.pk, extension='.pdf').exists()
+        )
+
     def test_formatted_file_size_property(self):
         """Test formatted_file_size property"""
         test_cases = [
@@ -172,6 +249,66 @@ class FileRevisionModelTest(TestCase):
         revision.save()
         self.assertEqual(revision.formatted_file_size, "0 bytes")
     
+    def test_revision_counters_track_saves_and_deletes(self):
+        """Test that the document's revision counters follow its revisions"""
+        FileRevision.objects.create(document=self.document, file_data=self.test_file)
+        latest = FileRevision.objects.create(
+            document=self.document,
+            file_data=SimpleUploadedFile("test2.txt", b"content2")
+        )
+        self.assertEqual(self.document.get_revision_count(), 2)
+        
+        self.document.refresh_from_db()
+        self.assertEqual(self.document.revision_count, 2)
+        self.assertEqual(self.document.last_revision_number, 1)
+        
+        latest.delete()
+        self.document.refresh_from_db()
+        self.assertEqual(self.document.revision_count, 1)
+        self.assertEqual(self.document.last_revision_number, 1)
+
+    def test_latest_for_documents(self):
+        """Test latest_for_documents fetches every latest revision in one query"""
+        other = FileDocument.objects.create(
+            url='/documents/other.txt',
+            name='other.txt',
+            owner=self.user
+        )
+        empty = FileDocument.objects.create(
+            url='/documents/empty.txt',
+            name='empty.txt',
+            owner=self.user
+        )
+        FileRevision.objects.create(document=self.document, file_data=self.test_file)
+        latest = FileRevision.objects.create(
+            document=self.document,
+            file_data=SimpleUploadedFile("test2.txt", b"content2")
+        )
+        other_latest = FileRevision.objects.create(
+            document=other,
+            file_data=SimpleUploadedFile("other.txt", b"other")
+        )
+
+        with self.assertNumQueries(1):
+            revisions = list(FileRevision.enhanced_objects.latest_for_documents(
+                [self.document, other, empty]
+            ))
+
+        self.assertCountEqual(revisions, [latest, other_latest])
+
+    def test_formatted_file_size_unit_boundaries(self):
+        """Test formatted_file_size around unit boundaries without storing files"""
+        test_cases = [
+            (1023, "1023.0 bytes"),
+            (1024, "1.0 KB"),
+            (2 * 1024 ** 4, "2.0 TB"),
+            (3 * 1024 ** 5, "3072.0 TB"),
+        ]
+
+        for size, expected in test_cases:
+            revision = FileRevision(document=self.document, file_size=size)
+            self.assertEqual(revision.formatted_file_size, expected)
+
     def test_unique_together_constraint(self):
         """Test that document and revision_number combination must be unique"""
         FileRevision.objects.create(
@@ -287,6 +424,7 @@ class FileAPITest(APITestCase):
             email='other@example.com',
             password='otherpass123'
         )
+        UserProfile.create_for_users([self.user, self.other_user])
         
         # Get JWT token for authentication
         refresh = RefreshToken.for_user(self.user)
@@ -301,6 +439,10 @@ class FileAPITest(APITestCase):
             content_type="text/plain"
         )
     
+    def tearDown(self):
+        # Write queued access logs while this test's documents still exist
+        access_log_buffer.flush()
+    
     def authenticate(self, user=None):
         """Helper method to authenticate a user"""
         if user is None:
@@ -330,6 +472,56 @@ class FileAPITest(APITestCase):
             url='/documents/test.txt'
         ).exists())
     
+    def test_large_file_upload_round_trip(self):
+        """Test uploads above the in-memory limit spool to disk and stream back"""
+        self.authenticate()
+        content = b'0123456789abcdef' * (16 * 1024)
+        
+        response = self.client.post(self.files_url, {
+            'url': '/documents/large.txt',
+            'name': 'large.txt',
+            'file': SimpleUploadedFile('large.txt', content)
+        }, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        
+        encoded_url = urllib.parse.quote('/documents/large.txt', safe='')
+        response = self.client.get(f'/api/files/{encoded_url}/', {'download': 'true'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertEqual(b''.join(response.streaming_content), content)
+    
+    def test_upload_reserves_quota_atomically(self):
+        """Test the reservation rejects uploads that passed the early quota check"""
+        self.authenticate()
+        UserProfile.objects.filter(user=self.user).update(storage_limit=30, storage_used=15)
+        
+        # As if a concurrent upload used the space after the permission check
+        with mock.patch.object(StorageQuotaPermission, 'has_permission', return_value=True):
+            response = self.client.post(self.files_url, {
+                'url': '/documents/test.txt',
+                'name': 'test.txt',
+                'file': self.test_file
+            }, format='multipart')
+        
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('Not enough storage space', response.data['error'])
+        self.assertFalse(FileDocument.objects.filter(owner=self.user).exists())
+        self.assertEqual(UserProfile.objects.get(user=self.user).storage_used, 15)
+    
+    def test_failed_upload_releases_reservation(self):
+        """Test a reservation is rolled back with the upload that made it"""
+        self.authenticate()
+        
+        with mock.patch('apps.files.views.create_file_document', side_effect=RuntimeError):
+            response = self.client.post(self.files_url, {
+                'url': '/documents/test.txt',
+                'name': 'test.txt',
+                'file': self.test_file
+            }, format='multipart')
+        
+        self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self.assertEqual(UserProfile.objects.get(user=self.user).storage_used, 0)
+    
     def test_file_upload_unauthenticated(self):
         """Test file upload without authentication"""
         data = {
@@ -340,6 +532,16 @@ class FileAPITest(APITestCase):
         response = self.client.post(self.files_url, data, format='multipart')
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
     
+    def test_owner_endpoints_unauthenticated(self):
+        """Test that endpoints without IsAuthenticated still reject anonymous users"""
+        response = self.client.get('/api/files/%2Fdocuments%2Ftest.txt/')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        
+        response = self.client.post(
+            '/api/files/bulk-delete/', {'urls': ['/documents/test.txt']}, format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+    
     def test_file_list_authenticated(self):
         """Test file listing with authentication"""
         self.authenticate()
@@ -356,6 +558,37 @@ class FileAPITest(APITestCase):
         self.assertEqual(len(response.data['results']), 1)
         self.assertEqual(response.data['results'][0]['id'], document.id)
     
+    def test_file_list_prefetches_latest_revisions(self):
+        """Test that listing does not query each document's latest revision"""
+        self.authenticate()
+        
+        def add_document(i):
+            document = FileDocument.objects.create(
+                url=f'/documents/test{i}.txt',
+                name=f'test{i}.txt',
+                owner=self.user
+            )
+            for content in (b'v0', b'v1'):
+                FileRevision.objects.create(
+                    document=document,
+                    file_data=SimpleUploadedFile(f'test{i}.txt', content)
+                )
+        
+        # Authentication, the page count, the documents and their revisions
+        add_document(0)
+        with self.assertNumQueries(4):
+            self.client.get(self.files_url)
+        
+        add_document(1)
+        add_document(2)
+        with self.assertNumQueries(4):
+            response = self.client.get(self.files_url)
+        
+        self.assertEqual(
+            [doc['latest_revision']['revision_number'] for doc in response.data['results']],
+            [1, 1, 1]
+        )
+    
     def test_file_list_user_isolation(self):
         """Test that users only see their own files"""
         self.authenticate()
@@ -551,7 +784,7 @@ class FileAPITest(APITestCase):
             'revision': rev1.revision_number
         })
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(response.content, b"version 1")
+        self.assertEqual(b''.join(response.streaming_content), b"version 1")
     
     def test_bulk_delete(self):
         """Test bulk delete operation"""
@@ -583,6 +816,23 @@ class FileAPITest(APITestCase):
         self.assertFalse(FileDocument.objects.filter(id=doc1.id).exists())
         self.assertFalse(FileDocument.objects.filter(id=doc2.id).exists())
     
+    def test_bulk_delete_rejects_unowned_urls(self):
+        """Test bulk delete refuses URLs the user does not own"""
+        self.authenticate()
+        
+        FileDocument.objects.create(
+            url='/documents/mine.txt',
+            name='mine.txt',
+            owner=self.user
+        )
+        
+        response = self.client.post('/api/files/bulk-delete/', {
+            'urls': ['/documents/mine.txt', '/documents/missing.txt']
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertIn('/documents/missing.txt', str(response.data))
+        self.assertTrue(FileDocument.objects.filter(url='/documents/mine.txt').exists())
+    
     def test_file_stats(self):
         """Test file statistics endpoint"""
         self.authenticate()
@@ -614,6 +864,7 @@ class FileAPITest(APITestCase):
         
         self.assertEqual(response.data['total_documents'], 1)
         self.assertEqual(response.data['total_revisions'], 1)
+        self.assertEqual(response.data['file_types'], {'txt': 1})
 
 
 class FileSerializersTest(TestCase):
@@ -639,6 +890,8 @@ class FileSerializersTest(TestCase):
             '/documents/test.txt/',  # Trailing slash
             '/documents/../test.txt',  # Path traversal
             '/documents/test<>.txt',  # Invalid characters
+            '/documents//test.txt',  # Empty segment
+            '/documents/te*st.txt',  # Wildcard
         ]
         
         for invalid_url in invalid_urls:
@@ -653,6 +906,53 @@ class FileSerializersTest(TestCase):
             self.assertFalse(serializer.is_valid())
             self.assertIn('url', serializer.errors)
     
+    def test_file_document_serializer_duplicate_url(self):
+        """Test duplicate URLs are reported by the unique constraint"""
+        serializer = FileDocumentSerializer(
+            data={'url': '/documents/test.txt', 'name': 'test.txt'},
+            context={'request': make_request(self.user)}
+        )
+        # No lookup query during validation for new documents
+        with self.assertNumQueries(0):
+            self.assertTrue(serializer.is_valid())
+        
+        with self.assertRaises(ValidationError) as ctx:
+            serializer.save()
+        self.assertIn('url', ctx.exception.detail)
+        self.assertEqual(FileDocument.objects.filter(owner=self.user).count(), 1)
+    
+    def test_file_document_serializer_other_integrity_errors(self):
+        """Test constraint failures other than a duplicate URL are not masked"""
+        serializer = FileDocumentSerializer(
+            data={'url': '/documents/other.txt', 'name': 'other.txt'},
+            context={'request': make_request(self.user)}
+        )
+        self.assertTrue(serializer.is_valid())
+        
+        error = IntegrityError('NOT NULL constraint failed: files_filedocument.name')
+        with mock.patch('rest_framework.serializers.ModelSerializer.create', side_effect=error):
+            with self.assertRaises(IntegrityError):
+                serializer.save()
+    
+    def test_detail_serializer_serializes_revisions_once(self):
+        """Test the detail serializer loads revisions a single time"""
+        for content in (b'v0', b'v1'):
+            FileRevision.objects.create(
+                document=self.document,
+                file_data=SimpleUploadedFile('test.txt', content)
+            )
+        
+        with self.assertNumQueries(2):
+            # The latest revision and the revision list
+            data = FileDocumentDetailSerializer(self.document).data
+        self.assertEqual([rev['revision_number'] for rev in data['revisions']], [1, 0])
+        
+        with self.assertNumQueries(1):
+            data = FileDocumentDetailSerializer(
+                self.document, context={'exclude_revisions': True}
+            ).data
+        self.assertNotIn('revisions', data)
+    
     def test_file_revision_serializer_file_validation(self):
         """Test FileRevisionSerializer file validation"""
         # Test empty file
@@ -679,4 +979,1106 @@ class FileSerializersTest(TestCase):
         
         data = serializer.data
         self.assertIn('revisions', data)
-        self.assertEqual(len(data['revisions']), 1)
\ No newline at end of file
+        self.assertEqual(len(data['revisions']), 1)
+
+class FileExtensionsAPITest(APITestCase):
+    """Test cases for extended file management API endpoints"""
+    
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='testuser',
+            email='test@example.com',
+            password='testpass123'
+        )
+        UserProfile.create_for_users([self.user])
+        cache.clear()
+        
+        refresh = RefreshToken.for_user(self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {refresh.access_token}')
+    
+    def create_document(self, name, revisions=1, content=None):
+        """Helper method to create a document with revisions"""
+        document = FileDocument.objects.create(
+            url=f'/documents/{name}',
+            name=name,
+            owner=self.user
+        )
+        # Metadata and quota updates run once the revision is committed
+        with self.captureOnCommitCallbacks(execute=True):
+            for i in range(revisions):
+                FileRevision.objects.create(
+                    document=document,
+                    file_data=SimpleUploadedFile(name, content or f"{name} v{i}".encode())
+                )
+        return document
+    
+    def test_file_statistics_counts(self):
+        """Test that file statistics count documents, revisions and categories"""
+        self.create_document('notes.txt', revisions=2)
+        self.create_document('photo.png')
+        FileDocument.objects.create(url='/documents/empty', name='empty', owner=self.user)
+        
+        stats = get_file_statistics(self.user)
+        
+        self.assertEqual(stats['total_documents'], 3)
+        self.assertEqual(stats['total_revisions'], 3)
+        self.assertEqual(stats['recent_uploads'], 3)
+        self.assertEqual(stats['categories'], {'document': 2, 'image': 1})
+    
+    def test_by_category_returns_each_document_once(self):
+        """Test that by_category matches documents without duplicates"""
+        text_document = self.create_document('notes.txt', revisions=2)
+        self.create_document('photo.png')
+        
+        documents = list(FileDocument.enhanced_objects.by_category(self.user, 'document'))
+        
+        self.assertEqual(documents, [text_document])
+    
+    def test_metadata_is_created_after_commit(self):
+        """Test that revision metadata is only extracted once the upload commits"""
+        document = FileDocument.objects.create(
+            url='/documents/test.txt', name='test.txt', owner=self.user
+        )
+        with self.captureOnCommitCallbacks() as callbacks:
+            revision = FileRevision.objects.create(
+                document=document,
+                file_data=SimpleUploadedFile('test.txt', b'test content')
+            )
+        self.assertFalse(FileMetadata.objects.filter(revision=revision).exists())
+        
+        for callback in callbacks:
+            callback()
+        metadata = FileMetadata.objects.get(revision=revision)
+        self.assertTrue(metadata.is_processed)
+        self.assertEqual(metadata.md5_hex, hashlib.md5(b'test content').hexdigest())
+        self.assertEqual(UserProfile.objects.get(user=self.user).storage_used, 12)
+    
+    def test_file_metadata_view(self):
+        """Test file metadata includes per-revision metadata"""
+        document = self.create_document('test.txt', revisions=2)
+        
+        response = self.client.get(f'/api/files/{document.id}/metadata/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['revisions']), 2)
+        for revision in response.data['revisions']:
+            self.assertEqual(len(revision['sha256_hash']), 64)
+    
+    def test_file_metadata_view_query_count(self):
+        """Test that metadata lookups don't scale with revision count"""
+        small = self.create_document('small.txt', revisions=1)
+        large = self.create_document('large.txt', revisions=4)
+        
+        # Authentication, the document and its revisions with their metadata
+        for document in (small, large):
+            with self.assertNumQueries(3):
+                response = self.client.get(f'/api/files/{document.id}/metadata/')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+    
+    def test_verify_file_integrity(self):
+        """Test that stored hashes are checked against the file on disk"""
+        document = self.create_document('test.txt', content=b'test content')
+        
+        response = self.client.post(f'/api/files/{document.id}/verify/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.data['integrity_valid'])
+        self.assertEqual(response.data['verified_algorithms'], ['md5', 'sha256'])
+        
+        revision = document.revisions.get()
+        with open(revision.file_data.path, 'wb') as f:
+            f.write(b'tampered content')
+        
+        response = self.client.post(f'/api/files/{document.id}/verify/')
+        self.assertFalse(response.data['integrity_valid'])
+    
+    def test_cleanup_user_files(self):
+        """Test that cleanup releases the freed bytes from storage usage"""
+        document = self.create_document('test.txt', revisions=3)
+        
+        response = self.client.post('/api/files/cleanup/', {'keep_revisions': 1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['cleaned_count'], 2)
+        self.assertEqual(response.data['bytes_freed'], 22)
+        self.assertEqual(response.data['storage']['usage'], 11)
+        self.assertEqual(document.revisions.count(), 1)
+        self.assertEqual(UserProfile.objects.get(user=self.user).storage_used, 11)
+    
+    def test_get_next_revision_number(self):
+        """Test the next revision number follows the highest existing one"""
+        document = FileDocument.objects.create(url='/documents/new.txt', name='new.txt', owner=self.user)
+        with self.assertNumQueries(1):
+            self.assertEqual(RevisionManager.get_next_revision_number(document), 0)
+        
+        document = self.create_document('test.txt', revisions=3)
+        with self.assertNumQueries(1):
+            self.assertEqual(RevisionManager.get_next_revision_number(document), 3)
+    
+    def test_cleanup_old_revisions_deletes_in_bulk(self):
+        """Test old revisions are removed with their files and counters"""
+        document = self.create_document('test.txt', revisions=4)
+        old_paths = [
+            revision.file_data.path
+            for revision in document.revisions.order_by('-revision_number')[2:]
+        ]
+        
+        self.assertEqual(RevisionManager.cleanup_old_revisions(document, keep_count=2), (2, 22))
+        self.assertEqual(RevisionManager.cleanup_old_revisions(document, keep_count=2), (0, 0))
+        self.assertEqual(
+            list(document.revisions.values_list('revision_number', flat=True)), [3, 2]
+        )
+        self.assertFalse(any(os.path.exists(path) for path in old_paths))
+        document.refresh_from_db()
+        self.assertEqual(document.revision_count, 2)
+    
+    def test_file_duplicates_view(self):
+        """Test that files sharing a hash are grouped as duplicates"""
+        self.create_document('a.txt', content=b'same content')
+        self.create_document('b.txt', content=b'same content')
+        self.create_document('c.txt', content=b'unique content')
+        
+        response = self.client.get('/api/files/duplicates/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['duplicate_groups'], 1)
+        group = response.data['duplicates'][0]
+        self.assertEqual(group['hash'], hashlib.sha256(b'same content').hexdigest())
+        self.assertEqual(group['file_count'], 2)
+        self.assertEqual(
+            {f['document_name'] for f in group['files']}, {'a.txt', 'b.txt'}
+        )
+        self.assertEqual(response.data['potential_savings'], len(b'same content'))
+        
+        # Authentication, the grouped hash query and the duplicate rows
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/files/duplicates/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+    
+    def test_file_duplicates_view_savings(self):
+        """Test groups are ranked by size and savings summed per group"""
+        for name in ['a1.txt', 'a2.txt', 'a3.txt']:
+            self.create_document(name, content=b'0123456789')
+        for name in ['b1.txt', 'b2.txt']:
+            self.create_document(name, content=b'abcd')
+        
+        response = self.client.get('/api/files/duplicates/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [(group['file_count'], group['total_size']) for group in response.data['duplicates']],
+            [(3, 30), (2, 8)]
+        )
+        self.assertEqual(response.data['potential_savings'], 2 * 10 + 4)
+    
+    def test_storage_breakdown_monthly_uploads(self):
+        """Test monthly uploads cover the last twelve calendar months"""
+        self.create_document('a.txt', revisions=2)
+        self.create_document('b.txt')
+        
+        response = self.client.get('/api/files/storage-breakdown/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        monthly = response.data['monthly_uploads']
+        self.assertEqual(len(monthly), 12)
+        self.assertEqual(monthly[-1]['month'], timezone.localtime().strftime('%Y-%m'))
+        self.assertEqual(monthly[-1]['uploads'], 3)
+        self.assertEqual(sum(item['uploads'] for item in monthly), 3)
+    
+    def test_file_analytics_view_is_cached(self):
+        """Test that analytics are cached until the user's files change"""
+        self.create_document('a.txt')
+        
+        response = self.client.get('/api/files/analytics/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['statistics']['total_documents'], 1)
+        
+        # Only the authentication lookup hits the database
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/files/analytics/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        
+        self.create_document('b.txt')
+        response = self.client.get('/api/files/analytics/')
+        self.assertEqual(response.data['statistics']['total_documents'], 2)
+    
+    def test_file_analytics_popular_files(self):
+        """Test popular files only count accesses inside the window"""
+        recent = self.create_document('recent.txt')
+        old = self.create_document('old.txt')
+        for accessed_at in [timezone.now(), timezone.now() - timedelta(days=60)]:
+            FileAccessLog.objects.create(
+                document=recent, user=self.user,
+                access_type='view', accessed_at=accessed_at
+            )
+        FileAccessLog.objects.create(
+            document=old, user=self.user, access_type='view',
+            accessed_at=timezone.now() - timedelta(days=60)
+        )
+        
+        response = self.client.get('/api/files/analytics/?days=30')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [(f['name'], f['access_count']) for f in response.data['popular_files']],
+            [('recent.txt', 1)]
+        )
+
+
+class FileAdminTest(TestCase):
+    """Test cases for the file admin classes"""
+    
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            email='test@example.com',
+            password='testpass123'
+        )
+        self.document = FileDocument.objects.create(
+            url='/documents/test.txt',
+            name='test.txt',
+            owner=self.user
+        )
+        for i in range(2):
+            FileRevision.objects.create(
+                document=self.document,
+                file_data=SimpleUploadedFile('test.txt', f'v{i}'.encode())
+            )
+        self.model_admin = site._registry[FileDocument]
+    
+    def test_revision_count_is_denormalized(self):
+        """Test that revision counts come from the document row"""
+        request = make_request(self.user)
+        document = self.model_admin.get_queryset(request).get(pk=self.document.pk)
+        
+        with self.assertNumQueries(0):
+            self.assertEqual(self.model_admin.get_revision_count(document), 2)
+
+
+class CleanupFilesCommandTest(TestCase):
+    """Test cases for the cleanup_files management command"""
+    
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = self.settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        
+        self.user = User.objects.create_user(
+            username='testuser',
+            email='test@example.com',
+            password='testpass123'
+        )
+        UserProfile.create_for_users([self.user])
+        self.document = FileDocument.objects.create(
+            url='/documents/test.txt',
+            name='test.txt',
+            owner=self.user
+        )
+        self.revision = FileRevision.objects.create(
+            document=self.document,
+            file_data=SimpleUploadedFile('test.txt', b'test content')
+        )
+    
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+    
+    def run_command(self, *args):
+        """Helper method to run the command and capture its output"""
+        out = StringIO()
+        call_command('cleanup_files', *args, stdout=out)
+        return out.getvalue()
+    
+    def test_cleanup_orphaned_files(self):
+        """Test that only files without a revision are deleted"""
+        orphan_path = os.path.join(self.media_root, 'uploads', 'orphan.txt')
+        with open(orphan_path, 'wb') as f:
+            f.write(b'orphaned')
+        
+        # One query counts users, one loads every referenced path
+        with self.assertNumQueries(2):
+            output = self.run_command('--cleanup-orphaned')
+        
+        self.assertIn('Cleaned up 1 orphaned files', output)
+        self.assertFalse(os.path.exists(orphan_path))
+        self.assertTrue(os.path.exists(self.revision.file_data.path))
+    
+    def test_cleanup_revisions_dry_run(self):
+        """Test that the dry run counts surplus revisions without deleting"""
+        for i in range(3):
+            FileRevision.objects.create(
+                document=self.document,
+                file_data=SimpleUploadedFile('test.txt', f'v{i}'.encode())
+            )
+        
+        output = self.run_command('--cleanup-revisions', '--keep-revisions', '2', '--dry-run')
+        self.assertIn('testuser: would clean 2 revisions', output)
+        self.assertEqual(self.document.revisions.count(), 4)
+    
+    def test_update_quotas(self):
+        """Test that quotas are recalculated from revision sizes"""
+        UserProfile.objects.filter(user=self.user).update(storage_used=0)
+        
+        output = self.run_command('--update-quotas', '--dry-run')
+        self.assertIn('would update 0 -> 12 bytes', output)
+        self.assertEqual(UserProfile.objects.get(user=self.user).storage_used, 0)
+        
+        output = self.run_command('--update-quotas')
+        self.assertIn('0 -> 12 bytes', output)
+        self.assertEqual(UserProfile.objects.get(user=self.user).storage_used, 12)
+    
+    def test_process_metadata(self):
+        """Test that missing metadata is created and processed"""
+        FileMetadata.objects.filter(revision=self.revision).delete()
+        
+        output = self.run_command('--process-metadata')
+        self.assertIn('Processed metadata for 1 revisions', output)
+        metadata = FileMetadata.objects.get(revision=self.revision)
+        self.assertTrue(metadata.is_processed)
+        self.assertEqual(len(metadata.sha256_hash), 32)
+    
+    def test_process_metadata_in_parallel(self):
+        """Test that files are hashed by several workers with matching digests"""
+        for index in range(3):
+            FileRevision.objects.create(
+                document=self.document,
+                file_data=SimpleUploadedFile('test.txt', f'content {index}'.encode())
+            )
+        FileMetadata.objects.all().delete()
+        
+        output = self.run_command('--process-metadata', '--workers', '3')
+        self.assertIn('Processed metadata for 4 revisions', output)
+        for revision in FileRevision.objects.filter(document=self.document):
+            with revision.file_data.open('rb') as f:
+                content = f.read()
+            self.assertEqual(revision.metadata.sha256_hex, hashlib.sha256(content).hexdigest())
+
+
+class AccessLogBufferTest(TestCase):
+    """Test cases for batched access logging"""
+    
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            email='test@example.com',
+            password='testpass123'
+        )
+        self.document = FileDocument.objects.create(
+            url='/documents/test.txt',
+            name='test.txt',
+            owner=self.user
+        )
+    
+    def test_flushes_full_batches(self):
+        """Test that rows are only inserted once the batch is full"""
+        buffer = AccessLogBuffer(batch_size=2, flush_interval=3600)
+        buffer.add(document=self.document, user=self.user, access_type='view')
+        buffer.flush_if_due()
+        self.assertFalse(FileAccessLog.objects.exists())
+        
+        buffer.add(document=self.document, user=self.user, access_type='download')
+        # One INSERT between SAVEPOINT and RELEASE
+        with self.assertNumQueries(3):
+            buffer.flush_if_due()
+        self.assertEqual(FileAccessLog.objects.filter(document=self.document).count(), 2)
+    
+    def test_keeps_access_time(self):
+        """Test that buffered rows keep the time they were queued"""
+        accessed_at = timezone.now() - timedelta(minutes=5)
+        buffer = AccessLogBuffer()
+        buffer.add(
+            document=self.document, user=self.user,
+            access_type='view', accessed_at=accessed_at
+        )
+        self.assertEqual(buffer.flush(), 1)
+        self.assertEqual(FileAccessLog.objects.get().accessed_at, accessed_at)
+    
+    def test_drops_rows_beyond_max_pending(self):
+        """Test that a full buffer drops new rows instead of growing"""
+        buffer = AccessLogBuffer(max_pending=1)
+        self.assertTrue(buffer.add(document=self.document, user=self.user, access_type='view'))
+        self.assertFalse(buffer.add(document=self.document, user=self.user, access_type='view'))
+        self.assertEqual(len(buffer._entries), 1)
+    
+    def test_background_flush(self):
+        """Test that a due batch is handed to a flusher thread"""
+        buffer = AccessLogBuffer(batch_size=1, background=True)
+        buffer.add(document=self.document, user=self.user, access_type='view')
+        with mock.patch.object(buffer, 'flush') as flush, \
+                mock.patch('apps.files.models_extensions.connection'):
+            buffer.flush_if_due()
+            buffer._flusher.join(timeout=5)
+        
+        flush.assert_called_once_with()
+    
+    def test_retry_drops_rows_for_deleted_objects(self):
+        """Test that a failed batch is retried without orphaned rows"""
+        other_user = User.objects.create_user(username='otheruser', password='testpass123')
+        buffer = AccessLogBuffer()
+        buffer.add(document=self.document, user=self.user, access_type='view')
+        buffer.add(document=self.document, user=other_user, access_type='view')
+        other_user.delete()
+        
+        with mock.patch.object(
+            FileAccessLog.objects, 'bulk_create',
+            side_effect=IntegrityError('FOREIGN KEY constraint failed')
+        ):
+            self.assertEqual(buffer.flush(), 1)
+        
+        self.assertEqual(list(FileAccessLog.objects.values_list('user_id', flat=True)), [self.user.id])
+    
+    def test_bad_row_does_not_drop_batch(self):
+        """Test that rows the database rejects are skipped one at a time"""
+        buffer = AccessLogBuffer()
+        buffer.add(document=self.document, user=self.user, access_type='view', ip_address='10.0.0.1')
+        buffer.add(document=self.document, user=self.user, access_type='view', ip_address='bad')
+        buffer.add(document=self.document, user=self.user, access_type='download')
+        
+        save = FileAccessLog.save
+        
+        def reject_bad_address(entry, *args, **kwargs):
+            if entry.ip_address == 'bad':
+                raise DataError('invalid input syntax for type inet')
+            return save(entry, *args, **kwargs)
+        
+        with mock.patch.object(
+            FileAccessLog.objects, 'bulk_create', side_effect=DataError('invalid input syntax for type inet')
+        ), mock.patch.object(FileAccessLog, 'save', reject_bad_address), \
+                self.assertLogs('apps.files.models_extensions', level='ERROR'):
+            self.assertEqual(buffer.flush(), 2)
+        
+        self.assertEqual(
+            sorted(FileAccessLog.objects.values_list('access_type', flat=True)), ['download', 'view']
+        )
+    
+    def test_failed_retry_is_logged_not_raised(self):
+        """Test that a batch whose rows all fail is logged and discarded"""
+        buffer = AccessLogBuffer()
+        buffer.add(document=self.document, user=self.user, access_type='view')
+        with mock.patch.object(
+            FileAccessLog.objects, 'bulk_create', side_effect=IntegrityError('constraint failed')
+        ), mock.patch.object(
+            FileAccessLog, 'save', side_effect=IntegrityError('constraint failed')
+        ), self.assertLogs('apps.files.models_extensions', level='ERROR'):
+            self.assertEqual(buffer.flush(), 0)
+        self.assertEqual(buffer._entries, [])
+    
+    def test_flushes_at_exit(self):
+        """Test that the shared buffer is written by the exit hook"""
+        access_log_buffer.add(document=self.document, user=self.user, access_type='view')
+        flush_access_logs_at_exit()
+        self.assertEqual(FileAccessLog.objects.filter(document=self.document).count(), 1)
+
+
+class FormatFileSizeTest(TestCase):
+    """Test cases for format_file_size"""
+    
+    def test_units(self):
+        """Test sizes are scaled to the largest whole unit"""
+        self.assertEqual(format_file_size(0), "0 bytes")
+        self.assertEqual(format_file_size(1023), "1023.0 bytes")
+        self.assertEqual(format_file_size(1024), "1.0 KB")
+        self.assertEqual(format_file_size(1536 * 1024), "1.5 MB")
+        self.assertEqual(format_file_size(5 * 1024 ** 3), "5.0 GB")
+        self.assertEqual(format_file_size(2048 * 1024 ** 4), "2048.0 TB")
+
+
+class GuessContentTypeTest(TestCase):
+    """Test cases for guess_content_type"""
+    
+    def test_matches_mimetypes(self):
+        """Test cached guesses agree with mimetypes.guess_type"""
+        for filename in ('report.pdf', 'REPORT.PDF', 'photo.jpeg', 'archive.tar.gz',
+                         'notes', 'data.unknownext'):
+            self.assertEqual(
+                guess_content_type(filename),
+                mimetypes.guess_type(filename.lower())[0],
+                filename
+            )
+
+
+class SecureFileStorageTest(TestCase):
+    """Test cases for SecureFileStorage"""
+    
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.storage = SecureFileStorage(location=self.location)
+        for name in ('report.txt', 'report_1.txt', 'report_2.txt'):
+            with open(os.path.join(self.location, name), 'wb') as f:
+                f.write(b'content')
+    
+    def tearDown(self):
+        shutil.rmtree(self.location, ignore_errors=True)
+    
+    def test_valid_name_replaces_unsafe_characters(self):
+        """Test unsafe characters are replaced and directories dropped"""
+        self.assertEqual(
+            self.storage.get_valid_name('dir/we:ird*na?me"<x>|y;\\z.txt'),
+            'we_ird_na_me__x__y__z.txt'
+        )
+        self.assertEqual(self.storage.get_valid_name('.hidden'), 'unnamed_file.hidden')
+    
+    def test_available_name_lists_directory_once(self):
+        """Test collisions are resolved against one directory listing"""
+        with mock.patch.object(self.storage, 'exists', wraps=self.storage.exists) as exists:
+            self.assertEqual(self.storage.get_available_name('report.txt'), 'report_3.txt')
+        self.assertEqual(exists.call_count, 1)
+        self.assertEqual(self.storage.get_available_name('other.txt'), 'other.txt')
+    
+    def test_available_name_falls_back_to_random_suffix(self):
+        """Test heavily reused names get a random suffix"""
+        with mock.patch('apps.files.storage.NUMBERED_NAME_ATTEMPTS', 2):
+            name = self.storage.get_available_name('report.txt')
+        self.assertRegex(name, r'^report_[0-9a-f]{8}\.txt$')
+        # Suffixed names are truncated to max_length
+        self.assertEqual(self.storage._suffixed_name('r' * 20, '.txt', 1, 12), 'rrrrrr_1.txt')
+
+
+class FileMetadataExtractorTest(TestCase):
+    """Test cases for FileMetadataExtractor"""
+    
+    def test_classify_file_type(self):
+        """Test categories come from the extension or content type, in priority order"""
+        classify = FileMetadataExtractor._classify_file_type
+        self.assertEqual(classify('.png', None), 'image')
+        self.assertEqual(classify('.csv', 'text/csv'), 'spreadsheet')
+        self.assertEqual(classify('', 'audio/mpeg'), 'audio')
+        self.assertEqual(classify('.bin', 'application/octet-stream'), 'other')
+        # An earlier category matched by content type beats the extension
+        self.assertEqual(classify('.csv', 'image/png'), 'image')
+        self.assertEqual(classify(
+            '.pptx',
+            'application/vnd.openxmlformats-officedocument.presentationml.presentation'
+        ), 'document')
+        # A later category's content type does not override the extension
+        self.assertEqual(classify('.zip', 'video/mp4'), 'archive')
+
+
+class FileHashManagerTest(TestCase):
+    """Test cases for FileHashManager"""
+    
+    def test_calculate_hash(self):
+        """Test a single digest matches hashlib and rewinds the file"""
+        upload = SimpleUploadedFile('data.bin', b'x' * 5000)
+        
+        self.assertEqual(
+            FileHashManager.calculate_hash(upload, 'md5'),
+            hashlib.md5(b'x' * 5000).hexdigest()
+        )
+        self.assertEqual(upload.tell(), 0)
+    
+    def test_calculate_hash_algorithms(self):
+        """Test every supported algorithm, and the sha256 fallback"""
+        content = b'content' * 1000
+        for algorithm in HASH_ALGORITHMS:
+            self.assertEqual(
+                FileHashManager.calculate_hash(SimpleUploadedFile('data.bin', content), algorithm),
+                hashlib.new(algorithm, content).hexdigest()
+            )
+        self.assertEqual(
+            FileHashManager.calculate_hash(SimpleUploadedFile('data.bin', content), 'crc32'),
+            hashlib.sha256(content).hexdigest()
+        )
+    
+    def test_calculate_hashes_single_pass(self):
+        """Test several digests are computed from one read of the content"""
+        content = b'content' * 1000
+        upload = SimpleUploadedFile('data.bin', content)
+        
+        hashes = FileHashManager.calculate_hashes(upload, ('md5', 'sha256'))
+        
+        self.assertEqual(hashes, {
+            'md5': hashlib.md5(content).hexdigest(),
+            'sha256': hashlib.sha256(content).hexdigest(),
+        })
+    
+    def test_verify_hashes_single_pass(self):
+        """Test several stored digests are verified from one read"""
+        content = b'content' * 1000
+        with tempfile.NamedTemporaryFile() as tmp:
+            tmp.write(content)
+            tmp.flush()
+            expected = {
+                'md5': hashlib.md5(content).hexdigest(),
+                'sha256': hashlib.sha256(content).hexdigest(),
+            }
+            
+            with mock.patch.object(
+                FileHashManager, 'calculate_hashes', wraps=FileHashManager.calculate_hashes
+            ) as calculate:
+                self.assertTrue(FileHashManager.verify_hashes(tmp.name, expected))
+            self.assertEqual(calculate.call_count, 1)
+            
+            self.assertFalse(FileHashManager.verify_hashes(tmp.name, {**expected, 'md5': '0' * 32}))
+            self.assertFalse(FileHashManager.verify_hashes(tmp.name, {'crc32': '0'}))
+            self.assertFalse(FileHashManager.verify_hashes(tmp.name + '.missing', expected))
+    
+    def test_large_disk_files_are_mapped(self):
+        """Test large files with a descriptor are hashed through mmap"""
+        content = b'0123456789abcdef' * (MMAP_HASH_THRESHOLD // 8)
+        with tempfile.NamedTemporaryFile() as tmp:
+            tmp.write(content)
+            tmp.flush()
+            
+            with mock.patch('apps.files.storage.mmap.mmap', wraps=mmap.mmap) as mapper:
+                with open(tmp.name, 'rb') as f:
+                    digest = FileHashManager.calculate_hash(File(f), 'sha256')
+                    hashes = FileHashManager.calculate_hashes(File(f), ('md5', 'sha256'))
+                    self.assertEqual(f.tell(), 0)
+                verified = FileHashManager.verify_integrity(
+                    tmp.name, hashlib.md5(content).hexdigest(), 'md5'
+                )
+        
+        self.assertEqual(mapper.call_count, 3)
+        self.assertEqual(digest, hashlib.sha256(content).hexdigest())
+        self.assertEqual(hashes['md5'], hashlib.md5(content).hexdigest())
+        self.assertEqual(hashes['sha256'], digest)
+        self.assertTrue(verified)
+    
+    def test_hash_chunk_size_setting(self):
+        """Test FILE_HASH_CHUNK_SIZE controls the read size of both entry points"""
+        class RecordingFile(io.BytesIO):
+            def read(self, size=-1):
+                self.sizes.append(size)
+                return super().read(size)
+        
+        content = b'content' * 1000
+        upload = RecordingFile(content)
+        upload.sizes = []
+        
+        with override_settings(FILE_HASH_CHUNK_SIZE=1024):
+            hashes = FileHashManager.calculate_hashes(upload, ('sha256',))
+            # Seven chunks for 7000 bytes, then the empty read at EOF
+            self.assertEqual(upload.sizes, [1024] * 8)
+            
+            upload.sizes = []
+            digest = FileHashManager.calculate_hash(upload, 'sha256')
+            self.assertEqual(upload.sizes, [1024] * 8)
+        
+        self.assertEqual(hashes, {'sha256': hashlib.sha256(content).hexdigest()})
+        self.assertEqual(digest, hashes['sha256'])
+
+
+class StorageQuotaManagerTest(TestCase):
+    """Test cases for StorageQuotaManager"""
+    
+    def test_update_user_quota_sums_in_database(self):
+        """Test usage is recalculated with one aggregate however many files exist"""
+        user = User.objects.create_user(username='testuser', password='testpass123')
+        UserProfile.objects.create(user=user)
+        for index in range(3):
+            document = FileDocument.objects.create(
+                url=f'/documents/{index}.txt', name=f'{index}.txt', owner=user
+            )
+            for content in (b'abc', b'abcdef'):
+                FileRevision.objects.create(
+                    document=document, file_data=SimpleUploadedFile('test.txt', content)
+                )
+        
+        user = User.objects.get(id=user.id)
+        # Profile lookup, the aggregate and the profile update
+        with self.assertNumQueries(3):
+            self.assertEqual(StorageQuotaManager.update_user_quota(user), 27)
+        self.assertEqual(UserProfile.objects.get(user=user).storage_used, 27)
+    
+    def test_release_storage_updates_in_database(self):
+        """Test freed bytes are subtracted from the stored usage, not a stale copy"""
+        user = User.objects.create_user(username='testuser', password='testpass123')
+        UserProfile.objects.create(user=user, storage_used=100)
+        user = User.objects.get(id=user.id)
+        user.profile  # Load the profile before usage changes elsewhere
+        UserProfile.objects.filter(user=user).update(storage_used=150)
+        
+        StorageQuotaManager.release_storage(user, 30)
+        self.assertEqual(UserProfile.objects.get(user=user).storage_used, 120)
+        
+        StorageQuotaManager.release_storage(user, 500)
+        self.assertEqual(UserProfile.objects.get(user=user).storage_used, 0)
+
+
+class AuditLogQueueTest(TestCase):
+    """Test cases for the background audit log queue"""
+    
+    def test_records_are_logged_as_json(self):
+        """Test that queued records are logged by the worker thread"""
+        audit_queue = AuditLogQueue()
+        with self.assertLogs('apps.files.middleware', level='INFO') as logs:
+            audit_queue.put('audit', (
+                1, 'testuser', 'VIEW', {'type': 'stats'}, '127.0.0.1',
+                'agent', timezone.now(), 200,
+            ))
+            deadline = time.monotonic() + 5
+            while not logs.records and time.monotonic() < deadline:
+                time.sleep(0.01)
+        
+        label, _, payload = logs.records[0].getMessage().partition(': ')
+        self.assertEqual(label, 'File audit')
+        record = json.loads(payload)
+        self.assertEqual(record['action'], 'VIEW')
+        self.assertEqual(record['file_info'], {'type': 'stats'})
+    
+    def test_records_are_dropped_when_info_is_disabled(self):
+        """Test that nothing is queued when INFO records would be discarded"""
+        self.addCleanup(middleware_logger.setLevel, middleware_logger.level)
+        middleware_logger.setLevel('WARNING')
+        
+        audit_queue = AuditLogQueue()
+        audit_queue.put('access', (
+            '127.0.0.1', 'agent', 'GET', '/api/files/', 200,
+            None, timezone.now(), False,
+        ))
+        
+        self.assertTrue(audit_queue._queue.empty())
+        self.assertIsNone(audit_queue._worker)
+
+
+class FileSecurityMiddlewareTest(TestCase):
+    """Test cases for FileSecurityMiddleware"""
+    
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        self.anonymous = AnonymousUser()
+        self.middleware = FileSecurityMiddleware(lambda request: None)
+    
+    def make_request(self, path='/api/files/'):
+        request = self.factory.get(path, REMOTE_ADDR='10.0.0.1')
+        request.user = self.anonymous
+        return request
+    
+    def test_rate_limit(self):
+        """Test that requests beyond the limit are rejected"""
+        with self.settings(ANONYMOUS_FILE_RATE_LIMIT=3):
+            responses = [
+                self.middleware.process_request(self.make_request())
+                for _ in range(4)
+            ]
+        
+        self.assertEqual(responses[:3], [None, None, None])
+        self.assertEqual(responses[3].status_code, 403)
+    
+    def test_rate_limit_weights_previous_window(self):
+        """Test that the previous window counts in proportion to its overlap"""
+        # Halfway through a window whose predecessor used the whole limit
+        now = 100 * RATE_LIMIT_WINDOW + RATE_LIMIT_WINDOW / 2
+        cache.set('file_rate_limit_10.0.0.1_99', 3)
+        
+        with self.settings(ANONYMOUS_FILE_RATE_LIMIT=3), \
+                mock.patch('apps.files.middleware.time.time', return_value=now):
+            self.assertFalse(self.middleware._is_rate_limited(self.make_request()))
+            self.assertTrue(self.middleware._is_rate_limited(self.make_request()))
+    
+    def test_suspicious_user_agents(self):
+        """Test that scripted clients are flagged regardless of case"""
+        for user_agent, suspicious in [
+            ('Mozilla/5.0 (X11; Linux x86_64)', False),
+            ('Wget/1.21', True),
+            ('Python-Requests/2.31', True),
+            ('Googlebot/2.1', True),
+        ]:
+            request = self.make_request()
+            request.META['HTTP_USER_AGENT'] = user_agent
+            self.assertEqual(self.middleware._is_suspicious_request(request), suspicious)
+    
+    def test_non_file_requests_are_skipped(self):
+        """Test that other paths bypass the checks and the result is reused"""
+        request = self.make_request('/api/auth/profile/')
+        self.assertIsNone(self.middleware.process_request(request))
+        self.assertFalse(hasattr(request, 'file_security'))
+        self.assertFalse(request._is_file_request)
+        
+        request = self.make_request('/media/uploads/test.txt')
+        self.assertIsNone(self.middleware.process_request(request))
+        self.assertTrue(request._is_file_request)
+    
+    def test_client_ip_prefers_forwarded_for(self):
+        """Test that the first forwarded address is used and kept on the request"""
+        request = self.make_request()
+        request.META['HTTP_X_FORWARDED_FOR'] = '203.0.113.5, 10.0.0.2, 10.0.0.3'
+        self.assertEqual(get_client_ip(request), '203.0.113.5')
+        
+        request.META['HTTP_X_FORWARDED_FOR'] = '198.51.100.7'
+        self.assertEqual(get_client_ip(request), '203.0.113.5')
+        self.assertEqual(get_client_ip(self.make_request()), '10.0.0.1')
+    
+    def test_client_ip_rejects_invalid_addresses(self):
+        """Test that malformed addresses are reported as None"""
+        request = self.make_request()
+        request.META['HTTP_X_FORWARDED_FOR'] = 'unknown, 10.0.0.2'
+        self.assertIsNone(get_client_ip(request))
+        
+        request = self.make_request()
+        del request.META['REMOTE_ADDR']
+        self.assertIsNone(get_client_ip(request))
+    
+    def test_user_context_follows_authentication(self):
+        """Test that the cached user context is refreshed when the user changes"""
+        request = self.make_request()
+        self.assertEqual(get_user_context(request), (False, None, ''))
+        
+        user = User.objects.create_user(username='testuser', password='testpass123')
+        request.user = user
+        self.assertEqual(get_user_context(request), (True, user.id, 'testuser'))
+    
+    def test_counters_are_per_ip(self):
+        """Test that counters start at one for each client"""
+        self.assertEqual(increment_cache_counter('file_rate_limit_10.0.0.1', 3600), 1)
+        self.assertEqual(increment_cache_counter('file_rate_limit_10.0.0.1', 3600), 2)
+        self.assertEqual(increment_cache_counter('file_rate_limit_10.0.0.2', 3600), 1)
+
+
+class ScopedFileAccessAuditMiddlewareTest(TestCase):
+    """Test cases for ScopedFileAccessAuditMiddleware"""
+    
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.middleware = ScopedFileAccessAuditMiddleware(lambda request: HttpResponse())
+        patcher = mock.patch.object(self.middleware.middleware, '_create_audit_log')
+        self.create_audit_log = patcher.start()
+        self.addCleanup(patcher.stop)
+    
+    def test_audits_file_api_requests(self):
+        """Test that file API responses reach the audit middleware"""
+        self.middleware(self.factory.get('/api/files/stats/'))
+        self.assertEqual(self.create_audit_log.call_count, 1)
+    
+    def test_skips_other_requests(self):
+        """Test that other paths bypass the audit middleware"""
+        self.middleware(self.factory.get('/api/auth/profile/'))
+        self.create_audit_log.assert_not_called()
+
+
+class FileDownloadSecurityMiddlewareTest(TestCase):
+    """Test cases for FileDownloadSecurityMiddleware"""
+    
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.middleware = FileDownloadSecurityMiddleware(lambda request: None)
+        self.audit_middleware = FileAccessAuditMiddleware(lambda request: None)
+    
+    def test_download_flag_is_exact(self):
+        """Test that only download=true marks a response as a download"""
+        response = HttpResponse()
+        download = self.factory.get('/api/files/serve/', {'download': 'true', 'v': '1'})
+        
+        self.assertTrue(self.middleware._is_file_download(download, response))
+        self.assertFalse(self.middleware._is_file_download(
+            self.factory.get('/api/files/serve/', {'nodownload': 'true'}), response
+        ))
+        self.assertEqual(self.audit_middleware._determine_action(download), 'DOWNLOAD')
+    
+    def test_secure_download_headers(self):
+        """Test that downloads are forced to attachments and not cached"""
+        response = HttpResponse()
+        self.middleware._secure_download_response(response)
+        
+        self.assertEqual(response['Content-Disposition'], 'attachment')
+        self.assertEqual(response['Cache-Control'], 'no-cache, no-store, must-revalidate')
+        self.assertEqual(response['X-Frame-Options'], 'DENY')
+        self.assertNotIn('Content-Security-Policy', response)
+
+
+class FileAccessPermissionTest(TestCase):
+    """Test cases for FileAccessPermission"""
+    
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+        self.document = FileDocument.objects.create(
+            url='/documents/test.txt', name='test.txt', owner=self.user
+        )
+        self.factory = RequestFactory()
+        self.permission = FileAccessPermission()
+    
+    def make_request(self, method='get', user=None):
+        request = getattr(self.factory, method)('/api/files/')
+        request.user = user or self.user
+        return request
+    
+    def test_permission_is_checked_once_per_request(self):
+        """Test that object checks reuse the request-level result"""
+        request = self.make_request('delete')
+        
+        self.assertTrue(self.permission.has_permission(request, None))
+        with self.assertNumQueries(0):
+            # The rate limit count is not repeated for the object check
+            self.assertTrue(self.permission.has_object_permission(request, None, self.document))
+    
+    def test_rate_limit_uses_cache_counter(self):
+        """Test that the hourly limit is counted without querying access logs"""
+        cache.clear()
+        with mock.patch('apps.files.permissions.ACCESS_RATE_LIMIT', 2), \
+                self.assertNumQueries(0):
+            results = [self.permission._is_rate_limited(self.user) for _ in range(3)]
+        
+        self.assertEqual(results, [False, False, True])
+    
+    def test_denial_message_is_reused(self):
+        """Test that a cached denial keeps its message"""
+        self.user.is_active = False
+        request = self.make_request()
+        
+        self.assertFalse(self.permission.has_permission(request, None))
+        permission = FileAccessPermission()
+        self.assertFalse(permission.has_object_permission(request, None, self.document))
+        self.assertEqual(permission.message, "Your account is not active.")
+    
+    def test_owner_check_compares_ids(self):
+        """Test that ownership checks do not load the owning user"""
+        other = User.objects.create_user(username='otheruser', password='testpass123')
+        FileRevision.objects.create(
+            document=self.document,
+            file_data=SimpleUploadedFile('test.txt', b'content')
+        )
+        document = FileDocument.objects.get(id=self.document.id)
+        revision = document.revisions.get()
+        request = self.make_request()
+        
+        with self.assertNumQueries(0):
+            self.assertTrue(self.permission._is_owner(self.user, document))
+            self.assertTrue(self.permission._is_owner(self.user, revision))
+            self.assertFalse(self.permission._is_owner(other, revision))
+            self.assertTrue(IsOwnerOrReadOnly()._check_owner(self.user, revision))
+            self.assertTrue(FileViewPermission().has_object_permission(request, None, revision))
+
+
+
+class BulkCheckOwnerTest(TestCase):
+    """Test cases for bulk_check_owner"""
+    
+    def test_checks_all_urls_in_one_query(self):
+        """Test ownership of many URLs is resolved with a single query"""
+        user = User.objects.create_user(username='testuser', password='testpass123')
+        other = User.objects.create_user(username='otheruser', password='testpass123')
+        FileDocument.objects.create(url='/documents/mine.txt', name='mine.txt', owner=user)
+        FileDocument.objects.create(url='/documents/theirs.txt', name='theirs.txt', owner=other)
+        
+        with self.assertNumQueries(1):
+            ownership = bulk_check_owner(
+                user, ['/documents/mine.txt', '/documents/theirs.txt', '/documents/missing.txt']
+            )
+        self.assertEqual(ownership, {
+            '/documents/mine.txt': True,
+            '/documents/theirs.txt': False,
+            '/documents/missing.txt': False,
+        })
+
+
+class FileAccessMiddlewareTest(TestCase):
+    """Test cases for FileAccessMiddleware"""
+    
+    def get_response(self, path):
+        request = RequestFactory().get(path)
+        request.resolver_match = resolve(path)
+        return FileAccessMiddleware(lambda request: HttpResponse())(request)
+    
+    def test_headers_only_on_file_responses(self):
+        """Test security headers are added to file API responses only"""
+        response = self.get_response('/api/files/stats/')
+        self.assertEqual(response['Content-Security-Policy'], "default-src 'none'")
+        self.assertEqual(response['Cache-Control'], 'no-cache, no-store, must-revalidate')
+        
+        response = self.get_response('/api/auth/profile/')
+        self.assertNotIn('Content-Security-Policy', response)
+        self.assertNotIn('Cache-Control', response)
+    
+    def test_security_context_is_reused_for_access_logs(self):
+        """Test access logs reuse the client details parsed by the middleware"""
+        user = User.objects.create_user(username='testuser', password='testpass123')
+        document = FileDocument.objects.create(url='/documents/test.txt', name='test.txt', owner=user)
+        request = RequestFactory().get(
+            '/api/files/stats/',
+            HTTP_X_FORWARDED_FOR='203.0.113.5, 10.0.0.1',
+            HTTP_USER_AGENT='x' * 2000
+        )
+        FileAccessMiddleware(lambda request: HttpResponse())(request)
+        self.assertEqual(request.security_context['ip_address'], '203.0.113.5')
+        self.assertEqual(len(request.security_context['user_agent']), 500)
+        
+        # The forwarded header is not parsed again when the access is logged
+        request.META['HTTP_X_FORWARDED_FOR'] = '198.51.100.7'
+        log_file_access(user, document, 'view', request)
+        access_log_buffer.flush()
+        log = FileAccessLog.objects.get()
+        self.assertEqual(log.ip_address, '203.0.113.5')
+        self.assertEqual(len(log.user_agent), 500)
+
+
+class StorageQuotaPermissionTest(TestCase):
+    """Test cases for StorageQuotaPermission"""
+    
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+        UserProfile.objects.create(user=self.user, storage_limit=100)
+        self.user = User.objects.get(id=self.user.id)
+    
+    def check(self, data):
+        request = make_request(self.user, 'POST', data)
+        return StorageQuotaPermission().has_permission(request, None)
+    
+    def test_profile_is_loaded_only_for_uploads(self):
+        """Test that requests without a file never load the profile"""
+        with self.assertNumQueries(0):
+            self.assertTrue(self.check({'name': 'test.txt'}))
+        
+        with self.assertNumQueries(1):
+            self.assertFalse(self.check({'file': SimpleUploadedFile('big.txt', b'x' * 200)}))
+        # The profile stays cached on the user for the rest of the request
+        with self.assertNumQueries(0):
+            self.assertTrue(self.check({'file': SimpleUploadedFile('small.txt', b'x' * 10)}))
+    
+    def test_missing_profile_gets_default_quota(self):
+        """Test that a user without a profile is held to the default quota"""
+        self.user = User.objects.create_user(username='noprofile', password='testpass123')
+        default_limit = UserProfile._meta.get_field('storage_limit').default
+        
+        self.assertFalse(self.check({'file': mock.Mock(size=default_limit + 1)}))
+        self.assertTrue(UserProfile.objects.filter(user=self.user).exists())
+        self.assertEqual(user_can_upload_file(self.user, default_limit + 1),
+                         (False, "Storage quota exceeded"))
+
+
+class FileTypePermissionTest(TestCase):
+    """Test cases for FileTypePermission"""
+    
+    def check(self, filename):
+        request = make_request(
+            AnonymousUser(), 'POST', {'file': SimpleUploadedFile(filename, b'content')}
+        )
+        return FileTypePermission().has_permission(request, None)
+    
+    def test_extension_checks(self):
+        """Test uploads are allowed by their last, case-insensitive extension"""
+        self.assertTrue(self.check('report.PDF'))
+        self.assertTrue(self.check('backup.tar.zip'))
+        self.assertFalse(self.check('script.sh'))
+        self.assertFalse(self.check('README'))
+        self.assertFalse(self.check('notes.ptxt'))
+    
+    def test_rejects_bare_extension(self):
+        """Test that a filename made of only an allowed extension is rejected"""
+        self.assertFalse(self.check('.txt'))
+        self.assertFalse(self.check('.PDF'))
+        self.assertTrue(self.check('a.txt'))
+
+
+class RequireFileOwnerTest(TestCase):
+    """Test cases for the require_file_owner decorator"""
+    
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+        self.other_user = User.objects.create_user(username='otheruser', password='testpass123')
+        self.document = FileDocument.objects.create(
+            url='/documents/test.txt', name='test.txt', owner=self.user
+        )
+        self.factory = RequestFactory()
+        self.view = require_file_owner(lambda request, **kwargs: request.file_document)
+    
+    def make_request(self, user):
+        request = self.factory.get('/api/files/')
+        request.user = user
+        return request
+    
+    def test_owner_gets_cached_document(self):
+        """Test the checked document is handed to the view in one query"""
+        with self.assertNumQueries(1):
+            document = self.view(self.make_request(self.user), file_id=self.document.id)
+        self.assertEqual(document, self.document)
+    
+    def test_other_user_is_denied(self):
+        """Test that non-owners are rejected"""
+        with self.assertRaises(PermissionDenied):
+            self.view(self.make_request(self.other_user), file_id=self.document.id)
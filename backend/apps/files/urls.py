@@ -8,6 +8,8 @@ from .api_extensions import (
     file_duplicates_view, storage_breakdown_view, verify_file_integrity
 )
 
+app_name = 'files'
+
 urlpatterns = [
     # File listing and upload
     path('', views.FileListCreateView.as_view(), name='file-list-create'),
@@ -3,24 +3,27 @@ Utility functions for file handling and management
 """
 import os
 import hashlib
+import ipaddress
 import mimetypes
+from functools import lru_cache
+from django.core.cache import cache
 from django.core.files.storage import default_storage
+from django.db.models import Count, Sum
 from django.conf import settings
 from .models import FileDocument, FileRevision
 
+USER_AGENT_MAX_LENGTH = 500
+
 
 def generate_file_hash(file_obj):
     """
     Generate MD5 hash for file content
     """
-    hasher = hashlib.md5()
-    
     # Reset file pointer to beginning
     file_obj.seek(0)
     
-    # Read file in chunks to handle large files
-    for chunk in iter(lambda: file_obj.read(4096), b""):
-        hasher.update(chunk)
+    # file_digest reads through one reused buffer instead of 4KB chunks
+    hasher = hashlib.file_digest(file_obj, hashlib.md5)
     
     # Reset file pointer back to beginning
     file_obj.seek(0)
@@ -28,12 +31,72 @@ def generate_file_hash(file_obj):
     return hasher.hexdigest()
 
 
+def get_client_ip(request):
+    """
+    Get the client IP address, parsed once per request
+    
+    Returns None when the header or REMOTE_ADDR is not a valid address, so
+    the value can always be stored in a GenericIPAddressField.
+    """
+    try:
+        return request._client_ip
+    except AttributeError:
+        pass
+    
+    x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
+    if x_forwarded_for:
+        ip = x_forwarded_for.split(',', 1)[0].strip()
+    else:
+        ip = request.META.get('REMOTE_ADDR', '')
+    try:
+        ip = str(ipaddress.ip_address(ip))
+    except ValueError:
+        ip = None
+    request._client_ip = ip
+    return ip
+
+
+def get_user_agent(request):
+    """
+    Get the client User-Agent, truncated to what the access log stores
+    """
+    return request.META.get('HTTP_USER_AGENT', '')[:USER_AGENT_MAX_LENGTH]
+
+
+def increment_cache_counter(cache_key, timeout):
+    """
+    Atomically increment a windowed counter in the cache and return it
+    """
+    try:
+        return cache.incr(cache_key)
+    except ValueError:
+        # First hit in this window; another worker may start it first
+        if cache.add(cache_key, 1, timeout=timeout):
+            return 1
+        return cache.incr(cache_key)
+
+
+@lru_cache(maxsize=1024)
+def _content_type_for_extension(extension):
+    return mimetypes.guess_type('file' + extension)[0]
+
+
+def guess_content_type(filename):
+    """
+    Guess a MIME type from the filename extension, cached per extension
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in mimetypes.encodings_map:
+        # Compressed names such as .tar.gz depend on the inner extension too
+        return mimetypes.guess_type(filename)[0]
+    return _content_type_for_extension(extension)
+
+
 def get_file_mime_type(filename):
     """
     Get MIME type for a file based on its extension
     """
-    mime_type, _ = mimetypes.guess_type(filename)
-    return mime_type or 'application/octet-stream'
+    return guess_content_type(filename) or 'application/octet-stream'
 
 
 def validate_file_extension(filename, allowed_extensions=None):
@@ -197,19 +260,27 @@ def get_file_stats_for_user(user):
     """
     Get comprehensive file statistics for a user
     """
-    documents = user.file_documents.all()
-    total_documents = documents.count()
-    total_revisions = sum(doc.get_revision_count() for doc in documents)
+    counts = user.file_documents.aggregate(
+        total_documents=Count('id'),
+        total_revisions=Sum('revision_count')
+    )
+    total_documents = counts['total_documents']
+    total_revisions = counts['total_revisions'] or 0
     
-    # File type breakdown
+    # File type breakdown, grouped by the database
+    extension_totals = FileRevision.objects.filter(
+        document__owner=user
+    ).values_list('extension').annotate(
+        count=Count('id'),
+        size=Sum('file_size')
+    ).order_by()
     file_types = {}
     total_size = 0
     
-    for document in documents:
-        for revision in document.revisions.all():
-            ext = revision.file_extension or 'unknown'
-            file_types[ext] = file_types.get(ext, 0) + 1
-            total_size += revision.file_size
+    for extension, count, size in extension_totals:
+        ext = extension or 'unknown'
+        file_types[ext] = file_types.get(ext, 0) + count
+        total_size += size
     
     return {
         'total_documents': total_documents,
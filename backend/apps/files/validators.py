@@ -7,6 +7,8 @@ from django.core.exceptions import ValidationError
 from django.core.files.uploadedfile import UploadedFile
 from django.conf import settings
 
+from .storage import StorageQuotaManager
+
 
 def validate_file_size(file_obj, max_size_mb=10):
     """
@@ -152,21 +154,19 @@ def validate_file_content(file_obj):
             raise ValidationError('Windows executable files are not allowed for security reasons.')
 
 
-def validate_user_storage_limit(user, additional_size):
+def reserve_user_storage(user, additional_size):
     """
-    Validate that user has enough storage space
+    Reserve storage space for an upload, or fail if it would exceed the quota
     """
-    if hasattr(user, 'profile'):
-        current_usage = user.profile.storage_used
-        storage_limit = user.profile.storage_limit
-        
-        if current_usage + additional_size > storage_limit:
-            available_space = storage_limit - current_usage
-            raise ValidationError(
-                f'Not enough storage space. '
-                f'Available: {available_space / (1024*1024):.1f}MB, '
-                f'Required: {additional_size / (1024*1024):.1f}MB'
-            )
+    if not StorageQuotaManager.reserve_storage(user, additional_size):
+        profile = user.profile
+        profile.refresh_from_db(fields=['storage_used', 'storage_limit'])
+        available_space = max(0, profile.storage_limit - profile.storage_used)
+        raise ValidationError(
+            f'Not enough storage space. '
+            f'Available: {available_space / (1024*1024):.1f}MB, '
+            f'Required: {additional_size / (1024*1024):.1f}MB'
+        )
 
 
 def validate_file_upload(file_obj, user=None, url_path=None):
@@ -184,6 +184,6 @@ def validate_file_upload(file_obj, user=None, url_path=None):
     if url_path:
         validate_url_path(url_path)
     
-    # User storage validation
+    # User storage reservation; callers run this in the upload's transaction
     if user:
-        validate_user_storage_limit(user, file_obj.size)
\ No newline at end of file
+        reserve_user_storage(user, file_obj.size)
\ No newline at end of file
@@ -4,24 +4,27 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.parsers import MultiPartParser, FormParser
 from django.shortcuts import get_object_or_404
-from django.http import HttpResponse, Http404
+from django.http import FileResponse, Http404
 from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Count, Sum
 import os
-import mimetypes
 
-from .models import FileDocument, FileRevision
+from .models import FileDocument, FileRevision, prefetch_latest_revision
 from .serializers import (
     FileDocumentSerializer, FileDocumentListSerializer, 
     FileDocumentDetailSerializer, FileRevisionSerializer,
     FileUploadSerializer
 )
-from .utils import create_file_document, update_user_storage_usage
+from .utils import create_file_document, guess_content_type, update_user_storage_usage
 from .validators import validate_file_upload
 from .permissions import (
     FileAccessPermission, StorageQuotaPermission, FileTypePermission,
-    BulkOperationPermission, log_file_access, UPLOAD_PERMISSIONS, OWNER_PERMISSIONS
+    log_file_access, UPLOAD_PERMISSIONS, OWNER_PERMISSIONS, BULK_PERMISSIONS
 )
 
+DOWNLOAD_CHUNK_SIZE = 64 * 1024  # bytes read per streamed download chunk
+
 
 class FileListCreateView(APIView):
     """
@@ -29,7 +32,7 @@ class FileListCreateView(APIView):
     GET /api/files/ - List all files for authenticated user
     POST /api/files/ - Upload a new file
     """
-    permission_classes = [permissions.IsAuthenticated, StorageQuotaPermission, FileTypePermission]
+    permission_classes = UPLOAD_PERMISSIONS
     parser_classes = [MultiPartParser, FormParser]
     
     def get(self, request):
@@ -51,7 +54,12 @@ class FileListCreateView(APIView):
         if ordering:
             documents = documents.order_by(ordering)
         
-        serializer = FileDocumentListSerializer(documents, many=True, context={'request': request})
+        # Load every listed document's latest revision in one extra query
+        serializer = FileDocumentListSerializer(
+            documents.prefetch_related(prefetch_latest_revision()),
+            many=True,
+            context={'request': request}
+        )
         return Response({
             'count': documents.count(),
             'results': serializer.data
@@ -70,11 +78,13 @@ class FileListCreateView(APIView):
         user = request.user
         
         try:
-            # Validate file upload
-            validate_file_upload(file_obj, user, url)
-            
-            # Create or update document (URL will be auto-generated if not provided)
-            document, revision = create_file_document(user, name, file_obj, url)
+            # Reserving quota and creating the revision commit or roll back together
+            with transaction.atomic():
+                # Validate file upload
+                validate_file_upload(file_obj, user, url)
+                
+                # Create or update document (URL will be auto-generated if not provided)
+                document, revision = create_file_document(user, name, file_obj, url)
             
             # Return the created document
             doc_serializer = FileDocumentDetailSerializer(document, context={'request': request})
@@ -93,7 +103,7 @@ class FileDetailView(APIView):
     PUT /api/files/{url}/ - Upload new revision
     DELETE /api/files/{url}/ - Delete file and all revisions
     """
-    permission_classes = [permissions.IsAuthenticated, FileAccessPermission, StorageQuotaPermission, FileTypePermission]
+    permission_classes = [*OWNER_PERMISSIONS, StorageQuotaPermission, FileTypePermission]
     parser_classes = [MultiPartParser, FormParser]
     
     def get_object(self, user, url):
@@ -132,7 +142,6 @@ class FileDetailView(APIView):
             # Serve file
             try:
                 # Get the original filename from the file path
-                import os
                 original_filename = os.path.basename(revision.file_data.name)
                 
                 # Extract the actual filename after the revision prefix (e.g., "1_Assignment2.zip" -> "Assignment2.zip")
@@ -149,8 +158,7 @@ class FileDetailView(APIView):
                 
                 # Always determine content type based on the actual filename extension
                 # Don't rely on stored content_type as it might be incorrect
-                import mimetypes
-                content_type, _ = mimetypes.guess_type(actual_filename)
+                content_type = guess_content_type(actual_filename)
                 if not content_type:
                     # If mimetypes can't determine it, use the stored content_type as fallback
                     content_type = revision.content_type if revision.content_type else 'application/octet-stream'
@@ -163,13 +171,12 @@ class FileDetailView(APIView):
                 print(f"DEBUG: File size: {revision.file_size}")
                 print(f"DEBUG: Content type: {content_type}")
                 
-                # Reset file pointer to beginning
-                revision.file_data.seek(0)
-                
-                response = HttpResponse(
-                    revision.file_data.read(),
+                # Stream the file in chunks instead of reading it into memory
+                response = FileResponse(
+                    revision.file_data.open('rb'),
                     content_type=content_type
                 )
+                response.block_size = DOWNLOAD_CHUNK_SIZE
                 response['Content-Disposition'] = f'attachment; filename="{actual_filename}"'
                 response['Content-Length'] = revision.file_size
                 
@@ -199,23 +206,25 @@ class FileDetailView(APIView):
         file_obj = request.data['file']
         
         try:
-            # Validate file upload
-            validate_file_upload(file_obj, user)
-            
-            # Create new revision
-            revision = FileRevision.objects.create(
-                document=document,
-                file_data=file_obj
-            )
-            
-            # Update document name if provided
-            name = request.data.get('name')
-            if name and name != document.name:
-                document.name = name
-                document.save()
-            
-            # Update user storage
-            update_user_storage_usage(user)
+            # Reserving quota and creating the revision commit or roll back together
+            with transaction.atomic():
+                # Validate file upload
+                validate_file_upload(file_obj, user)
+                
+                # Create new revision
+                revision = FileRevision.objects.create(
+                    document=document,
+                    file_data=file_obj
+                )
+                
+                # Update document name if provided
+                name = request.data.get('name')
+                if name and name != document.name:
+                    document.name = name
+                    document.save()
+                
+                # Update user storage
+                update_user_storage_usage(user)
             
             # Return updated document
             serializer = FileDocumentDetailSerializer(document, context={'request': request})
@@ -282,20 +291,22 @@ def file_stats_view(request):
     """
     user = request.user
     
-    # Calculate statistics
-    documents = user.file_documents.all()
-    total_documents = documents.count()
-    total_revisions = sum(doc.get_revision_count() for doc in documents)
+    # Calculate statistics from the stored per-document revision counts
+    counts = user.file_documents.aggregate(
+        total_documents=Count('id'),
+        total_revisions=Sum('revision_count')
+    )
+    total_documents = counts['total_documents']
+    total_revisions = counts['total_revisions'] or 0
     
-    # File type breakdown
+    # File type breakdown, grouped by the database
+    extension_counts = FileRevision.objects.filter(
+        document__owner=user
+    ).values_list('extension').annotate(count=Count('id')).order_by()
     file_types = {}
-    total_size = 0
-    
-    for document in documents:
-        for revision in document.revisions.all():
-            ext = revision.file_extension.lstrip('.') if revision.file_extension else 'unknown'
-            file_types[ext] = file_types.get(ext, 0) + 1
-            total_size += revision.file_size
+    for extension, count in extension_counts:
+        ext = extension.lstrip('.') or 'unknown'
+        file_types[ext] = file_types.get(ext, 0) + count
     
     # Storage info from user profile
     storage_info = {}
@@ -318,7 +329,7 @@ def file_stats_view(request):
 
 
 @api_view(['POST'])
-@permission_classes([permissions.IsAuthenticated, BulkOperationPermission])
+@permission_classes(BULK_PERMISSIONS)
 def bulk_delete_view(request):
     """
     Delete multiple files at once
@@ -66,6 +66,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'apps.files.middleware.ScopedFileAccessAuditMiddleware',
 ]
 
 ROOT_URLCONF = 'doc_keeper.urls'
@@ -99,6 +100,29 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# The file middleware keeps its request counters in the cache, so they are
+# only shared across workers when REDIS_URL points at Redis
+# (e.g. unix:///var/run/redis/redis.sock to skip TCP).
+
+REDIS_URL = os.getenv('REDIS_URL', '')
+
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -141,9 +165,23 @@ MEDIA_URL = 'media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
 # File upload settings
-FILE_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024  # 10MB
+# Uploads larger than one 64KB handler chunk spool to a temporary file so
+# concurrent uploads do not each hold the whole file in memory
+FILE_UPLOAD_MAX_MEMORY_SIZE = 64 * 1024  # 64KB
 DATA_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024  # 10MB
 
+# Threads that hash and classify uploads after commit; 0 runs that work
+# inline once the upload's transaction commits
+FILE_METADATA_WORKERS = int(os.getenv('FILE_METADATA_WORKERS', '0'))
+
+# Bytes read per step when hashing file content
+FILE_HASH_CHUNK_SIZE = int(os.getenv('FILE_HASH_CHUNK_SIZE', str(1024 * 1024)))
+
+# Insert batched file access logs from a background thread instead of the
+# thread that just finished a request. Queued rows are flushed on normal
+# shutdown; anything still buffered when a worker crashes is lost.
+FILE_ACCESS_LOG_BACKGROUND_FLUSH = os.getenv('FILE_ACCESS_LOG_BACKGROUND_FLUSH', 'False').lower() == 'true'
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -179,6 +217,7 @@ SIMPLE_JWT = {
     'ROTATE_REFRESH_TOKENS': True,
     'BLACKLIST_AFTER_ROTATION': True,
     'UPDATE_LAST_LOGIN': True,
+    # HMAC signing keeps token issue/verify cheap compared to RSA
     'ALGORITHM': 'HS256',
     'SIGNING_KEY': SECRET_KEY,
     'VERIFYING_KEY': None,